@@ -7,6 +7,23 @@ from lfd.mmqe.search import beam_search
 from lfd.rapprentice.knot_classifier import isKnot as is_knot
 
 
+class TransferResult(object):
+    def __init__(self, aug_traj, feasible, misgrasp, sim_state, check_feasible=False):
+        """Inits TransferResult
+        
+        Args:
+            aug_traj: transferred AugmentedTrajectory
+            feasible: whether the execution of aug_traj was feasible
+            misgrasp: whether a gripper closed without grasping anything during the execution
+            sim_state: simulation state after the execution
+            check_feasible: whether the execution stopped at the first infeasible part of aug_traj
+        """
+        self.aug_traj = aug_traj
+        self.feasible = feasible
+        self.misgrasp = misgrasp
+        self.sim_state = sim_state
+        self.check_feasible = check_feasible
+
 class ActionSelection(object):
     def __init__(self, registration_factory):
         """Inits ActionSelection
@@ -27,6 +44,12 @@ class ActionSelection(object):
         """
         raise NotImplementedError
 
+    def get_transfer_result(self, scene_state, action, check_feasible=False):
+        """Returns the TransferResult of the transfer and execution of action from scene_state if it was done 
+        with the same check_feasible while planning the last agenda, and None otherwise
+        """
+        return None
+
 class GreedyActionSelection(ActionSelection):
     def plan_agenda(self, scene_state, timestep):
         action2q_value = self.registration_factory.batch_cost(scene_state)
@@ -36,7 +59,11 @@ class GreedyActionSelection(ActionSelection):
 
 class FeatureActionSelection(ActionSelection):
     def __init__(self, registration_factory, features, actions, demos,
-                 width, depth, simulator=None, lfd_env=None):
+                 width, depth, simulator=None, lfd_env=None, sim_profile=None):
+        """
+        sim_profile is the fidelity profile (see DynamicSimulation.set_profile) of the simulation during the 
+        search. If None, the search uses the profile of lfd_env's simulation
+        """
         self.features = features
         self.actions = actions.keys()
 #        self.features.set_name2ind(self.actions)
@@ -45,9 +72,17 @@ class FeatureActionSelection(ActionSelection):
         self.depth = depth
         self.transferer = simulator
         self.lfd_env = lfd_env
+        self.sim_profile = sim_profile
+        # maps (scene state id, action, check_feasible) to the TransferResult of the simulations done by the last search
+        self.transfer_results = {}
         super(FeatureActionSelection, self).__init__(registration_factory)
 
+    def get_transfer_result(self, scene_state, action, check_feasible=False):
+        return self.transfer_results.get((scene_state.id, action, check_feasible))
+
     def plan_agenda(self, scene_state, timestep):
+        self.transfer_results = {}
+
         def evaluator(state, ts):
             try:
                 score = np.dot(self.features.features(state, timestep=ts), self.features.weights) + self.features.w0
@@ -57,9 +92,16 @@ class FeatureActionSelection(ActionSelection):
             #     import ipdb; ipdb.set_trace()
             return score
 
+        sim = self.lfd_env.sim
+        # the results of a search with a different profile can't be reused for the execution
+        preview = self.sim_profile is not None and self.sim_profile != sim.profile
+
         def simulate_transfer(state, action, next_state_id):
             aug_traj=self.transferer.transfer(self.demos[action], state, plotting=False)
-            self.lfd_env.execute_augmented_trajectory(aug_traj, step_viewer=0)
+            # the search executes the whole trajectory, i.e. without check_feasible
+            feasible, misgrasp = self.lfd_env.execute_augmented_trajectory(aug_traj, step_viewer=0)
+            if not preview:
+                self.transfer_results[(state.id, action, False)] = TransferResult(aug_traj, feasible, misgrasp, sim.get_state())
             result_state = self.lfd_env.observe_scene()
 
             # Get the rope simulation object and determine if it's a knot
@@ -70,6 +112,16 @@ class FeatureActionSelection(ActionSelection):
             rope_knot = is_knot(rope_sim_obj.rope.GetControlPoints())
             return (result_state, next_state_id, rope_knot)
 
-        return beam_search(scene_state, timestep, self.features.src_ctx.seg_names, simulate_transfer,
-                           evaluator, self.lfd_env.sim, width=self.width,
-                           depth=self.depth)
+        if not preview:
+            return beam_search(scene_state, timestep, self.features.src_ctx.seg_names, simulate_transfer,
+                               evaluator, sim, width=self.width,
+                               depth=self.depth)
+        sim_state, sim_profile = sim.get_state(), sim.profile
+        sim.set_profile(self.sim_profile)
+        try:
+            return beam_search(scene_state, timestep, self.features.src_ctx.seg_names, simulate_transfer,
+                               evaluator, sim, width=self.width,
+                               depth=self.depth)
+        finally:
+            # the state has the ropes of the original profile, so they are recreated from it instead of resampled
+            sim.set_profile(sim_profile, sim_state)
@@ -1,5 +1,8 @@
 from __future__ import division
 
+import os
+import hashlib
+import h5py
 import numpy as np
 from lfd.rapprentice import ropesim, resampling
 from lfd.rapprentice import math_utils as mu
@@ -20,10 +23,109 @@ class Demonstration(object):
             assert aug_traj.lr2ee_traj is not None
             assert aug_traj.lr2finger_traj is not None
         self.aug_traj = aug_traj
+        # demonstration-side results of the trajectory transfer that don't depend on the test scene
+        self.artifacts = {}
+    
+    def get_active_lr(self):
+        """Returns a string with the arms ('l' and/or 'r') that move in the demonstration"""
+        active_lr = ""
+        for lr in 'lr':
+            if lr in self.aug_traj.lr2arm_traj and sim_util.arm_moved(self.aug_traj.lr2arm_traj[lr]):
+                active_lr += lr
+        return active_lr
+    
+    def get_traj_hash(self):
+        sha = hashlib.sha1()
+        for lr2traj in [self.aug_traj.lr2arm_traj, self.aug_traj.lr2finger_traj]:
+            for lr in sorted(lr2traj.keys()):
+                sha.update(np.ascontiguousarray(lr2traj[lr], dtype=np.float64).tostring())
+        return sha.hexdigest()
+    
+    def get_resampled_traj(self, joint_length_per_step, finger_close_rate):
+        """Resamples the trajectory of the active arms so that the steps have the same length in joint space
+        
+        The result is cached in artifacts
+        
+        Returns:
+            The resampled timesteps and the resampled AugmentedTrajectory
+        """
+        resample_params = (joint_length_per_step, finger_close_rate)
+        if self.artifacts.get('resample_params') != resample_params:
+            self.artifacts = {'resample_params': resample_params}
+            active_lr = self.get_active_lr()
+            _, timesteps_rs = sim_util.unif_resample(np.c_[(1./joint_length_per_step) * np.concatenate([self.aug_traj.lr2arm_traj[lr] for lr in active_lr], axis=1), 
+                                                           (1./finger_close_rate) * np.concatenate([self.aug_traj.lr2finger_traj[lr] for lr in active_lr], axis=1)], 
+                                                     1.)
+            self.artifacts['timesteps_rs'] = timesteps_rs
+            self.artifacts['aug_traj_rs'] = self.aug_traj.get_resampled_traj(timesteps_rs)
+        return self.artifacts['timesteps_rs'], self.artifacts['aug_traj_rs']
+    
+    def get_resampled_finger_pts_traj(self, robot, lr, joint_length_per_step, finger_close_rate):
+        """Returns the finger points trajectories of the lr gripper along the resampled trajectory. The result is cached in artifacts"""
+        _, aug_traj_rs = self.get_resampled_traj(joint_length_per_step, finger_close_rate)
+        key = 'flr2finger_pts_traj_rs_%s'%lr
+        if key not in self.artifacts:
+            self.artifacts[key] = sim_util.get_finger_pts_traj(robot, lr, (aug_traj_rs.lr2ee_traj[lr], aug_traj_rs.lr2finger_traj[lr]))
+        return self.artifacts[key]
+    
+    def save_artifacts(self, group):
+        """Writes artifacts into the h5py group"""
+        for k in group.keys():
+            del group[k]
+        if 'resample_params' not in self.artifacts:
+            return
+        group.attrs['resample_params'] = self.artifacts['resample_params']
+        group.attrs['traj_hash'] = self.get_traj_hash()
+        group['timesteps_rs'] = self.artifacts['timesteps_rs']
+        aug_traj_rs = self.artifacts['aug_traj_rs']
+        for traj_name in ['arm', 'finger', 'ee', 'open_finger', 'close_finger']:
+            lr2traj = getattr(aug_traj_rs, 'lr2%s_traj'%traj_name)
+            for lr, traj in lr2traj.iteritems():
+                group['%s/%s'%(traj_name, lr)] = traj
+        for lr in 'lr':
+            key = 'flr2finger_pts_traj_rs_%s'%lr
+            if key in self.artifacts:
+                for finger_lr, finger_pts_traj in self.artifacts[key].iteritems():
+                    group['finger_pts/%s/%s'%(lr, finger_lr)] = finger_pts_traj
+    
+    def load_artifacts(self, group):
+        """Reads artifacts from the h5py group, unless they were computed from a different trajectory"""
+        if 'resample_params' not in group.attrs or group.attrs['traj_hash'] != self.get_traj_hash():
+            return False
+        self.artifacts = {'resample_params': tuple(group.attrs['resample_params'])}
+        self.artifacts['timesteps_rs'] = group['timesteps_rs'][()]
+        lr2trajs = {}
+        for traj_name in ['arm', 'finger', 'ee', 'open_finger', 'close_finger']:
+            lr2trajs['lr2%s_traj'%traj_name] = dict((lr, traj[()]) for lr, traj in group.get(traj_name, {}).iteritems())
+        self.artifacts['aug_traj_rs'] = AugmentedTrajectory(**lr2trajs)
+        for lr, flr2finger_pts_traj in group.get('finger_pts', {}).iteritems():
+            self.artifacts['flr2finger_pts_traj_rs_%s'%lr] = dict((finger_lr, traj[()]) for finger_lr, traj in flr2finger_pts_traj.iteritems())
+        return True
     
     def __repr__(self):
         return "%s(%s, %s, %s)" % (self.__class__.__name__, self.name, self.scene_state.__repr__(), self.aug_traj.__repr__())
 
+def save_demo_artifacts(demos, fname):
+    """Writes the artifacts of the demonstrations into the h5 file fname, with a group for each demonstration name"""
+    f = h5py.File(fname, 'a')
+    for name, demo in demos.iteritems():
+        if name not in f:
+            f.create_group(name)
+        demo.save_artifacts(f[name])
+    f.close()
+
+def load_demo_artifacts(demos, fname):
+    """Reads the artifacts saved by save_demo_artifacts, if fname exists. Returns the number of demonstrations loaded"""
+    if not os.path.exists(fname):
+        return 0
+    n_loaded = 0
+    f = h5py.File(fname, 'r')
+    for name, demo in demos.iteritems():
+        if name in f and demo.load_artifacts(f[name]):
+            n_loaded += 1
+    f.close()
+    return n_loaded
+
 
 class SceneState(object):
     ids = set()
@@ -216,7 +318,7 @@ class AugmentedTrajectory(object):
             for lr in self_lr2oc_finger_traj.keys():
                 self_oc_finger_traj = self_lr2oc_finger_traj[lr]
                 self_oc_inds = np.where(self_oc_finger_traj)[0]
-                oc_inds_rs = np.abs(timesteps_rs[:,None] - self_oc_inds[None,:]).argmin(axis=0)
+                oc_inds_rs = resampling.get_nearest_inds(timesteps_rs, self_oc_inds)
                 oc_finger_traj_rs = np.zeros(len(timesteps_rs), dtype=bool)
                 oc_finger_traj_rs[oc_inds_rs] = True
                 lr2oc_finger_traj_rs[lr] = oc_finger_traj_rs
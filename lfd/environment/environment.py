@@ -69,7 +69,8 @@ class LfdEnvironment(object):
             miniseg_traj = traj[start_ind:end_ind, active_inds]
             miniseg_dof_inds = list(np.asarray(dof_inds)[active_inds])
             full_traj = (miniseg_traj, miniseg_dof_inds)
-            feasible &= eval_util.traj_is_safe(self.sim, full_traj, 0)
+            if feasible: # the trajectory stays infeasible once a mini-segment is
+                feasible = eval_util.traj_is_safe(self.sim, full_traj, 0)
             if check_feasible and not feasible:
                 break
             self.world.execute_trajectory(full_traj, step_viewer=step_viewer, interactive=interactive, sim_callback=sim_callback)
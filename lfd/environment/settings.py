@@ -18,6 +18,48 @@ ROPE_MASS          = 1.0
 #:
 ROPE_RADIUS_THICK  = .008
 
+#: number of gripper joint values in the table of finger points used by sim_util.get_finger_pts_traj
+FINGER_PTS_TABLE_SIZE = 100
+
+#: simulation fidelity profiles of DynamicSimulation. time_step, max_substeps and fixed_time_step are the arguments of 
+#: the bullet steps, ropes have rope_link_stride times fewer links than in the full profile, and settle_max_steps is 
+#: the default maximum number of steps of DynamicSimulation.settle. Trajectories are executed with one step per 
+#: waypoint, and retimed so that the robot moves at the same speed in simulation time, so a profile with twice the 
+#: time_step executes them with half the steps. The preview profile is meant for search rollouts: half the steps, 
+#: each with the same two bullet substeps as the full profile but on ropes with half the links, so roughly a quarter 
+#: of the simulation cost per trajectory
+SIM_PROFILES = {
+    'full'   : {'time_step': .01, 'max_substeps': 200, 'fixed_time_step': .005, 'rope_link_stride': 1, 'settle_max_steps': 100},
+    'preview': {'time_step': .02, 'max_substeps': 10,  'fixed_time_step': .01,  'rope_link_stride': 2, 'settle_max_steps': 30},
+}
+#: fidelity profile of new simulations
+SIM_PROFILE = 'full'
+
+#: maximum number of steps between the checks of whether the dynamic objects have settled
+SETTLE_MAX_CHECK_INTERVAL = 10
+#: speed (in meters per second) below which the settling simulation uses a coarser time step
+SETTLE_COARSE_SPEED = .05
+
+#: number of simulation steps per waypoint in DynamicSimulationRobotWorld.execute_trajectory. The trajectory is 
+#: retimed with proportionally fewer waypoints, so larger values trade simulation accuracy for speed
+EXECUTE_N_SUBSTEPS = 1
+
+#: if True, DynamicSimulation.set_state writes the state into the existing bullet objects (and zeroes their 
+#: velocities) when the state has the same objects as the simulation, instead of recreating the bullet environment
+SET_STATE_IN_PLACE = True
+
+#: if True, the grippers close in one step until the nearest finger reaches the nearest object between the fingers 
+#: (or close completely if there is none), instead of closing by at most the maximum velocity at every step.
+#: Disabled by default since the resulting grasps haven't been validated against the stepwise closing
+PREDICT_CLOSING_STEP = False
+
+#: width and height (in pixels) of the simulated depth camera
+DEPTH_CAMERA_SIZE = (640, 480)
+#: focal length (in pixels) of the simulated depth camera
+DEPTH_CAMERA_FOCAL_LENGTH = 525.
+#: DynamicSimulationRobotWorld.observe_cloud casts a ray for every OBSERVE_CLOUD_SUBSAMPLE-th pixel along each image axis
+OBSERVE_CLOUD_SUBSAMPLE = 1
+
 #: window properties for the viewer's window
 WINDOW_PROP = [0,0,1500,1500]
 #: transposed homogeneous matrix for the viewer's camera
@@ -382,6 +382,70 @@ def get_finger_rel_pts(finger_lr):
         rot_x_180 = np.diag([1,-1,-1])
         return left_rel_pts.dot(rot_x_180.T)
 
+class FingerPtsTable(object):
+    """
+    Finger points of the lr gripper in its end-effector frame, tabulated over the range of the finger joint
+    
+    The finger points of other joint values are linearly interpolated, and the ones outside the range are clipped
+    """
+    def __init__(self, robot, lr, n_samples=settings.FINGER_PTS_TABLE_SIZE):
+        finger_ind = robot.GetJointIndex("%s_gripper_l_finger_joint"%lr)
+        lower, upper = robot.GetDOFLimits([finger_ind])
+        self.finger_vals = np.linspace(lower[0], upper[0], n_samples)
+        gripper_full_traj = (self.finger_vals[:,None], [finger_ind])
+        ee_traj = get_ee_traj(robot, lr, gripper_full_traj)
+        self.flr2ee_finger_pts = {}
+        for finger_lr in 'lr':
+            finger_traj = get_ee_traj(robot, lr, gripper_full_traj, ee_link_name_fmt="%s"+"_gripper_%s_finger_tip_link"%finger_lr)
+            finger_pts = finger_traj[:,None,:3,3] + np.einsum('tij,kj->tki', finger_traj[:,:3,:3], get_finger_rel_pts(finger_lr))
+            # express the points in the end-effector frame
+            self.flr2ee_finger_pts[finger_lr] = np.einsum('tji,tkj->tki', ee_traj[:,:3,:3], finger_pts - ee_traj[:,None,:3,3])
+        # distance between the inner surfaces of the fingers, which increases with the joint value
+        self.gaps = np.sqrt(((self.flr2ee_finger_pts['l'][:,0] - self.flr2ee_finger_pts['r'][:,3])**2).sum(axis=1))
+    
+    def get_gaps(self, finger_vals):
+        """
+        Returns the distances between the inner surfaces of the fingers for each of the finger_vals
+        """
+        return np.interp(finger_vals, self.finger_vals, self.gaps)
+    
+    def get_finger_vals(self, gaps):
+        """
+        Returns the finger joint values at which the inner surfaces of the fingers are at the distances gaps
+        """
+        return np.interp(gaps, self.gaps, self.finger_vals)
+    
+    def get_ee_finger_pts(self, finger_lr, finger_vals):
+        """
+        Returns the finger points in the end-effector frame for each of the finger_vals, as an array of shape (len(finger_vals), 4, 3)
+        """
+        finger_vals = np.clip(np.asarray(finger_vals).flatten(), self.finger_vals[0], self.finger_vals[-1])
+        inds = np.clip(np.searchsorted(self.finger_vals, finger_vals) - 1, 0, len(self.finger_vals) - 2)
+        fracs = (finger_vals - self.finger_vals[inds]) / (self.finger_vals[inds+1] - self.finger_vals[inds])
+        ee_finger_pts = self.flr2ee_finger_pts[finger_lr]
+        return ee_finger_pts[inds] + fracs[:,None,None] * (ee_finger_pts[inds+1] - ee_finger_pts[inds])
+    
+    def get_finger_pts_traj(self, ee_traj, finger_traj):
+        """
+        Composes the tabulated finger points with the end-effector poses of the whole trajectory
+        """
+        flr2finger_pts_traj = {}
+        for finger_lr in 'lr':
+            ee_finger_pts = self.get_ee_finger_pts(finger_lr, finger_traj)
+            flr2finger_pts_traj[finger_lr] = ee_traj[:,None,:3,3] + np.einsum('tij,tkj->tki', ee_traj[:,:3,:3], ee_finger_pts)
+        return flr2finger_pts_traj
+
+_finger_pts_tables = {}
+def get_finger_pts_table(robot, lr):
+    """
+    Returns the FingerPtsTable of the lr gripper, which is only computed the first time for each robot and finger joint limits
+    """
+    finger_ind = robot.GetJointIndex("%s_gripper_l_finger_joint"%lr)
+    key = (robot.GetKinematicsGeometryHash(), lr, tuple(np.asarray(robot.GetDOFLimits([finger_ind])).flat))
+    if key not in _finger_pts_tables:
+        _finger_pts_tables[key] = FingerPtsTable(robot, lr)
+    return _finger_pts_tables[key]
+
 def get_finger_pts_traj(robot, lr, full_traj_or_ee_finger_traj):
     """
     ee_traj = sim_util.get_ee_traj(robot, lr, arm_traj)
@@ -395,18 +459,7 @@ def get_finger_pts_traj(robot, lr, full_traj_or_ee_finger_traj):
     if full_traj_or_ee_finger_traj[0].ndim == 3:
         ee_traj, finger_traj = full_traj_or_ee_finger_traj
         assert len(ee_traj) == len(finger_traj)
-        for finger_lr in 'lr':
-            gripper_full_traj = get_full_traj(robot, {}, {lr:finger_traj})
-            rel_ee_traj = get_ee_traj(robot, lr, gripper_full_traj)
-            rel_finger_traj = get_ee_traj(robot, lr, gripper_full_traj, ee_link_name_fmt="%s"+"_gripper_%s_finger_tip_link"%finger_lr)
-            
-            flr2finger_pts_traj[finger_lr] = []
-            for (world_from_ee, world_from_rel_ee, world_from_rel_finger) in zip(ee_traj, rel_ee_traj, rel_finger_traj):
-                ee_from_finger = mu.invertHmat(world_from_rel_ee).dot(world_from_rel_finger)
-                world_from_finger = world_from_ee.dot(ee_from_finger)
-                finger_pts = world_from_finger[:3,3] + get_finger_rel_pts(finger_lr).dot(world_from_finger[:3,:3].T)
-                flr2finger_pts_traj[finger_lr].append(finger_pts)
-            flr2finger_pts_traj[finger_lr] = np.asarray(flr2finger_pts_traj[finger_lr])
+        flr2finger_pts_traj = get_finger_pts_table(robot, lr).get_finger_pts_traj(np.asarray(ee_traj), finger_traj)
     else:
         full_traj = full_traj_or_ee_finger_traj
         for finger_lr in 'lr':
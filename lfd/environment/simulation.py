@@ -3,12 +3,14 @@ from __future__ import division
 import openravepy
 import trajoptpy
 import bulletsimpy
-from lfd.rapprentice import animate_traj, ropesim
+from lfd.rapprentice import animate_traj, ropesim, resampling
 import numpy as np
 from robot_world import RobotWorld
 import sim_util
+import simulation_object
 import settings
 import importlib
+import hashlib
 
 class StaticSimulation(object):
     def __init__(self, env=None):
@@ -19,9 +21,11 @@ class StaticSimulation(object):
             self.env.StopSimulation()
         self.sim_objs = []
         self.robot = None
+        self.structure_version = 0 # incremented every time objects are added or removed
         self.__viewer_cache = None
     
     def add_objects(self, objs_to_add, consider_finger_collisions=True):
+        self.structure_version += 1
         if consider_finger_collisions:
             self._include_gripper_finger_collisions()
         n_robots = len(self.env.GetRobots())
@@ -39,6 +43,7 @@ class StaticSimulation(object):
             self._exclude_gripper_finger_collisions()
     
     def remove_objects(self, objs_to_remove, consider_finger_collisions=True):
+        self.structure_version += 1
         if consider_finger_collisions:
             self._include_gripper_finger_collisions()
         for obj_to_remove in objs_to_remove:
@@ -68,7 +73,18 @@ class StaticSimulation(object):
     
     def set_state(self, sim_state):
         constr_infos, states = sim_state
-        
+        sim_objs_to_remove, sim_objs_to_add = self._get_objects_diff(constr_infos)
+        if sim_objs_to_remove:
+            self.remove_objects(sim_objs_to_remove)
+        if sim_objs_to_add:
+            self.add_objects(sim_objs_to_add)
+        self._set_objects_state(states)
+    
+    def _get_objects_diff(self, constr_infos):
+        """
+        Returns the objects to remove and the objects to add so that the objects of the simulation have the 
+        constructor infos constr_infos
+        """
         cur_constr_infos = [sim_obj._get_constructor_info() for sim_obj in self.sim_objs]
         
         constr_infos_to_remove = [constr_info for constr_info in cur_constr_infos if constr_info not in constr_infos]
@@ -83,9 +99,9 @@ class StaticSimulation(object):
             class_module = importlib.import_module(class_module)
             c = getattr(class_module, class_name)
             sim_objs_to_add.append(c(*args, **kwargs))
-        self.remove_objects(sim_objs_to_remove)
-        self.add_objects(sim_objs_to_add)
-        
+        return sim_objs_to_remove, sim_objs_to_add
+    
+    def _set_objects_state(self, states):
         # the states should have one and only one state for every sim_obj and dof info
         states_keys = ["".join(sim_obj.names) for sim_obj in self.sim_objs] + ["dof_limits", "dof_values"]
         assert set(states_keys) == set(states.keys())
@@ -95,6 +111,13 @@ class StaticSimulation(object):
         self.robot.SetDOFLimits(*states["dof_limits"])
         self.robot.SetDOFValues(states["dof_values"])
     
+    def _can_set_state_in_place(self):
+        return True
+    
+    def _set_state_in_place(self, states):
+        """Sets the states of the current objects, which should be the ones of the states"""
+        self._set_objects_state(states)
+    
     @property
     def viewer(self):
         if not self.__viewer_cache and trajoptpy.ViewerExists(self.env):
@@ -151,6 +174,99 @@ class StaticSimulation(object):
         return True
 
 
+class SimulationSnapshot(object):
+    """
+    Compact state of a simulation, captured and restored by a 
+    SimulationSnapshotStore. The transforms of all the objects are flattened 
+    into a positions array and a quaternions array. The arrays are read-only.
+    """
+    __slots__ = ('fingerprint', 'positions', 'quats', 'dof_values')
+    
+    def __init__(self, fingerprint, positions, quats, dof_values):
+        self.fingerprint = fingerprint
+        self.positions = positions
+        self.quats = quats
+        self.dof_values = dof_values
+        for arr in [positions, quats, dof_values]:
+            arr.flags.writeable = False
+    
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.quats.nbytes + self.dof_values.nbytes
+
+class SimulationSnapshotStore(object):
+    """
+    Captures SimulationSnapshots of simulations and restores them
+    
+    The parts of the states that only change when objects are added or removed 
+    (the objects' constructor infos, the layout of the transforms and the 
+    robot's DOF limits) are kept once in the store for all the snapshots with 
+    the same structure fingerprint. The fingerprint of a simulation is only 
+    recomputed when its structure_version or its DOF limits change.
+    
+    A snapshot is restored in place when the simulation has the structure of 
+    the snapshot and allows it, otherwise it goes through set_state.
+    """
+    def __init__(self):
+        # maps fingerprint to (constructor infos, list of (state key, number of transforms), dof limits)
+        self.structures = {}
+        # maps id(sim) to (structure version, dof limits, fingerprint)
+        self._sim_fingerprints = {}
+    
+    def _get_fingerprint(self, sim, tfs_list=None):
+        dof_limits = np.asarray(sim.robot.GetDOFLimits())
+        cached = self._sim_fingerprints.get(id(sim))
+        if cached is not None and cached[0] == sim.structure_version and np.array_equal(cached[1], dof_limits):
+            return cached[2]
+        if tfs_list is None:
+            tfs_list = [sim_obj.get_state() for sim_obj in sim.sim_objs]
+        constr_infos = [sim_obj._get_constructor_info() for sim_obj in sim.sim_objs]
+        layout = [("".join(sim_obj.names), len(tfs)) for (sim_obj, tfs) in zip(sim.sim_objs, tfs_list)]
+        sha = hashlib.sha1(repr((constr_infos, layout)))
+        sha.update(np.ascontiguousarray(dof_limits, dtype=np.float64).tostring())
+        fingerprint = sha.hexdigest()
+        if fingerprint not in self.structures:
+            self.structures[fingerprint] = (constr_infos, layout, dof_limits)
+        self._sim_fingerprints[id(sim)] = (sim.structure_version, dof_limits, fingerprint)
+        return fingerprint
+    
+    def capture(self, sim):
+        tfs_list = [sim_obj.get_state() for sim_obj in sim.sim_objs]
+        fingerprint = self._get_fingerprint(sim, tfs_list)
+        if tfs_list:
+            tfs = np.concatenate([np.asarray(tfs).reshape((-1,4,4)) for tfs in tfs_list])
+        else:
+            tfs = np.zeros((0,4,4))
+        positions = tfs[:,:3,3].copy()
+        quats = resampling.quats_from_rot_mats(tfs[:,:3,:3])
+        return SimulationSnapshot(fingerprint, positions, quats, np.array(sim.robot.GetDOFValues(), dtype=float))
+    
+    def _get_states(self, snapshot):
+        constr_infos, layout, dof_limits = self.structures[snapshot.fingerprint]
+        tfs = np.zeros((len(snapshot.positions),4,4))
+        tfs[:,:3,3] = snapshot.positions
+        tfs[:,:3,:3] = resampling.rot_mats_from_quats(snapshot.quats) if len(tfs) else np.zeros((0,3,3))
+        tfs[:,3,3] = 1
+        states = {}
+        i = 0
+        for k, n_tfs in layout:
+            states[k] = tfs[i:i+n_tfs]
+            i += n_tfs
+        states["dof_limits"] = dof_limits
+        states["dof_values"] = np.array(snapshot.dof_values)
+        return states
+    
+    def get_state(self, snapshot):
+        """Returns the snapshot in the format of StaticSimulation.get_state"""
+        constr_infos = self.structures[snapshot.fingerprint][0]
+        return (constr_infos, self._get_states(snapshot))
+    
+    def restore(self, sim, snapshot):
+        if sim._can_set_state_in_place() and self._get_fingerprint(sim) == snapshot.fingerprint:
+            sim._set_state_in_place(self._get_states(snapshot))
+        else:
+            sim.set_state(self.get_state(snapshot))
+
 class DynamicSimulation(StaticSimulation):
     def __init__(self, env=None):
         super(DynamicSimulation, self).__init__(env=env)
@@ -158,32 +274,56 @@ class DynamicSimulation(StaticSimulation):
         self.bt_env = None
         self.bt_robot = None   
         self.dyn_bt_objs = []
+        self.profile = settings.SIM_PROFILE
+    
+    def set_profile(self, profile, sim_state=None):
+        """
+        sets the fidelity profile, which is a key of settings.SIM_PROFILES. If the profiles have different rope 
+        resolutions, the ropes are replaced by ropes of the same shape with the number of links of the new profile. 
+        If sim_state is given, the simulation is set to sim_state instead, which should be a state with the rope 
+        resolution of the new profile (e.g. a state from before switching to another profile)
+        """
+        if sim_state is not None:
+            self.profile = profile
+            self.set_state(sim_state)
+            return
+        old_stride = settings.SIM_PROFILES[self.profile]['rope_link_stride']
+        new_stride = settings.SIM_PROFILES[profile]['rope_link_stride']
+        self.profile = profile
+        ropes = [sim_obj for sim_obj in self.dyn_sim_objs if isinstance(sim_obj, simulation_object.RopeSimulationObject)]
+        if new_stride == old_stride or not ropes:
+            return
+        new_ropes = []
+        for rope in ropes:
+            n_links = len(rope.rope.GetControlPoints()) - 1
+            n_links = max(int(round(n_links * old_stride / new_stride)), 1)
+            new_ropes.append(rope.resampled(n_links + 1))
+        self._replace_objects(ropes, new_ropes)
     
     def add_objects(self, sim_objs):
-        static_sim_objs = [sim_obj for sim_obj in sim_objs if not sim_obj.dynamic]
-        dyn_sim_objs = [sim_obj for sim_obj in sim_objs if sim_obj.dynamic]
-        self._include_gripper_finger_collisions()
-        # add static objects
-        super(DynamicSimulation, self).add_objects(static_sim_objs, consider_finger_collisions=False)
-        # add dynamic objects
-        self._remove_bullet()
-        for sim_obj in dyn_sim_objs:
-            self.sim_objs.append(sim_obj)
-            self.dyn_sim_objs.append(sim_obj)
-        self._create_bullet()
-        self._exclude_gripper_finger_collisions()
+        self._replace_objects([], sim_objs)
     
     def remove_objects(self, sim_objs):
-        static_sim_objs = [sim_obj for sim_obj in sim_objs if not sim_obj.dynamic]
-        dyn_sim_objs = [sim_obj for sim_obj in sim_objs if sim_obj.dynamic]
+        self._replace_objects(sim_objs, [])
+    
+    def _replace_objects(self, sim_objs_to_remove, sim_objs_to_add):
+        """removes and adds objects, recreating the bullet environment once"""
         self._include_gripper_finger_collisions()
-        # remove static objects
-        super(DynamicSimulation, self).remove_objects(static_sim_objs, consider_finger_collisions=False)
-        # remove dynamic objects
+        # remove and add static objects
+        static_sim_objs_to_remove = [sim_obj for sim_obj in sim_objs_to_remove if not sim_obj.dynamic]
+        static_sim_objs_to_add = [sim_obj for sim_obj in sim_objs_to_add if not sim_obj.dynamic]
+        super(DynamicSimulation, self).remove_objects(static_sim_objs_to_remove, consider_finger_collisions=False)
+        super(DynamicSimulation, self).add_objects(static_sim_objs_to_add, consider_finger_collisions=False)
+        # remove and add dynamic objects
         self._remove_bullet()
-        for sim_obj in dyn_sim_objs:
-            self.sim_objs.remove(sim_obj)
-            self.dyn_sim_objs.remove(sim_obj)
+        for sim_obj in sim_objs_to_remove:
+            if sim_obj.dynamic:
+                self.sim_objs.remove(sim_obj)
+                self.dyn_sim_objs.remove(sim_obj)
+        for sim_obj in sim_objs_to_add:
+            if sim_obj.dynamic:
+                self.sim_objs.append(sim_obj)
+                self.dyn_sim_objs.append(sim_obj)
         self._create_bullet()
         self._exclude_gripper_finger_collisions()
     
@@ -196,48 +336,94 @@ class DynamicSimulation(StaticSimulation):
         execution1()
         set_state(sim_state)
         execution2()
+
+        If the objects of sim_state are the ones in the simulation and the 
+        robot isn't grasping anything, the state is set in the existing bullet 
+        environment, otherwise the bullet environment is recreated.
         """
-        self._include_gripper_finger_collisions()
-        self._remove_bullet()
-        self._create_bullet()
-        self._exclude_gripper_finger_collisions()
-        super(DynamicSimulation, self).set_state(sim_state)
+        constr_infos, states = sim_state
+        if self._can_set_state_in_place() and \
+                constr_infos == [sim_obj._get_constructor_info() for sim_obj in self.sim_objs]:
+            self._set_state_in_place(states)
+            return
+        # the bullet environment is recreated once, with the objects of sim_state
+        self._replace_objects(*self._get_objects_diff(constr_infos))
+        self._set_objects_state(states)
+        self.update()
+    
+    def _can_set_state_in_place(self):
+        return settings.SET_STATE_IN_PLACE and self.bt_env is not None
+    
+    def _set_state_in_place(self, states):
+        # same objects, so their states are written into the existing bullet objects
+        self._set_objects_state(states)
+        for sim_obj in self.dyn_sim_objs:
+            sim_obj.zero_velocities()
         self.update()
 
     def update(self):
         self.bt_robot.UpdateBullet()
         self._update_rave()
     
-    def step(self):
+    def step(self, n_substeps=1, update_rave=True):
+        """
+        advances the bullet simulation n_substeps times with the current robot configuration. If update_rave 
+        is False, the caller is responsible for calling _update_rave before the openrave bodies are used
+        """
+        profile = settings.SIM_PROFILES[self.profile]
         self.bt_robot.UpdateBullet()
-        self.bt_env.Step(.01, 200, .005)
-        self._update_rave()
+        for _ in range(n_substeps):
+            self.bt_env.Step(profile['time_step'], profile['max_substeps'], profile['fixed_time_step'])
+        if update_rave:
+            self._update_rave()
 
     def get_translations(self):
         """return translation part of all links of all dynamic objects"""
-        return np.concatenate(
-            [np.asarray([link.GetTransform() for link in bt_obj.GetKinBody().GetLinks()])[:, :3, 3]
-                for bt_obj in self.dyn_bt_objs]
-        )
+        if not self.dyn_sim_objs:
+            return np.zeros((0,3))
+        return np.concatenate([sim_obj.get_translations() for sim_obj in self.dyn_sim_objs])
 
-    def settle(self, max_steps=100, tol=.001, step_viewer=1):
-        """Keep stepping until the dynamic objects doesn't move, up to some tolerance"""
+    def settle(self, max_steps=None, tol=.001, step_viewer=1, energy_tol=None):
+        """Keep stepping until the dynamic objects doesn't move, up to some tolerance
+        
+        The objects have settled when every link would move less than tol in 10 steps at its current speed, or 
+        when the kinetic energy per unit mass of the links is less than energy_tol. The speeds are checked every 
+        10 steps while the links move fast, and more often as they slow down. Bullet uses a coarser time step once 
+        all the links are slower than settings.SETTLE_COARSE_SPEED. If max_steps is None, the maximum number of 
+        steps of the fidelity profile is used.
+        
+        Returns the number of steps
+        """
+        profile = settings.SIM_PROFILES[self.profile]
+        if max_steps is None:
+            max_steps = profile['settle_max_steps']
+        dt = profile['time_step']
+        fixed_dt = profile['fixed_time_step']
+        check_interval = settings.SETTLE_MAX_CHECK_INTERVAL
         prev_trans = self.get_translations()
-        for i in range(max_steps):
-            self.bt_env.Step(.01, 200, .005)
-            self._update_rave()
-            if self.viewer and step_viewer != 0 and i % step_viewer == 0:
-                if self.viewer:
-                    self.viewer.Step()
-            if i % 10 == 0 and i != 0:
+        i_prev_check = 0
+        i_step = 0
+        while i_step < max_steps:
+            self.bt_env.Step(dt, profile['max_substeps'], fixed_dt)
+            i_step += 1
+            if self.viewer and step_viewer != 0 and (i_step-1) % step_viewer == 0:
+                self._update_rave()
+                self.viewer.Step()
+            if i_step - i_prev_check >= check_interval:
                 curr_trans = self.get_translations()
-                diff = np.sqrt(((curr_trans - prev_trans)**2).sum(axis=1))
-                if diff.max() < tol:
+                speeds = np.sqrt(((curr_trans - prev_trans)**2).sum(axis=1)) / ((i_step - i_prev_check) * dt)
+                max_disp = speeds.max() * 10 * dt if len(speeds) else 0.
+                if max_disp < tol or (energy_tol is not None and .5 * (speeds**2).sum() < energy_tol):
                     break
+                # check less often while the links are far from settling
+                check_interval = int(np.clip(max_disp / tol, 1, settings.SETTLE_MAX_CHECK_INTERVAL))
+                fixed_dt = dt if speeds.max() < settings.SETTLE_COARSE_SPEED else profile['fixed_time_step']
                 prev_trans = curr_trans
+                i_prev_check = i_step
         self._update_rave()
         if self.viewer and step_viewer != 0:
             self.viewer.Step()
+        return i_step
     
     def _create_bullet(self):
         # create bullet environment and dynamic objects in it
@@ -286,7 +472,11 @@ class DynamicSimulationRobotWorld(DynamicSimulation, RobotWorld):
         self.T_w_k = T_w_k
         self.range_k = range_k
     
-    def observe_cloud(self):
+    def observe_cloud(self, subsample=settings.OBSERVE_CLOUD_SUBSAMPLE):
+        """
+        Simulates the depth camera by casting a ray for every subsample-th 
+        pixel (along each image axis) onto the dynamic objects
+        """
         if self.T_w_k is None:
             if self.robot is None:
                 raise RuntimeError("Can't observe cloud when there is no robot")
@@ -295,29 +485,29 @@ class DynamicSimulationRobotWorld(DynamicSimulation, RobotWorld):
                 self.T_w_k = berkeley_pr2.get_kinect_transform(self.robot)
         
         # camera's parameters
-        cx = 320.-.5
-        cy = 240.-.5
-        f = 525.  # focal length
-        w = 640.
-        h = 480.
+        w, h = settings.DEPTH_CAMERA_SIZE
+        cx = w/2.-.5
+        cy = h/2.-.5
+        f = settings.DEPTH_CAMERA_FOCAL_LENGTH
         
-        pixel_ij = np.array(np.meshgrid(np.arange(w), np.arange(h))).T.reshape((-1, 2))  # all pixel positions
-        rays_to = self.range_k * np.c_[(pixel_ij - np.array([cx, cy])) / f, np.ones(pixel_ij.shape[0])]
-        rays_from = np.zeros_like(rays_to)
-        # transform the rays from the camera frame to the world frame
-        rays_to = rays_to.dot(self.T_w_k[:3,:3].T) + self.T_w_k[:3,3]
-        rays_from = rays_from.dot(self.T_w_k[:3,:3].T) + self.T_w_k[:3,3]
-
+        T_k_w = np.linalg.inv(self.T_w_k)
+        # bulletsimpy only exposes the hit points through the RayTest results, 
+        # so they are gathered into a single list and converted to an array once
         cloud = []
         for sim_obj in self.dyn_sim_objs:
             for bt_obj in sim_obj.get_bullet_objects():
+                # only cast the rays of the pixels in the projection of the object's bounding box
+                aabb = bt_obj.GetKinBody().ComputeAABB()
+                pixel_ij = self._get_roi_pixels(aabb.pos(), aabb.extents(), T_k_w, subsample)
+                if len(pixel_ij) == 0:
+                    continue
+                rays_to = self.range_k * np.c_[(pixel_ij - np.array([cx, cy])) / f, np.ones(pixel_ij.shape[0])]
+                # transform the rays from the camera frame to the world frame
+                rays_to = rays_to.dot(self.T_w_k[:3,:3].T) + self.T_w_k[:3,3]
+                rays_from = np.tile(self.T_w_k[:3,3], (len(rays_to), 1))
                 ray_collisions = self.bt_env.RayTest(rays_from, rays_to, bt_obj)
-                
-                pts = np.empty((len(ray_collisions), 3))
-                for i, ray_collision in enumerate(ray_collisions):
-                    pts[i, :] = ray_collision.pt
-                cloud.append(pts)
-        cloud = np.concatenate(cloud)
+                cloud.extend([ray_collision.pt for ray_collision in ray_collisions])
+        cloud = np.array(cloud, dtype=float).reshape((-1, 3))
 
         # hack to filter out point below the top of the table. TODO: fix this hack
         table_sim_objs = [sim_obj for sim_obj in self.sim_objs if "table" in sim_obj.names]
@@ -327,6 +517,29 @@ class DynamicSimulationRobotWorld(DynamicSimulation, RobotWorld):
         cloud = cloud[cloud[:, 2] > table_height, :]
         return cloud
 
+    def _get_roi_pixels(self, aabb_pos, aabb_extents, T_k_w, subsample):
+        """
+        Returns the pixel positions of the depth camera's image (in the order 
+        of the full image) that are in the projection of the axis-aligned box, 
+        or all of them if the box isn't in front of the camera
+        """
+        w, h = settings.DEPTH_CAMERA_SIZE
+        cx = w/2.-.5
+        cy = h/2.-.5
+        f = settings.DEPTH_CAMERA_FOCAL_LENGTH
+        i_range = np.arange(0, w, subsample)
+        j_range = np.arange(0, h, subsample)
+        
+        corners = aabb_pos + aabb_extents * np.array(np.meshgrid([-1,1], [-1,1], [-1,1])).T.reshape((-1,3))
+        corners_k = corners.dot(T_k_w[:3,:3].T) + T_k_w[:3,3]
+        if np.all(corners_k[:,2] > 0):
+            # one pixel of margin for the rays that graze the box
+            uv = f * corners_k[:,:2] / corners_k[:,2][:,None] + np.array([cx, cy])
+            (u_min, v_min), (u_max, v_max) = np.floor(uv.min(axis=0)) - 1, np.ceil(uv.max(axis=0)) + 1
+            i_range = i_range[(u_min <= i_range) & (i_range <= u_max)]
+            j_range = j_range[(v_min <= j_range) & (j_range <= v_max)]
+        return np.array(np.meshgrid(i_range, j_range)).T.reshape((-1, 2)).astype(float)
+
     def open_gripper(self, lr, target_val=None, step_viewer=1, max_vel=.02):
         self._remove_constraints(lr)
          
@@ -357,29 +570,9 @@ class DynamicSimulationRobotWorld(DynamicSimulation, RobotWorld):
             flr2finger_pts_grid = self._get_finger_pts_grid(lr)
             ray_froms, ray_tos = flr2finger_pts_grid['l'], flr2finger_pts_grid['r']
 
-            # stop closing if any ray hits a dynamic object within a distance of close_dist_thresh from both sides
-            next_vel = max_vel
-            for bt_obj in dyn_bt_objs:
-                from_to_ray_collisions = self.bt_env.RayTest(ray_froms, ray_tos, bt_obj)
-                to_from_ray_collisions = self.bt_env.RayTest(ray_tos, ray_froms, bt_obj)
-                rays_dists = np.inf * np.ones((len(ray_froms), 2))
-                for rc in from_to_ray_collisions:
-                    ray_id = np.argmin(np.apply_along_axis(np.linalg.norm, 1, ray_froms - rc.rayFrom))
-                    rays_dists[ray_id, 0] = np.linalg.norm(rc.pt - rc.rayFrom)
-                for rc in to_from_ray_collisions:
-                    ray_id = np.argmin(np.apply_along_axis(np.linalg.norm, 1, ray_tos - rc.rayFrom))
-                    rays_dists[ray_id, 1] = np.linalg.norm(rc.pt - rc.rayFrom)
-                colliding_rays_inds = np.logical_and(rays_dists[:, 0] != np.inf, rays_dists[:, 1] != np.inf)
-                if np.any(colliding_rays_inds):
-                    rays_dists = rays_dists[colliding_rays_inds, :]
-                    if np.any(np.logical_and(rays_dists[:, 0] < close_dist_thresh,
-                                             rays_dists[:, 1] < close_dist_thresh)):
-                        next_vel = 0
-                    else:
-                        next_vel = np.minimum(next_vel, np.min(rays_dists.sum(axis=1)))
-            if next_vel == 0:
+            next_val = self._get_next_closing_val(lr, next_val, ray_froms, ray_tos, dyn_bt_objs, max_vel, close_dist_thresh)
+            if next_val is None:
                 break
-            next_val = np.maximum(next_val - next_vel, 0)
 
             self.robot.SetDOFValues([next_val], [joint_ind])
             self.step()
@@ -402,10 +595,23 @@ class DynamicSimulationRobotWorld(DynamicSimulation, RobotWorld):
             self.viewer.Step()
     
     def execute_trajectory(self, full_traj, step_viewer=1, interactive=False,
-                           max_cart_vel_trans_traj=.05, sim_callback=None):
+                           max_cart_vel_trans_traj=.05, sim_callback=None, n_substeps=settings.EXECUTE_N_SUBSTEPS):
+        """
+        n_substeps is the number of simulation steps per waypoint. The trajectory is retimed with n_substeps 
+        times fewer waypoints (and proportionally fewer for a profile with a longer time step), so that the robot 
+        moves at the same speed in simulation time
+        """
         # TODO: incorporate other parts of sim_full_traj_maybesim
+        # without viewer nor interaction, the trajectory is executed here instead of through animate_traj, and the 
+        # openrave bodies are only updated at the end
+        render = bool(self.viewer) or interactive
         if sim_callback is None:
-            sim_callback = lambda i: self.step()
+            if render:
+                sim_callback = lambda i: self.step(n_substeps)
+            else:
+                sim_callback = lambda i: self.step(n_substeps, update_rave=False)
+        # the retiming time is 10 times the simulation time, i.e. a waypoint every .1 for steps of .01
+        upsample_time = 10 * settings.SIM_PROFILES[self.profile]['time_step'] * n_substeps
         
         traj, dof_inds = full_traj
         
@@ -423,16 +629,22 @@ class DynamicSimulationRobotWorld(DynamicSimulation, RobotWorld):
         transition_traj = np.r_[[curr_vals], [traj[0]]]
         sim_util.unwrap_in_place(transition_traj, dof_inds=dof_inds)
         transition_traj = ropesim.retime_traj(self.robot, dof_inds, transition_traj,
-                                              max_cart_vel=max_cart_vel_trans_traj)
-        animate_traj.animate_traj(transition_traj, self.robot, restore=False, pause=interactive,
-                                  callback=sim_callback, step_viewer=step_viewer if self.viewer else 0)
+                                              max_cart_vel=max_cart_vel_trans_traj, upsample_time=upsample_time)
         
         traj[0] = transition_traj[-1]
         sim_util.unwrap_in_place(traj, dof_inds=dof_inds)
-        traj = ropesim.retime_traj(self.robot, dof_inds, traj)  # make the trajectory slow enough for the simulation
-    
-        animate_traj.animate_traj(traj, self.robot, restore=False, pause=interactive,
-                                  callback=sim_callback, step_viewer=step_viewer if self.viewer else 0)
+        traj = ropesim.retime_traj(self.robot, dof_inds, traj, upsample_time=upsample_time)  # make the trajectory slow enough for the simulation
+        
+        for t in [transition_traj, traj]:
+            if render:
+                animate_traj.animate_traj(t, self.robot, restore=False, pause=interactive,
+                                          callback=sim_callback, step_viewer=step_viewer if self.viewer else 0)
+            else:
+                for (i, dofs) in enumerate(t):
+                    sim_callback(i)
+                    self.robot.SetActiveDOFValues(dofs)
+        if not render:
+            self._update_rave()
         if self.viewer and step_viewer:
             self.viewer.Step()
         return True
@@ -449,6 +661,58 @@ class DynamicSimulationRobotWorld(DynamicSimulation, RobotWorld):
                 raise RuntimeError("Bullet environment can't be removed while the robot is grasping an object")
         super(DynamicSimulationRobotWorld, self)._remove_bullet()
         
+    def _can_set_state_in_place(self):
+        if self.constraints['l'] or self.constraints['r']:
+            return False
+        return super(DynamicSimulationRobotWorld, self)._can_set_state_in_place()
+
+    def _get_rays_dists(self, ray_froms, ray_tos, bt_obj):
+        """
+        Casts the rays between the fingers in both directions onto bt_obj and returns the distances from the ray 
+        origins to the hits as an array of shape (len(ray_froms), 2), which is inf for the rays that don't hit
+        """
+        rays_dists = np.inf * np.ones((len(ray_froms), 2))
+        for i_dir, (froms, tos) in enumerate([(ray_froms, ray_tos), (ray_tos, ray_froms)]):
+            ray_collisions = self.bt_env.RayTest(froms, tos, bt_obj)
+            if not ray_collisions:
+                continue
+            hit_froms = np.array([rc.rayFrom for rc in ray_collisions])
+            hit_pts = np.array([rc.pt for rc in ray_collisions])
+            # the ray of each hit is the one with the nearest origin
+            ray_ids = ((hit_froms[:,None,:] - froms[None,:,:])**2).sum(axis=2).argmin(axis=1)
+            rays_dists[ray_ids, i_dir] = np.sqrt(((hit_pts - hit_froms)**2).sum(axis=1))
+        return rays_dists
+    
+    def _get_next_closing_val(self, lr, cur_val, ray_froms, ray_tos, dyn_bt_objs, max_vel, close_dist_thresh):
+        """
+        Returns the next value of the lr finger joint while closing the gripper, or None if the gripper should stop 
+        closing because a ray hits a dynamic object within a distance of close_dist_thresh from both sides
+        
+        The value decreases by at most max_vel and by at most the smallest sum of the distances to the hits of a ray. 
+        If settings.PREDICT_CLOSING_STEP is True, the fingers move at least until the nearest finger reaches the 
+        nearest object between them, or close completely if there is no object between them.
+        """
+        next_vel = max_vel
+        min_side_dist = np.inf
+        for bt_obj in dyn_bt_objs:
+            rays_dists = self._get_rays_dists(ray_froms, ray_tos, bt_obj)
+            rays_dists = rays_dists[np.all(rays_dists != np.inf, axis=1)]
+            if len(rays_dists):
+                if np.any(np.all(rays_dists < close_dist_thresh, axis=1)):
+                    return None
+                next_vel = np.minimum(next_vel, np.min(rays_dists.sum(axis=1)))
+                min_side_dist = min(min_side_dist, rays_dists.min())
+        next_val = np.maximum(cur_val - next_vel, 0)
+        if settings.PREDICT_CLOSING_STEP:
+            if min_side_dist == np.inf:
+                predicted_val = 0
+            else:
+                # both fingers move towards each other by the same amount
+                finger_pts_table = sim_util.get_finger_pts_table(self.robot, lr)
+                predicted_val = finger_pts_table.get_finger_vals(finger_pts_table.get_gaps(cur_val) - 2 * min_side_dist)
+            next_val = np.maximum(np.minimum(next_val, predicted_val), 0)
+        return next_val
+    
     def _get_finger_pts_grid(self, lr, min_sample_dist=0.005):
         sample_grid = None
         flr2finger_pts_grid = {}
@@ -576,28 +840,9 @@ class DynamicRopeSimulationRobotWorld(DynamicSimulationRobotWorld):
             flr2finger_pts_grid = self._get_finger_pts_grid(lr)
             ray_froms, ray_tos = flr2finger_pts_grid['l'], flr2finger_pts_grid['r']
 
-            # stop closing if any ray hits a dynamic object within a distance of close_dist_thresh from both sides
-            next_vel = max_vel
-            for bt_obj in dyn_bt_objs:
-                from_to_ray_collisions = self.bt_env.RayTest(ray_froms, ray_tos, bt_obj)
-                to_from_ray_collisions = self.bt_env.RayTest(ray_tos, ray_froms, bt_obj)
-                rays_dists = np.inf * np.ones((len(ray_froms), 2))
-                for rc in from_to_ray_collisions:
-                    ray_id = np.argmin(np.apply_along_axis(np.linalg.norm, 1, ray_froms - rc.rayFrom))
-                    rays_dists[ray_id,0] = np.linalg.norm(rc.pt - rc.rayFrom)
-                for rc in to_from_ray_collisions:
-                    ray_id = np.argmin(np.apply_along_axis(np.linalg.norm, 1, ray_tos - rc.rayFrom))
-                    rays_dists[ray_id,1] = np.linalg.norm(rc.pt - rc.rayFrom)
-                colliding_rays_inds = np.logical_and(rays_dists[:,0] != np.inf, rays_dists[:,1] != np.inf)
-                if np.any(colliding_rays_inds):
-                    rays_dists = rays_dists[colliding_rays_inds,:]
-                    if np.any(np.logical_and(rays_dists[:,0] < close_dist_thresh, rays_dists[:,1] < close_dist_thresh)):
-                        next_vel = 0
-                    else:
-                        next_vel = np.minimum(next_vel, np.min(rays_dists.sum(axis=1)))
-            if next_vel == 0:
+            next_val = self._get_next_closing_val(lr, next_val, ray_froms, ray_tos, dyn_bt_objs, max_vel, close_dist_thresh)
+            if next_val is None:
                 break
-            next_val = np.maximum(next_val - next_vel, 0)
 
             self.robot.SetDOFValues([next_val], [joint_ind])
             self.step()
@@ -3,6 +3,7 @@ from __future__ import division
 import trajoptpy, bulletsimpy
 import sim_util
 import numpy as np
+from lfd.rapprentice import math_utils
 
 class SimulationObject(object):
     add_after = False # if True, this object needs to be added after the BulletEnvironment has been created
@@ -34,6 +35,15 @@ class SimulationObject(object):
         for (bt_obj, tf) in zip(self.get_bullet_objects(), tfs):
             bt_obj.SetTransform(tf)
     
+    def get_translations(self):
+        return np.asarray([bt_obj.GetTransform()[:3,3] for bt_obj in self.get_bullet_objects()]).reshape((-1,3))
+    
+    def zero_velocities(self):
+        for bt_obj in self.get_bullet_objects():
+            if not bt_obj.IsKinematic():
+                bt_obj.SetLinearVelocity(np.zeros(3))
+                bt_obj.SetAngularVelocity(np.zeros(3))
+    
     def _get_constructor_info(self):
         args = [self.names]
         kwargs = {"dynamic":self.dynamic}
@@ -179,6 +189,25 @@ class RopeSimulationObject(SimulationObject):
         self.rope.SetTranslations(tfs[:,:3,3])
         self.rope.SetRotations(tfs[:,:3,:3])
     
+    def get_translations(self):
+        return np.asarray(self.rope.GetTranslations())
+    
+    def resampled(self, n_ctrl_points):
+        """
+        returns a rope with the same name and parameters, and with n_ctrl_points control points uniformly spaced 
+        along the current control points of this rope
+        """
+        ctrl_points = self.init_ctrl_points if self.rope is None else np.asarray(self.rope.GetControlPoints())
+        lengths = np.r_[0, np.cumsum(np.sqrt((np.diff(ctrl_points, axis=0)**2).sum(axis=1)))]
+        ctrl_points = math_utils.interp2d(np.linspace(0, lengths[-1], n_ctrl_points), lengths, ctrl_points)
+        return RopeSimulationObject(self.name, ctrl_points, self.rope_params, dynamic=self.dynamic, 
+                                    upsample=self.upsample, upsample_rad=self.upsample_rad)
+    
+    def zero_velocities(self):
+        n_links = len(self.rope.GetTranslations())
+        self.rope.SetLinearVelocities(np.zeros((n_links, 3)))
+        self.rope.SetAngularVelocities(np.zeros((n_links, 3)))
+    
     def _get_constructor_info(self):
         args = [self.name, self.init_ctrl_points.tolist(), self.rope_params]
         kwargs = {"dynamic":self.dynamic, "upsample":0, "upsample_rad":1}
@@ -2,12 +2,22 @@
 Functions and classes for computing features
 """
 import h5py
+import hashlib
+from collections import OrderedDict
 
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.spatial.distance import cdist, pdist
 import re
 
-from lfd.tpsopt.batchtps import SrcContext, TgtContext, batch_tps_rpm_bij, GPUContext
+from lfd.tpsopt.registration import unit_boxify
+from lfd.tpsopt.settings import DS_SIZE
+
+try:
+    from lfd.tpsopt.batchtps import SrcContext, TgtContext, batch_tps_rpm_bij, GPUContext as BatchContext
+except (ImportError, OSError):
+    # no CUDA, fall back to the vectorized CPU contexts
+    from lfd.tpsopt.batchtps_cpu import CPUSrcContext as SrcContext, CPUTgtContext as TgtContext, \
+        batch_tps_rpm_bij, CPUContext as BatchContext
 
 
 class Feature(object):
@@ -138,10 +148,12 @@ class SimpleMulGripperFeats(MulFeats):
         self.costs = batch_tps_rpm_bij(self.src_ctx, self.tgt_ctx, component_cost=True)[:, :SimpleMulFeats.N_costs]
         #ipdb.set_trace()
         self.src_ctx.get_unscaled_trajs(self.tgt_ctx)
-        l_gripper_locs = [self.src_ctx.l_traj_w[i].get()[self.l_ind[i]] if self.l_ind[i]>=0 else rloc for i in range(self.src_ctx.N)]
-        l_gripper_dists = np.min(cdist(np.asarray(l_gripper_locs), np.asarray(state.cloud)), axis=1)
-        r_gripper_locs = [self.src_ctx.r_traj_w[i].get()[self.r_ind[i]] if self.r_ind[i]>=0 else rloc for i in range(self.src_ctx.N)]
-        r_gripper_dists = np.min(cdist(np.asarray(r_gripper_locs), np.asarray(state.cloud)), axis=1)
+        l_ind = np.asarray(self.l_ind)
+        l_gripper_locs = np.where((l_ind >= 0)[:,None], self.src_ctx.get_traj_pts('l', np.maximum(l_ind, 0)), rloc)
+        l_gripper_dists = np.min(cdist(l_gripper_locs, np.asarray(state.cloud)), axis=1)
+        r_ind = np.asarray(self.r_ind)
+        r_gripper_locs = np.where((r_ind >= 0)[:,None], self.src_ctx.get_traj_pts('r', np.maximum(r_ind, 0)), rloc)
+        r_gripper_dists = np.min(cdist(r_gripper_locs, np.asarray(state.cloud)), axis=1)
         dist_to_rope = np.max(np.array([r_gripper_dists,l_gripper_dists]), axis=0)[:,None]
         return np.c_[self.costs, self.indicators, dist_to_rope]
 
@@ -160,29 +172,127 @@ class SimpleMulGripperFeats(MulFeats):
         actions.close()
 
 def get_quad_terms(vec):
-    N = vec.shape[0]
-    v_t_v = np.dot(vec[:, None], vec[None, :])
+    """
+    linear and quadratic terms of vec, or of each row of vec if it is 2d
+    """
+    N = vec.shape[-1]
+    v_t_v = vec[..., :, None] * vec[..., None, :]
     inds = np.triu_indices(N)
-    return np.r_[vec, v_t_v[inds]]
+    return np.concatenate([vec, v_t_v[..., inds[0], inds[1]]], axis=-1)
+
+def get_shape_descriptor(cloud_xyz, n_bins=16):
+    """
+    cheap rigid-invariant descriptor of a cloud: normalized histogram of
+    the pairwise distances of the unit-boxified cloud
+    """
+    scaled_cld, _ = unit_boxify(np.asarray(cloud_xyz))
+    hist, _ = np.histogram(pdist(scaled_cld), bins=n_bins, range=(0, np.sqrt(3)))
+    return hist / float(max(hist.sum(), 1))
+
+class LandmarkFeatEngine(object):
+    """
+    computes the landmark features of a test cloud, i.e. the softmax of
+    the registration costs from each landmark to the cloud
+
+    the landmark-side matrices are read once, and the results are cached
+    by the hash of the test cloud. if n_nearest is set, only the n_nearest
+    landmarks closest to the cloud under get_shape_descriptor are registered,
+    and the others get the largest cost among the registered ones, so their
+    features are equal to the smallest feature of the registered landmarks
+    """
+    def __init__(self, landmarkf, n_nearest=None, cache_size=1000):
+        self.ctx = BatchContext()
+        self.landmarks = []
+        f = h5py.File(landmarkf, 'r')
+        for seg_name, seg_info in f.iteritems():
+            if 'inv' not in seg_info:
+                raise KeyError("Batch Mode only works with precomputed solvers")
+            seg_info = seg_info['inv']
+            proj_mats   = {}
+            offset_mats = {}
+            for b in self.ctx.bend_coefs:
+                k = str(b)
+                if k not in seg_info:
+                    raise KeyError("H5 File {} bend coefficient {}".format(seg_name, k))
+                proj_mats[b] = seg_info[k]['proj_mat'][:]
+                offset_mats[b] = seg_info[k]['offset_mat'][:]
+            ds_g = seg_info['DS_SIZE_{}'.format(DS_SIZE)]
+            self.landmarks.append((seg_name, proj_mats, offset_mats, ds_g['scaled_cloud_xyz'][:],
+                                   ds_g['scaled_K_nn'][:],
+                                   (ds_g['scaling'][()], ds_g['scaled_translation'][:])))
+        f.close()
+        self.N = len(self.landmarks)
+        self.descriptors = np.array([get_shape_descriptor(l[3]) for l in self.landmarks])
+
+        if n_nearest is None or n_nearest >= self.N:
+            self.n_nearest = None
+            landmarks = self.landmarks
+        else:
+            # registration slots, refilled with whichever landmarks are nearest
+            self.n_nearest = n_nearest
+            landmarks = self.landmarks[:n_nearest]
+        for i, l in enumerate(landmarks):
+            self.ctx.add_cld(*(l + (i == len(landmarks) - 1,)))
+        self.slot2landmark = range(len(landmarks))
+        self.tgt_ctx = TgtContext(self.ctx)
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def get_nearest(self, cloud_xyz):
+        d = get_shape_descriptor(cloud_xyz)
+        dists = np.abs(self.descriptors - d).sum(axis=1)
+        return np.argsort(dists)[:self.n_nearest]
+
+    def load_landmarks(self, inds):
+        """
+        puts landmarks inds in the registration slots, only copying
+        the ones that are not already there
+        """
+        inds = set(inds)
+        free_slots = [s for s, i in enumerate(self.slot2landmark) if i not in inds]
+        new_inds = sorted(inds - set(self.slot2landmark))
+        for s, i in zip(free_slots, new_inds):
+            self.ctx.replace_cld(s, *self.landmarks[i])
+            self.slot2landmark[s] = i
+
+    def registration_costs(self, cloud_xyz):
+        self.tgt_ctx.set_cld(cloud_xyz)
+        if self.n_nearest is None:
+            return batch_tps_rpm_bij(self.ctx, self.tgt_ctx)
+        self.load_landmarks(self.get_nearest(cloud_xyz))
+        slot_costs = batch_tps_rpm_bij(self.ctx, self.tgt_ctx)
+        costs = np.empty(self.N)
+        costs.fill(np.max(slot_costs))
+        costs[self.slot2landmark] = slot_costs
+        return costs
+
+    def features(self, cloud_xyz):
+        key = hashlib.sha1(np.ascontiguousarray(cloud_xyz, dtype=np.float64).tostring()).hexdigest()
+        if key in self.cache:
+            feats = self.cache.pop(key)
+        else:
+            costs = self.registration_costs(cloud_xyz)
+            feats = np.exp(-(costs - np.min(costs)))
+            feats /= np.sum(feats)
+        self.cache[key] = feats
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return feats
 
 class LandmarkFeats(MulFeats):
     
     def __init__(self, actionfile):
         MulFeats.__init__(self, actionfile)
-        self.landmark_ctx = None
+        self.landmark_engine = None
 
-    def set_landmark_file(self, landmarkf):
-        self.landmark_ctx = GPUContext()
-        self.landmark_ctx.read_h5(landmarkf)
-        self.landmark_targ_ctx = TgtContext(self.landmark_ctx)
-        self.weights = np.zeros(self.src_ctx.N + self.landmark_ctx.N + MulFeats.N_costs)
+    def set_landmark_file(self, landmarkf, n_nearest=None):
+        self.landmark_engine = LandmarkFeatEngine(landmarkf, n_nearest)
+        self.weights = np.zeros(self.src_ctx.N + self.landmark_engine.N + MulFeats.N_costs)
 
     def features(self, state, **kwargs):
         mul_feats = MulFeats.features(self, state)
-        self.landmark_targ_ctx.set_cld(state.cloud)
-        landmark_feats = batch_tps_rpm_bij(self.landmark_ctx, self.landmark_targ_ctx)
-        landmark_feats = np.exp(-landmark_feats)
-        landmark_feats /= np.sum(landmark_feats)
+        landmark_feats = self.landmark_engine.features(state.cloud)
         self.costs = np.c_[mul_feats, np.tile(landmark_feats, (self.src_ctx.N, 1))]
         return self.costs
 
@@ -204,9 +314,7 @@ class QuadMulFeats(BatchRCFeats):
         self.tgt_cld = state.cloud
         self.tgt_ctx.set_cld(self.tgt_cld)
         costs = batch_tps_rpm_bij(self.src_ctx, self.tgt_ctx, component_cost=True)
-        self.costs = np.zeros((self.N, QuadMulFeats.N_feats))
-        for i in range(self.N):
-            self.costs[i, :] = get_quad_terms(costs[i])
+        self.costs = get_quad_terms(costs)
         return np.c_[self.costs, self.indicators]
 
     def get_ind(self, a):
@@ -252,9 +360,7 @@ class QuadSimpleMulFeats(BatchRCFeats):
         self.tgt_cld = state.cloud
         self.tgt_ctx.set_cld(self.tgt_cld)
         costs = batch_tps_rpm_bij(self.src_ctx, self.tgt_ctx, component_cost=True)[:, :SimpleMulFeats.N_costs]
-        self.costs = np.zeros((self.N, QuadSimpleMulFeats.N_feats))
-        for i in range(self.N):
-            self.costs[i, :] = get_quad_terms(costs[i])
+        self.costs = get_quad_terms(costs)
         return np.c_[self.costs, self.indicators]
 
     def get_ind(self, a):
@@ -279,9 +385,7 @@ class QuadSimpleMulIndFeats(BatchRCFeats):
         costs = batch_tps_rpm_bij(self.src_ctx, self.tgt_ctx, component_cost=True)[:, :SimpleMulFeats.N_costs]
         for i in range(self.N):
             self.regind_feats[i,:] = np.reshape(np.dot(self.indicators[i][:,None], costs[i][None,:]), self.n_regindicators)
-        self.costs = np.zeros((self.N, QuadSimpleMulFeats.N_feats))
-        for i in range(self.N):
-            self.costs[i, :] = get_quad_terms(costs[i])
+        self.costs = get_quad_terms(costs)
 
         return np.c_[self.costs, self.indicators, self.regind_feats]
 
@@ -305,9 +409,7 @@ class QuadSimpleMulMapIndFeats(BatchRCFeats):
         costs = batch_tps_rpm_bij(self.src_ctx, self.tgt_ctx, component_cost=True)[:, :SimpleMulFeats.N_costs]
         for i in range(self.N):
             self.regind_feats[i,:] = self.indicators[i]*costs[i,0]
-        self.costs = np.zeros((self.N, QuadSimpleMulFeats.N_feats))
-        for i in range(self.N):
-            self.costs[i, :] = get_quad_terms(costs[i])
+        self.costs = get_quad_terms(costs)
 
         return np.c_[self.costs, self.indicators, self.regind_feats]
 
@@ -331,9 +433,7 @@ class QuadSimpleMulBendIndFeats(BatchRCFeats):
         costs = batch_tps_rpm_bij(self.src_ctx, self.tgt_ctx, component_cost=True)[:, :SimpleMulFeats.N_costs]
         for i in range(self.N):
             self.regind_feats[i,:] = self.indicators[i]*np.sum(costs[i,1:2])
-        self.costs = np.zeros((self.N, QuadSimpleMulFeats.N_feats))
-        for i in range(self.N):
-            self.costs[i, :] = get_quad_terms(costs[i])
+        self.costs = get_quad_terms(costs)
 
         return np.c_[self.costs, self.indicators, self.regind_feats]
 
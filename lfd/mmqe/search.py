@@ -3,6 +3,7 @@ classes and methods to do a tree search to find the best option
 """
 
 import numpy as np
+from lfd.environment.simulation import SimulationSnapshotStore
 
 class SearchNode(object):
 
@@ -91,9 +92,10 @@ class MaxNode(SearchNode):
 # env is for resetting the state at each step
 def beam_search(start_state, timestep, actions, expander, evaluator, sim, width=1, depth=1):
     id2simstate = {}
+    snapshot_store = SimulationSnapshotStore()
     SearchNode.set_actions(actions)
     root_id = SearchNode.get_UID()
-    id2simstate[root_id] = sim.get_state()
+    id2simstate[root_id] = snapshot_store.capture(sim)
     root_vals = evaluator(start_state, timestep)
     root = MaxNode(root_id, start_state, root_vals)
     agenda = [root]
@@ -112,9 +114,9 @@ def beam_search(start_state, timestep, actions, expander, evaluator, sim, width=
             parent_node = SearchNode.id_map[P_ID]
             parent_state = parent_node.state
             child_id = parent_node.child_ids[SearchNode.action2ind[a]]
-            sim.set_state(id2simstate[P_ID])
+            snapshot_store.restore(sim, id2simstate[P_ID])
             expand_res.append(expander(parent_state, a, child_id))
-            id2simstate[child_id] = sim.get_state()
+            id2simstate[child_id] = snapshot_store.capture(sim)
             child_node = ExpandingNode(child_id, parent_node)
         agenda = []
         for res in expand_res:
@@ -136,5 +138,5 @@ def beam_search(start_state, timestep, actions, expander, evaluator, sim, width=
         if goal_found:
             break
     # Reset back to the original state before returning
-    sim.set_state(id2simstate[root_id])
+    snapshot_store.restore(sim, id2simstate[root_id])
     return root.select_best(), goal_found
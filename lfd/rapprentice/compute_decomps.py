@@ -2,8 +2,14 @@ import h5py
 import numpy as np
 import scipy.linalg
 import argparse
+import hashlib
+import multiprocessing
 
-from lfd.rapprentice.tps import tps_kernel_matrix 
+from lfd.rapprentice import clouds
+from lfd.rapprentice.tps import tps_kernel_matrix
+from lfd.tpsopt.registration import loglinspace
+from lfd.tpsopt.transformations import get_exact_solver_mats
+from lfd.tpsopt.settings import BEND_COEF_DIGITS, DS_SIZE
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -11,70 +17,148 @@ def parse_arguments():
     parser.add_argument('--bend_coeff_init', type=float, default=10)
     parser.add_argument('--bend_coeff_final', type=float, default=.1)
     parser.add_argument('--n_iter', type=int, default=20)
+    parser.add_argument('--rot_coeff', type=float, default=1e-3)
+    parser.add_argument('--cloud_name', type=str, default='cloud_xyz')
+    parser.add_argument('--downsample_size', type=float, default=DS_SIZE)
+    parser.add_argument('--n_procs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--replace', action='store_true')
     parser.add_argument('--verbose', action='store_true')
     return parser.parse_args()
 
-def get_lu_decomp(x_na, bend_coef, rot_coef):
+def get_lu_decomp(x_na, bend_coef, rot_coef, K_nn=None):
     """
     precomputes the LU decomposition and other intermediate results needed
     to fit a TPS to x_na with bend_coeff
 
     all thats needed is to compute the righthand side and do a forward solve
     """
-    
-    n,d = x_na.shape
-    Q = np.c_[np.ones((n,1)), x_na, K_nn]
-    QWQ = Q.T.dot(WQ)
-    H = Q.T.dot(Q)
-    H[d+1:,d+1:] += bend_coef * K_nn
-    rot_coefs = np.ones(d) * rot_coef if np.isscalar(rot_coef) else rot_coef
-    H[1:d+1, 1:d+1] += np.diag(rot_coefs)
+    res = get_lu_decomps(x_na, [bend_coef], rot_coef, K_nn=K_nn)
+    res_dict = dict(res['bend_coefs'][bend_coef])
+    for k in ['N', 'QN', 'NR', 'rot_coefs']:
+        res_dict[k] = res[k]
+    return bend_coef, res_dict
+
+def get_lu_decomps(x_na, bend_coefs, rot_coef, K_nn=None):
+    """
+    batch version of get_lu_decomp
 
-    A = np.r_[np.zeros((d+1,d+1)), np.c_[np.ones((n,1)), x_na]].T
+    the null space N and the products that don't depend on the bending
+    coefficient are computed once, then N'HN is factored for every
+    coefficient in bend_coefs
 
-    # f = -WQ.T.dot(y_ng)
-    # f[1:d+1,0:d] -= np.diag(rot_coefs)
+    returns a dict with N, QN, NR, rot_coefs and bend_coefs, which maps
+    each bending coefficient to a dict with lu, piv and NON
+    """
+    n,d = x_na.shape
+    if K_nn is None:
+        K_nn = tps_kernel_matrix(x_na)
+    rot_coefs = np.ones(d) * rot_coef if np.isscalar(rot_coef) else np.asarray(rot_coef)
 
-    _u,_s,_vh = np.linalg.svd(A.T)
-    N = _u[:,n_cnts:]
+    N, QN, NON, NR = get_exact_solver_mats(x_na, K_nn, bend_coefs, rot_coefs)
+    QNQN = QN.T.dot(QN)
 
-    p, l, u, = scipy.linalg.lu(N.T.dot(H.dot(N)))
+    bend_coef_res = {}
+    for b in bend_coefs:
+        # N'HN with H = Q'Q + O_b
+        lu, piv = scipy.linalg.lu_factor(NON[b] + QNQN)
+        bend_coef_res[b] = {'lu' : lu, 'piv' : piv, 'NON' : NON[b]}
 
-    # z = np.linalg.solve(N.T.dot(H.dot(N)), -N.T.dot(f))
+    # z = scipy.linalg.lu_solve((lu, piv), NR + QN.T.dot(y_ng))
     # x = N.dot(z)
 
-    res_dict = {'p' : p, 'l' : l, 'u' : u, 'N' : N, 'rot_coeffs' : rot_coeffs}
+    return {'N' : N, 'QN' : QN, 'NR' : NR, 'rot_coefs' : rot_coefs, 'bend_coefs' : bend_coef_res}
 
-    return bend_coeff, res_dict
+def get_seg_hash(x_na, rot_coef, downsample_size):
+    """
+    content hash of the inputs that the decompositions of a segment depend on
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(x_na, dtype=np.float64).tostring())
+    sha.update(np.asarray(rot_coef, dtype=np.float64).tostring())
+    sha.update(repr(downsample_size))
+    return sha.hexdigest()
 
+def _compute_seg_decomps(job):
+    """
+    worker for the process pool. job is (seg_name, x_na, bend_coefs, rot_coef, downsample_size), 
+    where x_na is the raw segment cloud
+    """
+    seg_name, x_na, bend_coefs, rot_coef, downsample_size = job
+    if downsample_size > 0:
+        x_na = clouds.downsample(x_na, downsample_size)
+    K_nn = tps_kernel_matrix(x_na)
+    res = get_lu_decomps(x_na, bend_coefs, rot_coef, K_nn=K_nn)
+    res['x_nd'] = x_na
+    res['K_nn'] = K_nn
+    return seg_name, res
+
+def write_seg_decomps(lu_group, res):
+    for k in ['N', 'QN', 'NR', 'x_nd', 'K_nn']:
+        if k in lu_group:
+            del lu_group[k]
+        lu_group[k] = res[k]
+    if 'rot_coef' in lu_group:
+        del lu_group['rot_coef']
+    lu_group['rot_coef'] = res['rot_coefs']
+    if 'bend_coefs' not in lu_group:
+        lu_group.create_group('bend_coefs')
+    for bend_coeff, bend_coeff_res in res['bend_coefs'].iteritems():
+        if str(bend_coeff) in lu_group['bend_coefs']:
+            del lu_group['bend_coefs'][str(bend_coeff)]
+        bend_coeff_g = lu_group['bend_coefs'].create_group(str(bend_coeff))
+        for k, v in bend_coeff_res.iteritems():
+            bend_coeff_g[k] = v
 
 def main():
     args = parse_arguments()
 
-    f = h5py.File(args.datafile, 'r')
-    
-    bend_coefs = np.loglinspace(args.bend_coef_init, args.bend_coeff_final, args.n_iter)
+    f = h5py.File(args.datafile, 'r+')
+
+    bend_coeffs = np.around(loglinspace(args.bend_coeff_init, args.bend_coeff_final, args.n_iter),
+                            BEND_COEF_DIGITS)
 
+    # only segments that are new, whose cloud or parameters changed, or that
+    # are missing some bending coefficients are recomputed
+    jobs = []
+    seg_hashes = {}
     for seg_name, seg_info in f.iteritems():
-        if 'LU' not in seg_info:
-            lu_group = seg_info.create_group('LU')
-        else:
+        x_na = seg_info[args.cloud_name][:, :3]
+        seg_hash = seg_hashes[seg_name] = get_seg_hash(x_na, args.rot_coeff, args.downsample_size)
+        if 'LU' in seg_info and (args.replace or seg_info['LU'].attrs.get('hash') != seg_hash):
+            del seg_info['LU']
+        if 'LU' in seg_info:
             lu_group = seg_info['LU']
-        x_na = seg_info['cloud_xyz'][:]
-        for bend_coeff in bend_coeffs:
-            if str(bend_coeff) in lu_group:
-                continue
-            
-            bend_coeff_g = lu_group.create_group(str(bend_coeff))
-            _, res = get_lu_decomp(x_na, bend_coeff)
-            for k, v in res.iteritems():
-                bend_coeff_g[k] = v
-
-            if args.verbose:
-                print 'segment {}  bend_coeff {}'.format(seg_name, bend_coeff)
-
+            missing_bend_coeffs = [b for b in bend_coeffs if str(b) not in lu_group['bend_coefs']]
+        else:
+            missing_bend_coeffs = list(bend_coeffs)
+        if missing_bend_coeffs:
+            jobs.append((seg_name, x_na, missing_bend_coeffs, args.rot_coeff, args.downsample_size))
+        elif args.verbose:
+            print 'segment {} up to date'.format(seg_name)
+
+    if args.n_procs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.n_procs, len(jobs)))
+        results = pool.imap_unordered(_compute_seg_decomps, jobs)
+    else:
+        pool = None
+        results = (_compute_seg_decomps(job) for job in jobs)
+
+    for seg_name, res in results:
+        seg_info = f[seg_name]
+        if 'LU' not in seg_info:
+            seg_info.create_group('LU')
+        lu_group = seg_info['LU']
+        write_seg_decomps(lu_group, res)
+        lu_group.attrs['hash'] = seg_hashes[seg_name]
+        f.flush()
+        if args.verbose:
+            print 'segment {}  bend_coeffs {}'.format(seg_name, sorted(res['bend_coefs'].keys()))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
     f.close()
 
 if __name__=='__main__':
     main()
-            
+
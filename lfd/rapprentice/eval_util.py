@@ -7,6 +7,9 @@ import importlib, __builtin__
 import util
 import openravepy, trajoptpy
 import h5py, numpy as np
+import hashlib
+import weakref
+from collections import OrderedDict
 from lfd.rapprentice import math_utils as mu
 from string import lower
 
@@ -204,5 +207,152 @@ def traj_collisions(sim_env, full_traj, collision_dist_threshold, upsample=0):
         
     return col_times
 
+#: maximum number of results kept by traj_is_safe for each simulation
+TRAJ_SAFETY_CACHE_SIZE = 1000
+# maps each simulation to its cache of traj_is_safe results, so that the collision pairs excluded in the 
+# collision checker of another simulation don't affect them
+_traj_safety_caches = weakref.WeakKeyDictionary()
+
+def get_bisection_order(n):
+    """
+    Returns range(n) ordered by bisection: the endpoints, the middle, then the 
+    middles of the halves, and so on
+    """
+    if n <= 2:
+        return range(n)
+    order = [0, n-1]
+    intervals = [(0, n-1)]
+    while intervals:
+        next_intervals = []
+        for (lo, hi) in intervals:
+            if hi - lo < 2:
+                continue
+            mid = (lo + hi) // 2
+            order.append(mid)
+            next_intervals.extend([(lo, mid), (mid, hi)])
+        intervals = next_intervals
+    return order
+
+def _get_links_aabbs(links):
+    """Returns the min and max corners of the axis-aligned bounding boxes of the links"""
+    aabbs = [link.ComputeAABB() for link in links]
+    pos = np.array([aabb.pos() for aabb in aabbs]).reshape((-1,3))
+    extents = np.array([aabb.extents() for aabb in aabbs]).reshape((-1,3))
+    return pos - extents, pos + extents
+
+def _get_links_local_aabbs(links):
+    """Returns the centers and extents of the bounding boxes of the links in the frames of the links"""
+    aabbs = [link.ComputeLocalAABB() for link in links]
+    pos = np.array([aabb.pos() for aabb in aabbs]).reshape((-1,3))
+    extents = np.array([aabb.extents() for aabb in aabbs]).reshape((-1,3))
+    return pos, extents
+
+def _get_boxes_aabbs(tfs, pos, extents):
+    """
+    Returns the min and max corners of the axis-aligned bounding boxes of the boxes with centers pos and 
+    extents in the frames tfs. tfs has shape (n_waypoints, n_boxes, 4, 4)
+    """
+    world_pos = np.einsum('tkij,kj->tki', tfs[:,:,:3,:3], pos) + tfs[:,:,:3,3]
+    world_extents = np.einsum('tkij,kj->tki', np.abs(tfs[:,:,:3,:3]), extents)
+    return world_pos - world_extents, world_pos + world_extents
+
+def _aabb_pairs_overlap(mins, maxs, inds0, inds1):
+    """Returns whether any of the boxes inds0 overlaps the corresponding box inds1"""
+    if len(inds0) == 0:
+        return False
+    return np.any(np.all((mins[inds0] <= maxs[inds1]) & (mins[inds1] <= maxs[inds0]), axis=1))
+
+def _aabbs_overlap(mins0, maxs0, mins1, maxs1):
+    """Returns whether any of the first boxes overlaps any of the second boxes"""
+    if len(mins0) == 0 or len(mins1) == 0:
+        return False
+    return np.any(np.all((mins0[:,None,:] <= maxs1[None,:,:]) & (mins1[None,:,:] <= maxs0[:,None,:]), axis=2))
+
 def traj_is_safe(sim_env, full_traj, collision_dist_threshold, upsample=0):
-    return traj_collisions(sim_env, full_traj, collision_dist_threshold, upsample) == []
+    """
+    Same as traj_collisions(sim_env, full_traj, collision_dist_threshold, upsample) == [], but only the waypoints 
+    that may be in collision are checked, in bisection order so that it returns as soon as a collision is found. 
+    A waypoint may be in collision if the bounding box of a link moved by the trajectory overlaps the bounding box 
+    of a link of another body or of a non-adjacent link of the robot. The first waypoint is also checked if the 
+    bounding boxes of the links that aren't moved overlap, since their collisions are the same at every waypoint.
+    
+    The results are cached per simulation for identical trajectories, robot configurations, poses of the other 
+    bodies and sim_env.structure_version (the excluded collision pairs only change with the objects).
+    """
+    traj, dof_inds = full_traj
+    sim_util.unwrap_in_place(traj, dof_inds=dof_inds)
+
+    if upsample > 0:
+        traj_up = mu.interp2d(np.linspace(0,1,upsample), np.linspace(0,1,len(traj)), traj)
+    else:
+        traj_up = traj
+    robot = sim_env.robot
+    obstacles = [body for body in sim_env.env.GetBodies() if body != robot]
+    
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(traj_up, dtype=np.float64).tostring())
+    sha.update(repr((list(dof_inds), collision_dist_threshold, getattr(sim_env, 'structure_version', None))))
+    sha.update(np.asarray(robot.GetDOFValues(), dtype=np.float64).tostring())
+    for body in obstacles:
+        sha.update(body.GetName())
+        sha.update(np.asarray(body.GetLinkTransformations(), dtype=np.float64).tostring())
+    key = sha.hexdigest()
+    traj_safety_cache = _traj_safety_caches.setdefault(sim_env, OrderedDict())
+    if key in traj_safety_cache:
+        traj_safety_cache[key] = traj_safety_cache.pop(key) # most recently used
+        return traj_safety_cache[key]
+    
+    margin = max(collision_dist_threshold, 0)
+    obstacle_links = [link for body in obstacles for link in body.GetLinks() if link.GetGeometries()]
+    obstacle_mins, obstacle_maxs = _get_links_aabbs(obstacle_links)
+    obstacle_mins -= margin
+    obstacle_maxs += margin
+    
+    joint_inds = [robot.GetJointFromDOFIndex(dof_ind).GetJointIndex() for dof_ind in dof_inds]
+    links = [link for link in robot.GetLinks() if link.GetGeometries()]
+    link_inds = [link.GetIndex() for link in links]
+    moving = np.array([any(robot.DoesAffect(joint_ind, link_ind) for joint_ind in joint_inds) for link_ind in link_inds], 
+                      dtype=bool).reshape(-1)
+    # pairs of links of the robot that may collide with each other, as indices into links
+    link_ind2ind = dict((link_ind, i) for (i, link_ind) in enumerate(link_inds))
+    self_pairs = [(link_ind2ind[pair & 0xffff], link_ind2ind[pair >> 16]) for pair in robot.GetNonAdjacentLinks(0) 
+                  if (pair & 0xffff) in link_ind2ind and (pair >> 16) in link_ind2ind]
+    self_pairs = np.array(self_pairs, dtype=int).reshape((-1,2))
+    moving_self_pairs = self_pairs[moving[self_pairs[:,0]] | moving[self_pairs[:,1]]]
+    static_self_pairs = self_pairs[~(moving[self_pairs[:,0]] | moving[self_pairs[:,1]])]
+    local_pos, local_extents = _get_links_local_aabbs(links)
+    local_extents += margin/2. # the margin is split between the two links of the self-collision pairs
+    
+    cc = trajoptpy.GetCollisionChecker(sim_env.env)
+    safe = True
+    with openravepy.RobotStateSaver(robot):
+        robot.SetActiveDOFs(dof_inds)
+        # forward kinematics of every waypoint
+        link_tfs = []
+        for row in traj_up:
+            robot.SetActiveDOFValues(row)
+            link_tfs.append(robot.GetLinkTransformations())
+        link_tfs = np.asarray(link_tfs).reshape((len(traj_up), -1, 4, 4))[:,link_inds]
+        mins, maxs = _get_boxes_aabbs(link_tfs, local_pos, local_extents)
+        
+        flagged = []
+        if len(traj_up) > 0:
+            static_overlap = _aabbs_overlap(mins[0][~moving], maxs[0][~moving], obstacle_mins, obstacle_maxs) or \
+                _aabb_pairs_overlap(mins[0], maxs[0], static_self_pairs[:,0], static_self_pairs[:,1])
+        for i in range(len(traj_up)):
+            if (i == 0 and static_overlap) or \
+                    _aabbs_overlap(mins[i][moving], maxs[i][moving], obstacle_mins, obstacle_maxs) or \
+                    _aabb_pairs_overlap(mins[i], maxs[i], moving_self_pairs[:,0], moving_self_pairs[:,1]):
+                flagged.append(i)
+        
+        for i in [flagged[j] for j in get_bisection_order(len(flagged))]:
+            robot.SetActiveDOFValues(traj_up[i])
+            col_now = cc.BodyVsAll(robot)
+            if any(cn.GetDistance() < collision_dist_threshold for cn in col_now):
+                safe = False
+                break
+    
+    traj_safety_cache[key] = safe
+    while len(traj_safety_cache) > TRAJ_SAFETY_CACHE_SIZE:
+        traj_safety_cache.popitem(last=False)
+    return safe
@@ -7,7 +7,6 @@ from lfd.rapprentice import LOG
 import lfd.rapprentice.math_utils as mu
 #import fastrapp
 import scipy.interpolate as si
-import openravepy
 
 def lerp(a, b, fracs):
     "linearly interpolate between a and b"
@@ -128,23 +127,117 @@ def test_resample_big():
     
     assert np.allclose(inds0, inds1)
 
+def get_interp_inds(newtimes, oldtimes):
+    """
+    returns the indices i and fractions u such that each of the newtimes is 
+    (1-u)*oldtimes[i] + u*oldtimes[i+1], clipped to the range of oldtimes
+    """
+    newtimes = np.asarray(newtimes, dtype=float)
+    oldtimes = np.asarray(oldtimes, dtype=float)
+    if len(oldtimes) == 1:
+        return np.zeros(len(newtimes), dtype=int), np.zeros(len(newtimes))
+    inds = np.clip(np.searchsorted(oldtimes, newtimes, side='right') - 1, 0, len(oldtimes)-2)
+    fracs = np.clip((newtimes - oldtimes[inds]) / (oldtimes[inds+1] - oldtimes[inds]), 0., 1.)
+    return inds, fracs
+
+def get_nearest_inds(times, querytimes):
+    """
+    returns the index of the nearest of the sorted times for each of the 
+    querytimes (the lower one for ties)
+    """
+    times = np.asarray(times)
+    querytimes = np.asarray(querytimes)
+    if len(times) == 1:
+        return np.zeros(len(querytimes), dtype=int)
+    inds = np.clip(np.searchsorted(times, querytimes), 1, len(times)-1)
+    nearer_prev = np.abs(querytimes - times[inds-1]) <= np.abs(times[inds] - querytimes)
+    return np.where(nearer_prev, inds-1, inds)
+
+def quats_from_rot_mats(rot_n33):
+    """
+    converts rotation matrices to quaternions in the (w, x, y, z) convention 
+    of openravepy
+    """
+    R = np.asarray(rot_n33)
+    quat_n4 = np.empty((len(R), 4))
+    sq_n4 = np.c_[1 + R[:,0,0] + R[:,1,1] + R[:,2,2], 
+                  1 + R[:,0,0] - R[:,1,1] - R[:,2,2], 
+                  1 - R[:,0,0] + R[:,1,1] - R[:,2,2], 
+                  1 - R[:,0,0] - R[:,1,1] + R[:,2,2]]
+    # use the largest component as the denominator for numerical stability
+    largest = sq_n4.argmax(axis=1)
+    for k in range(4):
+        mask = largest == k
+        if not mask.any():
+            continue
+        Rk = R[mask]
+        s = 2 * np.sqrt(sq_n4[mask,k])
+        diffs = np.c_[Rk[:,2,1] - Rk[:,1,2], Rk[:,0,2] - Rk[:,2,0], Rk[:,1,0] - Rk[:,0,1]]
+        sums = np.c_[Rk[:,0,1] + Rk[:,1,0], Rk[:,0,2] + Rk[:,2,0], Rk[:,1,2] + Rk[:,2,1]]
+        if k == 0:
+            quat_n4[mask] = np.c_[s/4, diffs/s[:,None]]
+        elif k == 1:
+            quat_n4[mask] = np.c_[diffs[:,0], s/4, sums[:,0], sums[:,1]] / np.c_[s, np.ones_like(s), s, s]
+        elif k == 2:
+            quat_n4[mask] = np.c_[diffs[:,1], sums[:,0], s/4, sums[:,2]] / np.c_[s, s, np.ones_like(s), s]
+        else:
+            quat_n4[mask] = np.c_[diffs[:,2], sums[:,1], sums[:,2], s/4] / np.c_[s, s, s, np.ones_like(s)]
+    return quat_n4
+
+def rot_mats_from_quats(quat_n4):
+    """
+    converts quaternions in the (w, x, y, z) convention to rotation matrices
+    """
+    quat_n4 = mu.normr(np.asarray(quat_n4, dtype=float))
+    w, x, y, z = quat_n4.T
+    rot_n33 = np.empty((len(quat_n4), 3, 3))
+    rot_n33[:,0,0] = 1 - 2*(y*y + z*z)
+    rot_n33[:,0,1] = 2*(x*y - w*z)
+    rot_n33[:,0,2] = 2*(x*z + w*y)
+    rot_n33[:,1,0] = 2*(x*y + w*z)
+    rot_n33[:,1,1] = 1 - 2*(x*x + z*z)
+    rot_n33[:,1,2] = 2*(y*z - w*x)
+    rot_n33[:,2,0] = 2*(x*z - w*y)
+    rot_n33[:,2,1] = 2*(y*z + w*x)
+    rot_n33[:,2,2] = 1 - 2*(x*x + y*y)
+    return rot_n33
+
+def slerp_quats(quat0_n4, quat1_n4, fracs):
+    """
+    spherical linear interpolation between each pair of quaternions along the 
+    shortest arc
+    """
+    quat0_n4 = np.asarray(quat0_n4, dtype=float)
+    quat1_n4 = np.array(quat1_n4, dtype=float)
+    fracs = np.asarray(fracs, dtype=float)
+    cos_n = (quat0_n4 * quat1_n4).sum(axis=1)
+    flip = cos_n < 0
+    quat1_n4[flip] *= -1
+    cos_n = np.clip(np.abs(cos_n), 0., 1.)
+    theta_n = np.arccos(cos_n)
+    sin_n = np.sin(theta_n)
+    # fall back to linear interpolation when the quaternions are (nearly) the same
+    small = sin_n < 1e-6
+    sin_n[small] = 1.
+    w0_n = np.where(small, 1 - fracs, np.sin((1 - fracs) * theta_n) / sin_n)
+    w1_n = np.where(small, fracs, np.sin(fracs * theta_n) / sin_n)
+    return mu.normr(w0_n[:,None] * quat0_n4 + w1_n[:,None] * quat1_n4)
+
 def interp_quats(newtimes, oldtimes, oldquats):
-    u_ioldtimes = np.interp(newtimes, oldtimes, range(len(oldtimes)))
-    newquats = np.empty((len(u_ioldtimes), oldquats.shape[1]))
-    for i, u_ioldtime in enumerate(u_ioldtimes):
-        u, ioldtime = np.modf(u_ioldtime)
-        if ioldtime+1 < oldquats.shape[0]:
-            newquats[i,:] = openravepy.quatSlerp(oldquats[ioldtime,:], oldquats[ioldtime+1,:], u)
-        else: # the last u is zero by definition
-            newquats[i,:] = oldquats[-1,:]
-    return newquats
+    oldquats = np.asarray(oldquats)
+    inds, fracs = get_interp_inds(newtimes, oldtimes)
+    inds1 = np.minimum(inds + 1, len(oldquats) - 1)
+    return slerp_quats(oldquats[inds], oldquats[inds1], fracs)
 
 def interp_hmats(newtimes, oldtimes, oldhmats):
-    oldposes = openravepy.poseFromMatrices(oldhmats)
-    newposes = np.empty((len(newtimes), 7))
-    newposes[:,4:7] = mu.interp2d(newtimes, oldtimes, oldposes[:,4:7])
-    newposes[:,0:4] = interp_quats(newtimes, oldtimes, oldposes[:,0:4])
-    newhmats = openravepy.matrixFromPoses(newposes)
+    oldhmats = np.asarray(oldhmats)
+    inds, fracs = get_interp_inds(newtimes, oldtimes)
+    inds1 = np.minimum(inds + 1, len(oldhmats) - 1)
+    newhmats = np.zeros((len(inds), 4, 4))
+    newhmats[:,:3,3] = lerp(oldhmats[inds,:3,3], oldhmats[inds1,:3,3], fracs)
+    oldquats = quats_from_rot_mats(oldhmats[:,:3,:3])
+    newhmats[:,:3,:3] = rot_mats_from_quats(slerp_quats(oldquats[inds], oldquats[inds1], fracs))
+    newhmats[:,3,3] = 1
     return newhmats
 
 if __name__ == "__main__":
@@ -42,48 +42,78 @@ def in_grasp_region(robot, lr, pt):
 
 def retime_traj(robot, inds, traj, max_cart_vel=.02, max_finger_vel=.02, upsample_time=.1):
     """retime a trajectory so that it executes slowly enough for the simulation"""
-    cart_traj = np.empty((len(traj), 6))
-    finger_traj = np.empty((len(traj),2))
     leftarm, rightarm = robot.GetManipulator("leftarm"), robot.GetManipulator("rightarm")
+    manips = [leftarm, rightarm]
+    inds = list(inds)
+    traj = np.asarray(traj)
+
+    # the tool frames are the end-effector links offset by the local tool transforms, so only the two 
+    # end-effector links are read at every step and the tool positions of both arms are computed at once
+    ee_links = [manip.GetEndEffector() for manip in manips]
+    tool_pts = np.array([manip.GetLocalToolTransform()[:3,3] for manip in manips])
+    moves_ee = any(robot.DoesAffect(robot.GetJointFromDOFIndex(ind).GetJointIndex(), ee_link.GetIndex()) 
+                   for ind in inds for ee_link in ee_links)
     with robot:
-        for i in range(len(traj)):
-            robot.SetDOFValues(traj[i], inds)
-            cart_traj[i,:3] = leftarm.GetTransform()[:3,3]
-            cart_traj[i,3:] = rightarm.GetTransform()[:3,3]
-            finger_traj[i,:1] = robot.GetDOFValues(leftarm.GetGripperIndices())
-            finger_traj[i,1:] = robot.GetDOFValues(rightarm.GetGripperIndices())
+        if moves_ee:
+            ee_traj = np.empty((len(traj), 2, 4, 4))
+            for i in range(len(traj)):
+                robot.SetDOFValues(traj[i], inds)
+                ee_traj[i,0] = ee_links[0].GetTransform()
+                ee_traj[i,1] = ee_links[1].GetTransform()
+        else: # none of the DOFs moves the end-effectors
+            ee_traj = np.tile([ee_link.GetTransform() for ee_link in ee_links], (len(traj),1,1,1))
+        # the gripper values are the trajectory columns (clipped to the joint limits) or the current values
+        finger_traj = np.empty((len(traj), 2))
+        for (j, manip) in enumerate(manips):
+            gripper_ind = manip.GetGripperIndices()[0]
+            if gripper_ind in inds:
+                lower, upper = robot.GetDOFLimits([gripper_ind])
+                finger_traj[:,j] = np.clip(traj[:,inds.index(gripper_ind)], lower[0], upper[0])
+            else:
+                finger_traj[:,j] = robot.GetDOFValues([gripper_ind])[0]
+    cart_traj = (np.einsum('tkij,kj->tki', ee_traj[:,:,:3,:3], tool_pts) + ee_traj[:,:,:3,3]).reshape(len(traj), 6)
 
     times = retiming.retime_with_vel_limits(np.c_[cart_traj, finger_traj], np.r_[np.repeat(max_cart_vel, 6),np.repeat(max_finger_vel,2)])
     times_up = np.linspace(0, times[-1], times[-1]/upsample_time) if times[-1] > upsample_time else times
     traj_up = math_utils.interp2d(times_up, times, traj)
     return traj_up
 
+def rotate_about_axes(vs, axes, thetas):
+    """
+    rotates each of the vectors vs (n x 3) about the respective unit axis in axes (n x 3) by each angle in thetas, 
+    with Rodrigues' rotation formula. Returns an array of shape (len(thetas), n, 3)
+    """
+    cos = np.cos(thetas)[:,None,None]
+    sin = np.sin(thetas)[:,None,None]
+    cross = np.cross(axes, vs)
+    proj = axes * (axes * vs).sum(axis=1)[:,None]
+    return vs[None,:,:] * cos + cross[None,:,:] * sin + proj[None,:,:] * (1 - cos)
+
 def observe_cloud(pts, radius, upsample=0, upsample_rad=1):
     """
     If upsample > 0, the number of points along the rope's backbone is resampled to be upsample points
     If upsample_rad > 1, the number of points perpendicular to the backbone points is resampled to be upsample_rad points, around the rope's cross-section
     The total number of points is then: (upsample if upsample > 0 else len(self.rope.GetControlPoints())) * upsample_rad
     """
+    pts = np.asarray(pts)
     if upsample > 0:
-        lengths = np.r_[0, np.apply_along_axis(np.linalg.norm, 1, np.diff(pts, axis=0))]
+        lengths = np.r_[0, np.sqrt((np.diff(pts, axis=0)**2).sum(axis=1))]
         summed_lengths = np.cumsum(lengths)
         assert len(lengths) == len(pts)
         pts = math_utils.interp2d(np.linspace(0, summed_lengths[-1], upsample), summed_lengths, pts)
     if upsample_rad > 1:
         # add points perpendicular to the points in pts around the rope's cross-section
         vs = np.diff(pts, axis=0) # vectors between the current and next points
-        vs /= np.apply_along_axis(np.linalg.norm, 1, vs)[:,None]
+        vs /= np.sqrt((vs**2).sum(axis=1))[:,None]
         perp_vs = np.c_[-vs[:,1], vs[:,0], np.zeros(vs.shape[0])] # perpendicular vectors between the current and next points in the xy-plane
-        perp_vs /= np.apply_along_axis(np.linalg.norm, 1, perp_vs)[:,None]
+        perp_vs /= np.sqrt((perp_vs**2).sum(axis=1))[:,None]
         vs = np.r_[vs, vs[-1,:][None,:]] # define the vector of the last point to be the same as the second to last one
         perp_vs = np.r_[perp_vs, perp_vs[-1,:][None,:]] # define the perpendicular vector of the last point to be the same as the second to last one
-        perp_pts = []
-        from openravepy import matrixFromAxisAngle
-        for theta in np.linspace(0, 2*np.pi, upsample_rad, endpoint=False): # uniformly around the cross-section circumference
-            for (center, rot_axis, perp_v) in zip(pts, vs, perp_vs):
-                rot = matrixFromAxisAngle(rot_axis, theta)[:3,:3]
-                perp_pts.append(center + rot.T.dot(radius * perp_v))
-        pts = np.array(perp_pts)
+        # rotate the perpendicular vectors of all the points at once, uniformly around the cross-section circumference. 
+        # The angles are negated since the points used to be rotated by the transpose of the rotation matrices
+        thetas = np.linspace(0, 2*np.pi, upsample_rad, endpoint=False)
+        perp_pts = pts[None,:,:] + rotate_about_axes(radius * perp_vs, vs, -thetas)
+        pts = perp_pts.reshape((-1, 3))
     return pts
 
 class Simulation(object):
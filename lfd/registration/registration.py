@@ -6,8 +6,7 @@ import settings
 import tps
 import solver
 import lfd.registration
-if lfd.registration._has_cuda:
-    from lfd.tpsopt.batchtps import batch_tps_rpm_bij, GPUContext, TgtContext
+from lfd.tpsopt.batchctx import BatchTpsRpmBijContext
 
 class Registration(object):
     def __init__(self, demo, test_scene_state, f, corr):
@@ -383,6 +382,9 @@ class BatchGpuTpsRpmRegistrationFactory(TpsRpmRegistrationFactory):
 class BatchGpuTpsRpmBijRegistrationFactory(TpsRpmBijRegistrationFactory):
     """
     Similar to TpsRpmBijRegistrationFactory but batch_register and batch_cost are computed in batch using the GPU
+
+    The batch context is kept between calls to batch_cost. If CUDA is not installed, the vectorized CPU 
+    implementation is used instead.
     """
     def __init__(self, demos, actionfile=None, 
                  n_iter=settings.N_ITER, em_iter=settings.EM_ITER, 
@@ -393,8 +395,6 @@ class BatchGpuTpsRpmBijRegistrationFactory(TpsRpmBijRegistrationFactory):
                  prior_fn=None, 
                  f_solver_factory=solver.AutoTpsSolverFactory(), 
                  g_solver_factory=solver.AutoTpsSolverFactory(use_cache=False)):
-        if not lfd.registration._has_cuda:
-            raise NotImplementedError("CUDA not installed")
         super(BatchGpuTpsRpmBijRegistrationFactory, self).__init__(demos=demos, 
                                                               n_iter=n_iter, em_iter=em_iter, 
                                                               reg_init=reg_init, reg_final=reg_final, 
@@ -407,8 +407,8 @@ class BatchGpuTpsRpmBijRegistrationFactory(TpsRpmBijRegistrationFactory):
         self.actionfile = actionfile
         if self.actionfile:
             self.bend_coefs = tps.loglinspace(self.reg_init, self.reg_final, self.n_iter)
-            self.src_ctx = GPUContext(self.bend_coefs)
-            self.src_ctx.read_h5(actionfile)
+            self.batch_ctx = BatchTpsRpmBijContext(actionfile, self.bend_coefs)
+            self.src_ctx = self.batch_ctx.src_ctx
         self.warn_clip_cloud = True
     
     def _clip_cloud(self, cloud):
@@ -426,18 +426,16 @@ class BatchGpuTpsRpmBijRegistrationFactory(TpsRpmBijRegistrationFactory):
     def batch_cost(self, test_scene_state):
         if not(self.actionfile):
             raise ValueError('No actionfile provided for gpu context')
-        tgt_ctx = TgtContext(self.src_ctx)
         cloud = test_scene_state.cloud
         cloud = self._clip_cloud(cloud)
-        tgt_ctx.set_cld(cloud)
         
-        cost_array = batch_tps_rpm_bij(self.src_ctx, tgt_ctx,
-                                       T_init=self.rad_init, T_final=self.rad_final, 
-                                       outlierfrac=self.outlierfrac, outlierprior=self.outlierprior, 
-                                       outliercutoff=settings.OUTLIER_CUTOFF, 
-                                       em_iter=self.em_iter, 
-                                       component_cost=True)
-        costs = dict(zip(self.src_ctx.seg_names, cost_array))
+        cost_array = self.batch_ctx.batch_cost(cloud,
+                                               T_init=self.rad_init, T_final=self.rad_final, 
+                                               outlierfrac=self.outlierfrac, outlierprior=self.outlierprior, 
+                                               outliercutoff=settings.OUTLIER_CUTOFF, 
+                                               em_iter=self.em_iter, 
+                                               component_cost=True)
+        costs = dict(zip(self.batch_ctx.seg_names, cost_array))
         return costs
 
 
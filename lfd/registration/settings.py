@@ -16,6 +16,13 @@ OUTLIER_PRIOR = .1
 #:
 OURLIER_FRAC  = 1e-2
 
+# thin plate spline evaluation
+#: maximum memory (in bytes) of the temporary kernel matrices when evaluating a thin plate spline or its jacobian; 
+#: the query points are processed in blocks that fit in it
+TPS_EVAL_MAX_MEM   = 32 * 2**20
+#: number of threads that evaluate the blocks of query points
+TPS_EVAL_N_THREADS = 1
+
 # registration with gpu
 #:
 MAX_CLD_SIZE       = 150
@@ -6,6 +6,7 @@ from __future__ import division
 import settings
 import numpy as np
 import scipy.spatial.distance as ssd
+from multiprocessing.pool import ThreadPool
 from transformation import Transformation
 import lfd.registration
 if lfd.registration._has_cuda:
@@ -53,25 +54,84 @@ def tps_kernel_matrix2(x_na, y_ma):
     distmat = ssd.cdist(x_na, y_ma)
     return tps_apply_kernel(distmat, dim)
 
-def tps_eval(x_ma, lin_ag, trans_g, w_ng, x_na):
-    K_mn = tps_kernel_matrix2(x_ma, x_na)
-    return np.dot(K_mn, w_ng) + np.dot(x_ma, lin_ag) + trans_g[None,:]
+def tps_block_size(n, n_temps, max_mem=None):
+    """
+    number of query points per block so that n_temps float64 temporaries of 
+    shape (block size, n) take at most max_mem bytes (settings.TPS_EVAL_MAX_MEM 
+    by default)
+    """
+    if max_mem is None:
+        max_mem = settings.TPS_EVAL_MAX_MEM
+    return max(1, int(max_mem // (8 * n_temps * max(n, 1))))
 
-def tps_grad(x_ma, lin_ag, _trans_g, w_ng, x_na):
+_thread_pools = {}
+def tps_map_blocks(block_fn, m, block_size, n_threads=None):
+    """
+    calls block_fn with the slices of consecutive blocks of block_size of 
+    range(m), from a pool of n_threads threads if n_threads > 1 
+    (settings.TPS_EVAL_N_THREADS by default)
+    """
+    if n_threads is None:
+        n_threads = settings.TPS_EVAL_N_THREADS
+    slices = [slice(i, min(i+block_size, m)) for i in xrange(0, m, block_size)]
+    if n_threads > 1 and len(slices) > 1:
+        if n_threads not in _thread_pools:
+            _thread_pools[n_threads] = ThreadPool(n_threads)
+        _thread_pools[n_threads].map(block_fn, slices)
+    else:
+        for sl in slices:
+            block_fn(sl)
+
+def tps_eval(x_ma, lin_ag, trans_g, w_ng, x_na, max_mem=None, n_threads=None):
+    y_mg = np.empty((x_ma.shape[0], lin_ag.shape[1]))
+    def eval_block(sl):
+        K_mn = tps_kernel_matrix2(x_ma[sl], x_na)
+        y_mg[sl] = np.dot(K_mn, w_ng) + np.dot(x_ma[sl], lin_ag) + trans_g[None,:]
+    tps_map_blocks(eval_block, x_ma.shape[0], tps_block_size(x_na.shape[0], 1, max_mem=max_mem), n_threads=n_threads)
+    return y_mg
+
+def tps_grad(x_ma, lin_ag, _trans_g, w_ng, x_na, max_mem=None, n_threads=None):
     _N, D = x_na.shape
     M = x_ma.shape[0]
 
     assert x_ma.shape[1] == 3
-    dist_mn = ssd.cdist(x_ma, x_na,'euclidean')
-
     grad_mga = np.empty((M,D,D))
-
     lin_ga = lin_ag.T
-    for a in xrange(D):
-        diffa_mn = x_ma[:,a][:,None] - x_na[:,a][None,:]
-        grad_mga[:,:,a] = lin_ga[None,:,a] - np.dot(nan2zero(diffa_mn/dist_mn),w_ng)
+    def grad_block(sl):
+        dist_mn = ssd.cdist(x_ma[sl], x_na,'euclidean')
+        for a in xrange(D):
+            diffa_mn = x_ma[sl,a][:,None] - x_na[:,a][None,:]
+            grad_mga[sl,:,a] = lin_ga[None,:,a] - np.dot(nan2zero(diffa_mn/dist_mn),w_ng)
+    tps_map_blocks(grad_block, M, tps_block_size(x_na.shape[0], 3, max_mem=max_mem), n_threads=n_threads)
     return grad_mga
 
+def tps_eval_and_grad(x_ma, lin_ag, trans_g, w_ng, x_na, m_grad=None, max_mem=None, n_threads=None):
+    """
+    tps_eval(x_ma, ...) and tps_grad(x_ma[:m_grad], ...), with the distances
+    between x_ma and x_na computed once for both
+    """
+    _N, D = x_na.shape
+    M = x_ma.shape[0]
+    if m_grad is None:
+        m_grad = M
+
+    assert x_ma.shape[1] == 3
+    y_mg = np.empty((M, lin_ag.shape[1]))
+    grad_mga = np.empty((m_grad,D,D))
+    lin_ga = lin_ag.T
+    def eval_and_grad_block(sl):
+        dist_mn = ssd.cdist(x_ma[sl], x_na,'euclidean')
+        K_mn = tps_apply_kernel(dist_mn, D)
+        y_mg[sl] = np.dot(K_mn, w_ng) + np.dot(x_ma[sl], lin_ag) + trans_g[None,:]
+        grad_sl = slice(sl.start, min(sl.stop, m_grad))
+        if grad_sl.start < grad_sl.stop:
+            dist_mn = dist_mn[:grad_sl.stop-grad_sl.start]
+            for a in xrange(D):
+                diffa_mn = x_ma[grad_sl,a][:,None] - x_na[:,a][None,:]
+                grad_mga[grad_sl,:,a] = lin_ga[None,:,a] - np.dot(nan2zero(diffa_mn/dist_mn),w_ng)
+    tps_map_blocks(eval_and_grad_block, M, tps_block_size(x_na.shape[0], 3, max_mem=max_mem), n_threads=n_threads)
+    return y_mg, grad_mga
+
 def solve_eqp1(H, f, A, ret_factorization=False):
     """solve equality-constrained qp
     min .5 tr(x'Hx) + tr(f'x)
@@ -226,6 +286,9 @@ class ThinPlateSpline(Transformation):
         grad_mga = tps_grad(x_ma, self.lin_ag, self.trans_g, self.w_ng, self.x_na)
         return grad_mga
     
+    def transform_points_and_jacobian(self, x_ma, m_jac=None):
+        return tps_eval_and_grad(x_ma, self.lin_ag, self.trans_g, self.w_ng, self.x_na, m_grad=m_jac)
+    
     def get_objective(self):
         r"""Returns the following 3 objectives:
         
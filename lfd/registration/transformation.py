@@ -26,6 +26,15 @@ class Transformation(object):
     def compute_jacobian(self, x_ma):
         raise NotImplementedError        
 
+    def transform_points_and_jacobian(self, x_ma, m_jac=None):
+        """
+        returns transform_points(x_ma) and the jacobians at the first m_jac
+        points of x_ma (all of them if m_jac is None)
+        """
+        if m_jac is None:
+            m_jac = len(x_ma)
+        return self.transform_points(x_ma), self.compute_jacobian(x_ma[:m_jac])
+
     def transform_vectors(self, x_ma, v_ma):
         grad_mga = self.compute_jacobian(x_ma)
         return np.einsum('ijk,ik->ij', grad_mga, v_ma) # matrix multiply each jac with each vector
@@ -34,30 +43,55 @@ class Transformation(object):
         """
         orthogonalize: none, svd, qr
         """
-
         grad_mga = self.compute_jacobian(x_ma)
-        newrot_mgd = np.array([grad_ga.dot(rot_ad) for (grad_ga, rot_ad) in zip(grad_mga, rot_mad)])
-
-
-        if orthogonalize:
-            if orth_method == "qr": 
-                newrot_mgd =  orthogonalize3_qr(newrot_mgd)
-            elif orth_method == "svd":
-                newrot_mgd = orthogonalize3_svd(newrot_mgd)
-            elif orth_method == "cross":
-                newrot_mgd = orthogonalize3_cross(newrot_mgd)
-            else: raise Exception("unknown orthogonalization method %s"%orthogonalize)
-        return newrot_mgd
+        return transform_bases_with_jacobian(grad_mga, rot_mad, orthogonalize=orthogonalize, orth_method=orth_method)
 
     def transform_hmats(self, hmat_mAD):
         """
         Transform (D+1) x (D+1) homogenius matrices
         """
-        hmat_mGD = np.empty_like(hmat_mAD)
-        hmat_mGD[:,:3,3] = self.transform_points(hmat_mAD[:,:3,3])
-        hmat_mGD[:,:3,:3] = self.transform_bases(hmat_mAD[:,:3,3], hmat_mAD[:,:3,:3])
-        hmat_mGD[:,3,:] = np.array([0,0,0,1])
-        return hmat_mGD
+        return self.warp(name2hmats={'hmats':hmat_mAD})['hmats']
+
+    def warp(self, name2pts=None, name2hmats=None):
+        """
+        Transforms several named sets of points and of homogeneous matrices at
+        once. The points of all the sets (and the positions of the matrices)
+        are transformed together, so that the transformation is evaluated once
+        over all of them
+
+        name2pts: dict from names to arrays of points of shape (..., D)
+        name2hmats: dict from names to arrays of shape (m, D+1, D+1)
+        returns a dict from the names of both dicts to the transformed arrays
+        """
+        if name2pts is None:
+            name2pts = {}
+        if name2hmats is None:
+            name2hmats = {}
+        assert not set(name2pts).intersection(name2hmats)
+        hmats_names = name2hmats.keys()
+        pts_names = name2pts.keys()
+        x_ma_list = [name2hmats[name][:,:3,3] for name in hmats_names] + \
+                    [np.asarray(name2pts[name]).reshape((-1,3)) for name in pts_names]
+        if not x_ma_list:
+            return {}
+        sizes = [len(x_ma) for x_ma in x_ma_list]
+        m_jac = sum(sizes[:len(hmats_names)])
+        y_ma, grad_mga = self.transform_points_and_jacobian(np.concatenate(x_ma_list), m_jac=m_jac)
+        
+        name2warped = {}
+        offsets = np.r_[0, np.cumsum(sizes)]
+        for i, name in enumerate(hmats_names):
+            hmat_mAD = name2hmats[name]
+            start, end = offsets[i], offsets[i+1]
+            hmat_mGD = np.empty_like(hmat_mAD)
+            hmat_mGD[:,:3,3] = y_ma[start:end]
+            hmat_mGD[:,:3,:3] = transform_bases_with_jacobian(grad_mga[start:end], hmat_mAD[:,:3,:3])
+            hmat_mGD[:,3,:] = np.array([0,0,0,1])
+            name2warped[name] = hmat_mGD
+        for i, name in enumerate(pts_names):
+            start, end = offsets[len(hmats_names)+i], offsets[len(hmats_names)+i+1]
+            name2warped[name] = y_ma[start:end].reshape(np.shape(name2pts[name]))
+        return name2warped
         
     def compute_numerical_jacobian(self, x_d, epsilon=0.0001):
         "numerical jacobian"
@@ -98,6 +132,23 @@ class Composition(Transformation):
             totalgrad = (grad[:,:,:,None] * totalgrad[:,None,:,:]).sum(axis=-2)
         return totalgrad
 
+def transform_bases_with_jacobian(grad_mga, rot_mad, orthogonalize=True, orth_method = "cross"):
+    """
+    transforms the bases rot_mad with the jacobians grad_mga of the
+    transformation at their origins
+    """
+    newrot_mgd = np.einsum('mga,mad->mgd', grad_mga, rot_mad)
+
+    if orthogonalize:
+        if orth_method == "qr": 
+            newrot_mgd =  orthogonalize3_qr(newrot_mgd)
+        elif orth_method == "svd":
+            newrot_mgd = orthogonalize3_svd(newrot_mgd)
+        elif orth_method == "cross":
+            newrot_mgd = orthogonalize3_cross(newrot_mgd)
+        else: raise Exception("unknown orthogonalization method %s"%orthogonalize)
+    return newrot_mgd
+
 def orthogonalize3_cross(mats_n33):
     "turns each matrix into a rotation"
 
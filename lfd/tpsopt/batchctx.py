@@ -0,0 +1,63 @@
+"""
+Long-lived context for batched tps-rpm registration
+
+the demonstration clouds are read once into a source context, and the
+target context and all the scratch buffers of both are kept around
+between calls, so each call only swaps in the new target cloud
+"""
+import hashlib
+
+import numpy as np
+
+try:
+    from lfd.tpsopt.batchtps import GPUContext, TgtContext, batch_tps_rpm_bij
+    _has_cuda = True
+except (ImportError, OSError):
+    _has_cuda = False
+from lfd.tpsopt import batchtps_cpu
+
+
+class BatchTpsRpmBijContext(object):
+    """
+    registers a target cloud to all the demonstration clouds of actionfile
+
+    uses the GPU contexts in batchtps if CUDA is available (or use_gpu is
+    True) and the vectorized CPU contexts in batchtps_cpu otherwise
+    """
+    def __init__(self, actionfile, bend_coefs=None, use_gpu=None):
+        if use_gpu is None:
+            use_gpu = _has_cuda
+        if use_gpu and not _has_cuda:
+            raise NotImplementedError("CUDA not installed")
+        self.use_gpu = use_gpu
+        if use_gpu:
+            ctx_class, tgt_ctx_class, self._batch_tps_rpm_bij = \
+                GPUContext, TgtContext, batch_tps_rpm_bij
+        else:
+            ctx_class, tgt_ctx_class, self._batch_tps_rpm_bij = \
+                batchtps_cpu.CPUContext, batchtps_cpu.CPUTgtContext, batchtps_cpu.batch_tps_rpm_bij
+        self.src_ctx = ctx_class(bend_coefs)
+        self.src_ctx.read_h5(actionfile)
+        self.tgt_ctx = tgt_ctx_class(self.src_ctx)
+        self.tgt_cld_hash = None
+
+    @property
+    def seg_names(self):
+        return self.src_ctx.seg_names
+
+    def set_cld(self, cloud_xyz):
+        """
+        swaps in cloud_xyz as the target, unless it is already there
+        """
+        cld_hash = hashlib.sha1(np.ascontiguousarray(cloud_xyz, dtype=np.float64).tostring()).hexdigest()
+        if cld_hash != self.tgt_cld_hash:
+            self.tgt_ctx.set_cld(cloud_xyz)
+            self.tgt_cld_hash = cld_hash
+
+    def batch_cost(self, cloud_xyz, **kwargs):
+        """
+        returns the registration costs from every demonstration cloud to
+        cloud_xyz. kwargs are passed to batch_tps_rpm_bij
+        """
+        self.set_cld(cloud_xyz)
+        return self._batch_tps_rpm_bij(self.src_ctx, self.tgt_ctx, **kwargs)
@@ -40,13 +40,16 @@ def sync(override = False):
     if Globals.sync or override:
         check_cuda_err()
 
-def gpu_pad(x, shape, dtype=np.float32):
+def pad(x, shape, dtype=np.float32):
     (m, n) = x.shape
     if m > shape[0] or n > shape[1]:
         raise ValueError("Cannot Pad Beyond Normal Dimension")
     x_new = np.zeros(shape, dtype=dtype)    
     x_new[:m, :n] = x
-    return gpuarray.to_gpu(x_new)
+    return x_new
+
+def gpu_pad(x, shape, dtype=np.float32):
+    return gpuarray.to_gpu(pad(x, shape, dtype))
 
 class GPUContext(object):
     """
@@ -193,6 +196,31 @@ class GPUContext(object):
         if update_ptrs:
             self.update_ptrs()
 
+    def replace_cld(self, i, name, proj_mats, offset_mats, cloud_xyz, kernel, scale_params):
+        """
+        overwrites cloud i with a new cloud, reusing its GPU memory
+        """
+        self.check_cld(cloud_xyz)
+        n = cloud_xyz.shape[0]
+        del self.names2inds[self.seg_names[i]]
+        self.seg_names[i] = name
+        self.names2inds[name] = i
+        self.scale_params[i] = scale_params
+
+        for b in self.bend_coefs:
+            offset_mat = offset_mats[b]
+            if offset_mat.shape != (n + DATA_DIM + 1, DATA_DIM):
+                raise ValueError("Offset Matrix has incorrect dimension")
+            self.proj_mats[b][i].set(pad(proj_mats[b], (MAX_CLD_SIZE + DATA_DIM + 1, MAX_CLD_SIZE)))
+            self.offset_mats[b][i].set(pad(offset_mat, (MAX_CLD_SIZE + DATA_DIM + 1, DATA_DIM)))
+
+        if kernel.shape != (n, n):
+            raise ValueError("dimension mismatch b/t kernel and cloud")
+        self.pts[i].set(pad(cloud_xyz, (MAX_CLD_SIZE, DATA_DIM)))
+        self.kernels[i].set(pad(kernel, (MAX_CLD_SIZE, MAX_CLD_SIZE)))
+        self.dims[i] = n
+        self.dims_gpu.set(np.array(self.dims, dtype=np.int32))
+
     def update_ptrs(self):
         self.tps_param_ptrs = get_gpu_ptrs(self.tps_params)
         self.trans_d_ptrs   = get_gpu_ptrs(self.trans_d)
@@ -701,6 +729,14 @@ class SrcContext(GPUContext):
         scale_points(self.l_traj_w_ptrs, self.l_traj_dims_gpu, scale, t[0], t[1], t[2], self.N)
         scale_points(self.r_traj_w_ptrs, self.r_traj_dims_gpu, scale, t[0], t[1], t[2], self.N)
 
+    def get_traj_pts(self, lr, inds):
+        """
+        returns the points of the warped lr trajectories at inds, one index per cloud
+        assumes that the trajectories have been warped already
+        """
+        traj_w = getattr(self, '%s_traj_w'%lr)
+        return np.array([traj_w[i][inds[i]].get() for i in range(self.N)])
+
     def test_get_unscaled_trajs(self, other):
         self.transform_trajs()
         scaled_traj_l = [x.get()[:self.l_traj_dims[i]] for i, x in enumerate(self.l_traj_w)]
@@ -786,6 +822,7 @@ class TgtContext(GPUContext):
             name = "{}_tgt".format(n)
             GPUContext.add_cld(self, name, proj_mats, offset_mats, tgt_cld, tgt_K, None)
         GPUContext.update_ptrs(self)
+        self.tgt_cld_set = False
     def add_cld(self, name, proj_mats, offset_mats, cloud_xyz, kernel, update_ptrs = False):
         raise NotImplementedError("not implemented for TgtConext")
     def update_ptrs(self):
@@ -794,31 +831,43 @@ class TgtContext(GPUContext):
     def set_cld(self, cld):
         """
         sets the cloud for this appropriately
-        won't allocate any new memory
+        the target buffers are allocated on the first call and
+        overwritten in place afterwards, so the pointers stay valid
         """                          
         scaled_cld, scale_params = unit_boxify(cld)
         proj_mats, offset_mats, K = self.get_sol_params(scaled_cld)
-        K_gpu = gpu_pad(K, (MAX_CLD_SIZE, MAX_CLD_SIZE))
-        cld_gpu = gpu_pad(scaled_cld, (MAX_CLD_SIZE, DATA_DIM))
-        self.pts          = [cld_gpu for _ in range(self.N)]
         self.scale_params = scale_params
+        self.dims         = [scaled_cld.shape[0]]
+        self.dims_gpu.fill(self.dims[0])
+        K = pad(K, (MAX_CLD_SIZE, MAX_CLD_SIZE))
+        scaled_cld = pad(scaled_cld, (MAX_CLD_SIZE, DATA_DIM))
+        proj_mats = dict([(b, pad(p.get(), (MAX_CLD_SIZE + DATA_DIM + 1, MAX_CLD_SIZE)))
+                          for b, p in proj_mats.iteritems()])
+        offset_mats = dict([(b, pad(p.get(), (MAX_CLD_SIZE + DATA_DIM + 1, DATA_DIM)))
+                            for b, p in offset_mats.iteritems()])
+        if self.tgt_cld_set:
+            self.pts[0].set(scaled_cld)
+            self.kernels[0].set(K)
+            for b in self.bend_coefs:
+                self.proj_mats[b][0].set(proj_mats[b])
+                self.offset_mats[b][0].set(offset_mats[b])
+            return
+
+        K_gpu = gpuarray.to_gpu(K)
+        cld_gpu = gpuarray.to_gpu(scaled_cld)
+        self.pts          = [cld_gpu for _ in range(self.N)]
         self.kernels      = [K_gpu for _ in range(self.N)]
-        proj_mats_gpu     = dict([(b, gpu_pad(p.get(), (MAX_CLD_SIZE + DATA_DIM + 1, MAX_CLD_SIZE)))
+        self.proj_mats    = dict([(b, [gpuarray.to_gpu(p)] * self.N)
                                   for b, p in proj_mats.iteritems()])
-        self.proj_mats    = dict([(b, [p for _ in range(self.N)])
-                                  for b, p in proj_mats_gpu.iteritems()])
-        offset_mats_gpu   = dict([(b, gpu_pad(p.get(), (MAX_CLD_SIZE + DATA_DIM + 1, DATA_DIM))) 
+        self.offset_mats  = dict([(b, [gpuarray.to_gpu(p)] * self.N)
                                   for b, p in offset_mats.iteritems()])
-        self.offset_mats  = dict([(b, [p for _ in range(self.N)])
-                                  for b, p in offset_mats_gpu.iteritems()])
-        self.dims         = [scaled_cld.shape[0]]
 
         self.pt_ptrs.fill(int(self.pts[0].gpudata))
         self.kernel_ptrs.fill(int(self.kernels[0].gpudata))
-        self.dims_gpu.fill(self.dims[0])
         for b in self.bend_coefs:
             self.proj_mat_ptrs[b].fill(int(self.proj_mats[b][0].gpudata))
             self.offset_mat_ptrs[b].fill(int(self.offset_mats[b][0].gpudata))
+        self.tgt_cld_set = True
 
 def check_transform_pts(ctx, i = 0):
     import scikits.cuda.linalg as la
@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+"""
+CPU version of the batched tps-rpm in batchtps
+
+the contexts mirror GPUContext, SrcContext and TgtContext, but each batch
+is kept in zero-padded numpy arrays so that every step of batch_tps_rpm_bij
+is a handful of vectorized operations over all the demonstrations at once
+
+arrays are named like name_abc, with the batch index first
+"""
+
+from __future__ import division
+import h5py
+import sys
+
+import numpy as np
+import scipy.linalg
+
+from lfd.tpsopt.tps import tps_kernel_matrix
+from lfd.tpsopt.registration import unit_boxify, loglinspace
+from lfd.tpsopt.transformations import get_exact_solver_mats
+from lfd.tpsopt.settings import N_ITER_CHEAP, EM_ITER_CHEAP, DEFAULT_LAMBDA, DATA_DIM, DS_SIZE, \
+    DEFAULT_NORM_ITERS, BEND_COEF_DIGITS, ROT_REG
+
+import time
+
+# demo-side matrices are stored in single precision, like in the GPU contexts
+DTYPE = np.float32
+
+def bdot(a_bij, b_bjk):
+    """
+    batched matrix product, leading dimensions are broadcasted
+    """
+    return np.einsum('...ij,...jk->...ik', a_bij, b_bjk)
+
+def bsqdist(x_bid, y_bjd):
+    """
+    batched squared euclidean distances between the rows of x and y
+    """
+    sqdist_bij = (x_bid**2).sum(axis=-1)[..., :, None] + (y_bjd**2).sum(axis=-1)[..., None, :] \
+        - 2 * bdot(x_bid, np.swapaxes(y_bjd, -1, -2))
+    return np.maximum(sqdist_bij, 0)
+
+def pad(x, shape, dtype=DTYPE):
+    (m, n) = x.shape
+    if m > shape[0] or n > shape[1]:
+        raise ValueError("Cannot Pad Beyond Normal Dimension")
+    x_new = np.zeros(shape, dtype=dtype)
+    x_new[:m, :n] = x
+    return x_new
+
+def get_sol_params(x_nd, K_nn, bend_coefs, rot_coef=ROT_REG):
+    """
+    precomputes the linear operators to fit a TPS to x_nd for each bending coefficient
+
+    the tps params for targets y_nd are proj_mats[b].dot(y_nd) + offset_mats[b]
+    """
+    n, d = x_nd.shape
+    rot_coefs = np.ones(d) * rot_coef if np.isscalar(rot_coef) else np.asarray(rot_coef)
+    N, QN, NON, NR = get_exact_solver_mats(x_nd, K_nn, bend_coefs, rot_coefs)
+    QNQN = QN.T.dot(QN)
+    rhs = np.c_[QN.T, NR]
+    proj_mats   = {}
+    offset_mats = {}
+    for b in bend_coefs:
+        sol = N.dot(scipy.linalg.solve(NON[b] + QNQN, rhs))
+        proj_mats[b]   = sol[:, :n]
+        offset_mats[b] = sol[:, n:]
+    return proj_mats, offset_mats
+
+class CPUContext(object):
+    """
+    Class to contain a batch of clouds and their tps params on the CPU
+    """
+    def __init__(self, bend_coefs = None):
+        if bend_coefs is None:
+            lambda_init, lambda_final = DEFAULT_LAMBDA
+            bend_coefs = np.around(loglinspace(lambda_init, lambda_final, N_ITER_CHEAP),
+                                    BEND_COEF_DIGITS)
+        self.bend_coefs = bend_coefs
+        self.arrays_valid = False
+        self.N = 0
+
+        # per cloud inputs, stacked into the batch arrays by update_arrays
+        self._clds        = []
+        self._kernels     = []
+        self._proj_mats   = dict([(b, []) for b in bend_coefs])
+        self._offset_mats = dict([(b, []) for b in bend_coefs])
+
+        """
+        TPS PARAM FORMAT
+        [      np.zeros(DATA_DIM)      ]   [  trans_d  ]   [1 x d]
+        [       np.eye(DATA_DIM)       ] = [  lin_dd   ] = [d x d]
+        [np.zeros((np.zeros, DATA_DIM))]   [   w_nd    ]   [n x d]
+        """
+        self.tps_params  = None
+        self.trans_d     = None
+        self.lin_dd      = None
+        self.w_nd        = None
+
+        self.proj_mats   = None
+        self.offset_mats = None
+
+        self.pts         = None
+        self.kernels     = None
+        self.pts_w       = None
+        self.pts_t       = None
+        self.dims        = []
+        self.mask        = None
+        self.scale_params = []
+
+        self.seg_names   = []
+        self.names2inds  = {}
+
+    def reset_tps_params(self):
+        """
+        sets the tps params to be identity
+        """
+        self.tps_params.fill(0)
+        self.lin_dd[:] = np.eye(DATA_DIM, dtype=DTYPE)
+
+    def set_tps_params(self, vals):
+        self.tps_params[:] = vals
+
+    def check_cld(self, cloud_xyz):
+        if cloud_xyz.shape[1] != DATA_DIM:
+            raise ValueError("point cloud must have cumn dimension {}".format(DATA_DIM))
+
+    def get_sol_params(self, cld):
+        self.check_cld(cld)
+        K = tps_kernel_matrix(cld)
+        proj_mats, offset_mats = get_sol_params(cld, K, self.bend_coefs)
+        return proj_mats, offset_mats, K
+
+    def add_cld(self, name, proj_mats, offset_mats, cloud_xyz, kernel, scale_params, update_arrays = False):
+        """
+        adds a new cloud to our context for batch processing
+        """
+        self.check_cld(cloud_xyz)
+        self.arrays_valid = False
+        self.N += 1
+        self.seg_names.append(name)
+        self.names2inds[name] = self.N - 1
+        self.scale_params.append(scale_params)
+        n = cloud_xyz.shape[0]
+
+        for b in self.bend_coefs:
+            proj_mat   = proj_mats[b]
+            offset_mat = offset_mats[b]
+            if proj_mat.shape != (n + DATA_DIM + 1, n):
+                raise ValueError("Projection Matrix has incorrect dimension")
+            if offset_mat.shape != (n + DATA_DIM + 1, DATA_DIM):
+                raise ValueError("Offset Matrix has incorrect dimension")
+            self._proj_mats[b].append(proj_mat)
+            self._offset_mats[b].append(offset_mat)
+
+        if kernel.shape != (n, n):
+            raise ValueError("dimension mismatch b/t kernel and cloud")
+        self._clds.append(cloud_xyz)
+        self._kernels.append(kernel)
+        self.dims.append(n)
+
+        if update_arrays:
+            self.update_arrays()
+
+    def replace_cld(self, i, name, proj_mats, offset_mats, cloud_xyz, kernel, scale_params):
+        """
+        overwrites cloud i with a new cloud, in place unless it is larger
+        than the current padding
+        """
+        self.check_cld(cloud_xyz)
+        n = cloud_xyz.shape[0]
+        del self.names2inds[self.seg_names[i]]
+        self.seg_names[i] = name
+        self.names2inds[name] = i
+        self.scale_params[i] = scale_params
+
+        for b in self.bend_coefs:
+            if offset_mats[b].shape != (n + DATA_DIM + 1, DATA_DIM):
+                raise ValueError("Offset Matrix has incorrect dimension")
+            self._proj_mats[b][i]   = proj_mats[b]
+            self._offset_mats[b][i] = offset_mats[b]
+        if kernel.shape != (n, n):
+            raise ValueError("dimension mismatch b/t kernel and cloud")
+        self._clds[i]    = cloud_xyz
+        self._kernels[i] = kernel
+        self.dims[i]     = n
+
+        n_max = self.pts.shape[1]
+        if n > n_max:
+            self.update_arrays()
+            return
+        self.pts[i]     = pad(cloud_xyz, (n_max, DATA_DIM))
+        self.kernels[i] = pad(kernel, (n_max, n_max))
+        for b in self.bend_coefs:
+            self.proj_mats[b][i]   = pad(proj_mats[b], (n_max + DATA_DIM + 1, n_max))
+            self.offset_mats[b][i] = pad(offset_mats[b], (n_max + DATA_DIM + 1, DATA_DIM))
+        self.mask[i] = np.arange(n_max) < n
+
+    def update_arrays(self):
+        """
+        stacks the clouds added so far into arrays padded to the largest cloud
+        """
+        n_max = max(self.dims)
+        self.pts     = np.array([pad(x, (n_max, DATA_DIM)) for x in self._clds])
+        self.kernels = np.array([pad(K, (n_max, n_max)) for K in self._kernels])
+        self.proj_mats   = {}
+        self.offset_mats = {}
+        for b in self.bend_coefs:
+            self.proj_mats[b]   = np.array([pad(p, (n_max + DATA_DIM + 1, n_max))
+                                            for p in self._proj_mats[b]])
+            self.offset_mats[b] = np.array([pad(o, (n_max + DATA_DIM + 1, DATA_DIM))
+                                            for o in self._offset_mats[b]])
+        self.mask = np.arange(n_max)[None, :] < np.asarray(self.dims)[:, None]
+        self.alloc_params(n_max)
+        self.arrays_valid = True
+
+    def alloc_params(self, n_max):
+        self.tps_params = np.zeros((self.N, DATA_DIM + 1 + n_max, DATA_DIM), DTYPE)
+        self.trans_d    = self.tps_params[:, 0, :]
+        self.lin_dd     = self.tps_params[:, 1:DATA_DIM+1, :]
+        self.w_nd       = self.tps_params[:, DATA_DIM+1:, :]
+        self.pts_w      = np.zeros((self.N, n_max, DATA_DIM), DTYPE)
+        self.pts_t      = np.zeros((self.N, n_max, DATA_DIM), DTYPE)
+        self.reset_tps_params()
+
+    def read_h5(self, fname):
+        f = h5py.File(fname, 'r')
+        for seg_name, seg_info in f.iteritems():
+            if 'inv' not in seg_info:
+                raise KeyError("Batch Mode only works with precomputed solvers")
+            seg_info = seg_info['inv']
+
+            proj_mats   = {}
+            offset_mats = {}
+            for b in self.bend_coefs:
+                k = str(b)
+                if k not in seg_info:
+                    raise KeyError("H5 File {} bend coefficient {}".format(seg_name, k))
+                proj_mats[b] = seg_info[k]['proj_mat'][:]
+                offset_mats[b] = seg_info[k]['offset_mat'][:]
+
+            ds_g         = seg_info['DS_SIZE_{}'.format(DS_SIZE)]
+            cloud_xyz    = ds_g['scaled_cloud_xyz'][:]
+            kernel       = ds_g['scaled_K_nn'][:]
+            scale_params = (ds_g['scaling'][()], ds_g['scaled_translation'][:])
+            self.add_cld(seg_name, proj_mats, offset_mats, cloud_xyz, kernel, scale_params)
+
+        f.close()
+        self.update_arrays()
+
+    def setup_tgt_ctx(self, cloud_xyz):
+        """
+        returns a CPUTgtContext where all the clouds are cloud_xyz
+        and matched in length with this contex
+        """
+        tgt_ctx = CPUTgtContext(self)
+        tgt_ctx.set_cld(cloud_xyz)
+        return tgt_ctx
+
+    def transform_points(self):
+        """
+        computes the warp of self.pts under the current tps params
+        """
+        self.pts_w[:] = bdot(self.pts, self.lin_dd) + self.trans_d[:, None, :] + bdot(self.kernels, self.w_nd)
+
+    def get_target_points(self, other, outlierprior=1e-1, outlierfrac=1e-2, outliercutoff=1e-2,
+                          T = 5e-3, norm_iters = DEFAULT_NORM_ITERS):
+        """
+        computes the target points for self and other
+        using the current warped points for both
+        """
+        x, xw, x_mask = self.pts, self.pts_w, self.mask
+        y, yw, y_mask = other.pts, other.pts_w, other.mask
+        n, m = x.shape[1], y.shape[1]
+        x_dims = np.asarray(self.dims, DTYPE)
+        y_dims = np.asarray(other.dims, DTYPE)
+        if len(x_dims) != self.N: x_dims = np.repeat(x_dims, self.N)
+        if len(y_dims) != self.N: y_dims = np.repeat(y_dims, self.N)
+        inlier_mask = x_mask[:, :, None] & y_mask[:, None, :]
+
+        dist_nm = np.sqrt(bsqdist(xw, y)) + np.sqrt(bsqdist(x, yw))
+        prob_NM = np.zeros((self.N, n + 1, m + 1), DTYPE)
+        prob_NM[:, :n, :m] = (np.exp(-dist_nm / (2 * T)) + 1e-9) * inlier_mask
+        prob_NM[:, :n, m] = outlierprior * x_mask
+        prob_NM[:, n, :m] = outlierprior * y_mask
+        prob_NM[:, n, m] = outlierfrac * np.sqrt(x_dims * y_dims)
+
+        a_N = np.zeros((self.N, n + 1), DTYPE)
+        a_N[:, :n] = x_mask
+        a_N[:, n] = y_dims * outlierfrac
+        b_M = np.zeros((self.N, m + 1), DTYPE)
+        b_M[:, :m] = y_mask
+        b_M[:, m] = x_dims * outlierfrac
+
+        # padded rows and columns have zero targets, so they get zero coefficients
+        r_N = np.ones((self.N, n + 1), DTYPE)
+        c_M = np.ones((self.N, m + 1), DTYPE)
+        for _ in range(norm_iters):
+            r_N = a_N / np.maximum(np.einsum('bij,bj->bi', prob_NM, c_M), 1e-20)
+            rn_c_M = c_M
+            c_M = b_M / np.maximum(np.einsum('bi,bij->bj', r_N, prob_NM), 1e-20)
+
+        prob_nm = prob_NM[:, :n, :m] * r_N[:, :n, None]
+        rn_prob_nm = prob_nm * rn_c_M[:, None, :m]
+        cn_prob_nm = prob_nm * c_M[:, None, :m]
+
+        wt_n = rn_prob_nm.sum(axis=2)
+        self.pts_t[:] = np.where((wt_n > outliercutoff)[:, :, None], bdot(rn_prob_nm, y), xw)
+        wt_m = cn_prob_nm.sum(axis=1)
+        other.pts_t[:] = np.where((wt_m > outliercutoff)[:, :, None],
+                                  bdot(np.swapaxes(cn_prob_nm, 1, 2), x), yw)
+
+    def update_transform(self, b):
+        """
+        computes the TPS associated with the current target pts
+        """
+        self.tps_params[:] = bdot(self.proj_mats[b], self.pts_t) + self.offset_mats[b]
+
+    def mapping_cost(self, other, bend_coef=DEFAULT_LAMBDA[1], outlierprior=1e-1, outlierfrac=1e-2,
+                       outliercutoff=1e-2,  T = 5e-3, norm_iters = DEFAULT_NORM_ITERS):
+        """
+        computes the error in the current mapping
+        assumes that the target points have already been filled
+        """
+        self.transform_points()
+        other.transform_points()
+        warp_err = (((self.pts_w - self.pts_t)**2).sum(axis=2) * self.mask).sum(axis=1)
+        warp_err += (((other.pts_w - other.pts_t)**2).sum(axis=2) * other.mask).sum(axis=1)
+        return warp_err
+
+    def bending_cost(self, b=DEFAULT_LAMBDA[1]):
+        ## b * w_nd' * K * w_nd
+        return b * (bdot(self.kernels, self.w_nd) * self.w_nd).sum(axis=2).sum(axis=1)
+
+    def gram_mat_cost(self, sigma):
+        ## assumes that self.pts_w has the warped points
+        ## computes the row-normalized gram matrices for the source and warped
+        ## points, returns ||K - K_w||^2
+        gram_mask = self.mask[:, :, None] & self.mask[:, None, :]
+        K = np.exp(bsqdist(self.pts, self.pts) / sigma) * gram_mask
+        K /= np.maximum(K.sum(axis=2), 1e-20)[:, :, None]
+        K_w = np.exp(bsqdist(self.pts_w, self.pts_w) / sigma) * gram_mask
+        K_w /= np.maximum(K_w.sum(axis=2), 1e-20)[:, :, None]
+        return ((K - K_w)**2).sum(axis=2).sum(axis=1).reshape(self.N, 1)
+
+    def bidir_tps_cost(self, other, bend_coef=1, outlierprior=1e-1, outlierfrac=1e-2,
+                       outliercutoff=1e-2,  T = 5e-3, norm_iters = DEFAULT_NORM_ITERS,
+                       sigma = 1, return_components = False):
+        mapping_err  = self.mapping_cost(other, outlierprior, outlierfrac, outliercutoff, T, norm_iters)
+        bending_cost = self.bending_cost(bend_coef)
+        other_bending_cost = other.bending_cost(bend_coef)
+        if return_components:
+            self_gram_mat_cost = self.gram_mat_cost(sigma)
+            other_gram_mat_cost = other.gram_mat_cost(sigma)
+            return np.c_[mapping_err, bending_cost, other_bending_cost, self_gram_mat_cost, other_gram_mat_cost]
+        return mapping_err + bending_cost + other_bending_cost
+
+class CPUSrcContext(CPUContext):
+    """
+    specialized class to handle source clouds
+    includes support for warped trajectories as well
+    """
+    def __init__(self, bend_coefs=None):
+        CPUContext.__init__(self, bend_coefs)
+        """
+        items for the trajectory and warping thereof
+        """
+        self._l_trajs     = []
+        self._l_trajs_K   = []
+        self._r_trajs     = []
+        self._r_trajs_K   = []
+
+        self.l_traj       = None
+        self.l_traj_K     = None
+        self.l_traj_w     = None
+        self.l_traj_dims  = []
+        self.l_traj_mask  = None
+
+        self.r_traj       = None
+        self.r_traj_K     = None
+        self.r_traj_w     = None
+        self.r_traj_dims  = []
+        self.r_traj_mask  = None
+
+    def update_arrays(self):
+        CPUContext.update_arrays(self)
+        n_max = self.pts.shape[1]
+        for lr in 'lr':
+            dims = getattr(self, '%s_traj_dims'%lr)
+            t_max = max(dims)
+            trajs   = [pad(t, (t_max, DATA_DIM)) for t in getattr(self, '_%s_trajs'%lr)]
+            trajs_K = [pad(K, (t_max, n_max)) for K in getattr(self, '_%s_trajs_K'%lr)]
+            setattr(self, '%s_traj'%lr, np.array(trajs))
+            setattr(self, '%s_traj_K'%lr, np.array(trajs_K))
+            setattr(self, '%s_traj_w'%lr, np.zeros((self.N, t_max, DATA_DIM), DTYPE))
+            setattr(self, '%s_traj_mask'%lr, np.arange(t_max)[None, :] < np.asarray(dims)[:, None])
+
+    def add_cld(self, name, proj_mats, offset_mats, cloud_xyz, kernel, scale_params,
+                r_traj, r_traj_K, l_traj, l_traj_K, update_arrays = False):
+        """
+        does the normal add, but also adds the trajectories
+        """
+        # don't update arrays there, do it after this
+        CPUContext.add_cld(self, name, proj_mats, offset_mats, cloud_xyz, kernel, scale_params,
+                           update_arrays=False)
+        self._r_trajs.append(r_traj)
+        self._r_trajs_K.append(r_traj_K)
+        self._l_trajs.append(l_traj)
+        self._l_trajs_K.append(l_traj_K)
+
+        self.l_traj_dims.append(l_traj.shape[0])
+        self.r_traj_dims.append(r_traj.shape[0])
+
+        if update_arrays:
+            self.update_arrays()
+
+    def read_h5(self, fname):
+        f = h5py.File(fname, 'r')
+        for seg_name, seg_info in f.iteritems():
+            if 'inv' not in seg_info:
+                raise KeyError("Batch Mode only works with precomputed solvers")
+            seg_info = seg_info['inv']
+
+            proj_mats   = {}
+            offset_mats = {}
+            for b in self.bend_coefs:
+                k = str(b)
+                if k not in seg_info:
+                    raise KeyError("H5 File {} bend coefficient {}".format(seg_name, k))
+                proj_mats[b] = seg_info[k]['proj_mat'][:]
+                offset_mats[b] = seg_info[k]['offset_mat'][:]
+
+            ds_g         = seg_info['DS_SIZE_{}'.format(DS_SIZE)]
+            cloud_xyz    = ds_g['scaled_cloud_xyz'][:]
+            kernel       = ds_g['scaled_K_nn'][:]
+            r_traj       = ds_g['scaled_r_traj'][:]
+            r_traj_K     = ds_g['scaled_r_traj_K'][:]
+            l_traj       = ds_g['scaled_l_traj'][:]
+            l_traj_K     = ds_g['scaled_l_traj_K'][:]
+            scale_params = (ds_g['scaling'][()], ds_g['scaled_translation'][:])
+            self.add_cld(seg_name, proj_mats, offset_mats, cloud_xyz, kernel, scale_params,
+                         r_traj, r_traj_K, l_traj, l_traj_K)
+        f.close()
+        self.update_arrays()
+
+    def transform_trajs(self):
+        """
+        computes the warp of l_traj and r_traj under current tps params
+        """
+        self.l_traj_w[:] = bdot(self.l_traj, self.lin_dd) + self.trans_d[:, None, :] + bdot(self.l_traj_K, self.w_nd)
+        self.r_traj_w[:] = bdot(self.r_traj, self.lin_dd) + self.trans_d[:, None, :] + bdot(self.r_traj_K, self.w_nd)
+
+    def get_unscaled_trajs(self, other):
+        """
+        transforms the trajectories with the current tps params
+        unscales them assuming that other is the target
+        assumes other is a CPUTgtContext
+        """
+        self.transform_trajs()
+        r, s = other.scale_params
+        self.l_traj_w[:] = self.l_traj_w / r - s / r
+        self.r_traj_w[:] = self.r_traj_w / r - s / r
+
+    def get_traj_pts(self, lr, inds):
+        """
+        returns the points of the warped lr trajectories at inds, one index per cloud
+        assumes that the trajectories have been warped already
+        """
+        traj_w = getattr(self, '%s_traj_w'%lr)
+        return traj_w[np.arange(self.N), np.asarray(inds)]
+
+    def traj_cost(self, tgt_seg, other):
+        i = self.names2inds[tgt_seg]
+        self.get_unscaled_trajs(other)
+        costs = []
+        for lr in 'lr':
+            traj_w = getattr(self, '%s_traj_w'%lr)
+            traj_mask = getattr(self, '%s_traj_mask'%lr)
+            tgt_traj = traj_w[i][traj_mask[i]]
+            min_dist = np.sqrt(bsqdist(traj_w, tgt_traj[None, :, :]).min(axis=2))
+            costs.append((min_dist * traj_mask).sum(axis=1) / traj_mask.sum(axis=1))
+        return (costs[0] + costs[1]) / float(2)
+
+class CPUTgtContext(CPUContext):
+    """
+    specialized class to handle the case where we are
+    mapping to a single target cloud --> the cloud arrays are
+    shared by the whole batch, only the tps params are not
+    """
+    def __init__(self, src_ctx):
+        CPUContext.__init__(self, src_ctx.bend_coefs)
+        self.src_ctx = src_ctx
+        self.N = src_ctx.N
+        self.seg_names = ["{}_tgt".format(n) for n in src_ctx.seg_names]
+        self.names2inds = dict([(s, i) for i, s in enumerate(self.seg_names)])
+        self.scale_params = None
+    def add_cld(self, name, proj_mats, offset_mats, cloud_xyz, kernel, update_arrays = False):
+        raise NotImplementedError("not implemented for CPUTgtConext")
+    def update_arrays(self):
+        raise NotImplementedError("not implemented for CPUTgtConext")
+    def set_cld(self, cld):
+        """
+        sets the cloud for this appropriately
+        only allocates new memory if the size of the cloud changes
+        """
+        scaled_cld, scale_params = unit_boxify(cld)
+        proj_mats, offset_mats, K = self.get_sol_params(scaled_cld)
+        m = scaled_cld.shape[0]
+        self.scale_params = scale_params
+        self.pts          = scaled_cld.astype(DTYPE)[None, :, :]
+        self.kernels      = K.astype(DTYPE)[None, :, :]
+        self.proj_mats    = dict([(b, p.astype(DTYPE)[None, :, :]) for b, p in proj_mats.iteritems()])
+        self.offset_mats  = dict([(b, o.astype(DTYPE)[None, :, :]) for b, o in offset_mats.iteritems()])
+        self.dims         = [m]
+        self.mask         = np.ones((1, m), bool)
+        if self.tps_params is None or self.pts_w.shape[1] != m:
+            self.alloc_params(m)
+        self.arrays_valid = True
+
+def batch_tps_rpm_bij(src_ctx, tgt_ctx, T_init = 1e-1, T_final = 5e-3,
+                      outlierfrac = 1e-2, outlierprior = 1e-1, outliercutoff = 1e-2, em_iter = EM_ITER_CHEAP,
+                      component_cost = False):
+    """
+    computes tps rpm for the clouds in src and tgt in batch
+    same as batchtps.batch_tps_rpm_bij but for CPU contexts
+    """
+    n_iter = len(src_ctx.bend_coefs)
+    T_vals = loglinspace(T_init, T_final, n_iter)
+
+    src_ctx.reset_tps_params()
+    tgt_ctx.reset_tps_params()
+    for i, b in enumerate(src_ctx.bend_coefs):
+        T = T_vals[i]
+        for _ in range(em_iter):
+            src_ctx.transform_points()
+            tgt_ctx.transform_points()
+            src_ctx.get_target_points(tgt_ctx, outlierprior, outlierfrac, outliercutoff, T)
+            src_ctx.update_transform(b)
+            tgt_ctx.update_transform(b)
+    return src_ctx.bidir_tps_cost(tgt_ctx, return_components=component_cost)
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", type=str, default='../data/misc/actions.h5')
+    parser.add_argument("--timing_runs", type=int, default=100)
+    return parser.parse_args()
+
+if __name__=='__main__':
+    from lfd.rapprentice import clouds
+    args = parse_arguments()
+    src_ctx = CPUSrcContext()
+    src_ctx.read_h5(args.input_file)
+    f = h5py.File(args.input_file, 'r')
+    tgt_cld = clouds.downsample(f['demo1-seg00']['cloud_xyz'][:], DS_SIZE)
+    f.close()
+    tgt_ctx = CPUTgtContext(src_ctx)
+    tgt_ctx.set_cld(tgt_cld)
+    times = []
+    print "batchtps initialized"
+    for i in range(args.timing_runs):
+        sys.stdout.write("\rRunning Timing test {}/{}".format(i, args.timing_runs))
+        sys.stdout.flush()
+        start = time.time()
+        tgt_ctx.set_cld(tgt_cld)
+        c = batch_tps_rpm_bij(src_ctx, tgt_ctx)
+        time_taken = time.time() - start
+        times.append(time_taken)
+    print "\nTiming Tests Complete"
+    print "Batch Size:\t\t\t", src_ctx.N
+    print "Mean Compute Time per Batch:\t", np.mean(times)
+    print "BiDirectional TPS fits/second:\t", float(args.timing_runs * src_ctx.N) / np.sum(times)
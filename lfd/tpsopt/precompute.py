@@ -13,7 +13,7 @@ from tps import tps_kernel_matrix, tps_kernel_matrix2
 from lfd.tpsopt.registration import unit_boxify, loglinspace
 from lfd.rapprentice import clouds
 from culinalg_exts import get_gpu_ptrs, dot_batch_nocheck, m_dot_batch
-from settings import N_ITER_CHEAP, DEFAULT_LAMBDA, DS_SIZE, BEND_COEF_DIGITS, EXACT_LAMBDA, N_ITER_EXACT
+from settings import N_ITER_CHEAP, DEFAULT_LAMBDA, DS_SIZE, BEND_COEF_DIGITS, EXACT_LAMBDA, N_ITER_EXACT, ROT_REG
 
 
 def parse_arguments():
@@ -382,7 +382,7 @@ def main():
             solver_g = seg_info.create_group('solver')
         x_nd = seg_info['inv'][ds_key]['scaled_cloud_xyz'][:]
         K_nn = seg_info['inv'][ds_key]['scaled_K_nn'][:]
-        N, QN, NON, NR = get_exact_solver(x_nd, K_nn, bend_coefs)
+        N, QN, NON, NR = get_exact_solver(x_nd, K_nn, bend_coefs, ROT_REG)
         solver_g['N']    = N
         solver_g['QN']   = QN
         solver_g['NR']   = NR
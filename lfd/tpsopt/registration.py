@@ -15,12 +15,18 @@ index name conventions:
 
 from __future__ import division
 
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import scipy.spatial.distance as ssd
 
-from lfd.tpsopt.transformations import ThinPlateSpline, fit_ThinPlateSpline
+from lfd.tpsopt.transformations import ThinPlateSpline, fit_ThinPlateSpline, NoGPUEmptySolver
 import tps
-from settings import BEND_COEF_DIGITS
+from settings import BEND_COEF_DIGITS, CPU_SOLVER_CACHE_SIZE
+
+# maps the hash of a cloud and its coefficients to its NoGPUTPSSolver
+_cpu_solver_cache = OrderedDict()
 
 # from svds import svds
 
@@ -63,7 +69,7 @@ def unscale_tps(f, src_params, targ_params):
     return Composition([aff_in, f, aff_out])
         
 # @profile
-def tps_rpm_bij(x_nd, y_md, fsolve, gsolve,n_iter = 20, reg_init = .1, reg_final = .001, rad_init = .1,
+def tps_rpm_bij(x_nd, y_md, fsolve=None, gsolve=None, n_iter = 20, reg_init = .1, reg_final = .001, rad_init = .1,
                 rad_final = .005, rot_reg = 1e-3, outlierprior=1e-1, outlierfrac=2e-1, vis_cost_xy=None,
                 return_corr=False, check_solver=False):
     """
@@ -71,12 +77,21 @@ def tps_rpm_bij(x_nd, y_md, fsolve, gsolve,n_iter = 20, reg_init = .1, reg_final
     reg_init/reg_final: regularization on curvature
     rad_init/rad_final: radius for correspondence calculation (meters)
     plotting: 0 means don't plot. integer n means plot every n iterations
+    fsolve/gsolve: solvers for the forward and backward fits. if not specified,
+                   CPU solvers with the products for each regularization are used
     """
     
     _,d=x_nd.shape
     regs = np.around(loglinspace(reg_init, reg_final, n_iter), BEND_COEF_DIGITS)
     rads = loglinspace(rad_init, rad_final, n_iter)
 
+    if fsolve is None or gsolve is None:
+        rot_coefs = np.ones(d) * rot_reg if np.isscalar(rot_reg) else np.asarray(rot_reg)
+        if fsolve is None:
+            fsolve = get_cpu_solver(x_nd, regs, rot_coefs)
+        if gsolve is None:
+            gsolve = get_cpu_solver(y_md, regs, rot_coefs)
+
     f = ThinPlateSpline(d)
     scale = (np.max(y_md,axis=0) - np.min(y_md,axis=0)) / (np.max(x_nd,axis=0) - np.min(x_nd,axis=0))
     f.lin_ag = np.diag(scale) # align the mins and max
@@ -126,6 +141,28 @@ def tps_rpm_bij(x_nd, y_md, fsolve, gsolve,n_iter = 20, reg_init = .1, reg_final
         return (f, g), corr_nm
     return f,g
 
+def get_cpu_solver(x_nd, bend_coefs, rot_coef):
+    """
+    returns a NoGPUTPSSolver for x_nd with the products for all of bend_coefs
+
+    the solvers of the last CPU_SOLVER_CACHE_SIZE clouds are kept, so
+    registering the same cloud again doesn't recompute them
+    """
+    key = hashlib.sha1(np.ascontiguousarray(x_nd, dtype=np.float64).tostring() + 
+                       np.asarray(bend_coefs, dtype=np.float64).tostring() + 
+                       np.asarray(rot_coef, dtype=np.float64).tostring()).hexdigest()
+    if key in _cpu_solver_cache:
+        solver = _cpu_solver_cache.pop(key)
+    else:
+        K_nn = tps.tps_kernel_matrix(x_nd)
+        # each solver has its own empty solver so that the cached solvers stay valid
+        empty_solver = NoGPUEmptySolver(x_nd.shape[0], bend_coefs)
+        solver = empty_solver.get_solver(x_nd, K_nn, bend_coefs, rot_coef)
+    _cpu_solver_cache[key] = solver
+    while len(_cpu_solver_cache) > CPU_SOLVER_CACHE_SIZE:
+        _cpu_solver_cache.popitem(last=False)
+    return solver
+
 def balance_matrix(prob_nm, max_iter, p, outlierfrac, r_N = None):
     
     n,m = prob_nm.shape
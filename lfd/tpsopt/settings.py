@@ -11,7 +11,9 @@ DS_SIZE            = 0.025 # for overhand
 N_STREAMS          = 10
 DEFAULT_NORM_ITERS = 10
 BEND_COEF_DIGITS   = 6
+ROT_REG            = (1e-4, 1e-4, 1e-1)
 GRIPPER_OPEN_CLOSE_THRESH = 0.04 # 0.07 for thick rope...
+CPU_SOLVER_CACHE_SIZE = 32 # number of clouds whose CPU solvers are kept by registration.get_cpu_solver
 
 try:
 	from lfd_settings.tpsopt.settings import *
@@ -1,16 +1,25 @@
 import numpy as np
-import pycuda.gpuarray as gpuarray
-import pycuda.driver as drv
 import scipy.linalg
 
 import tps
-from lfd.tpsopt.culinalg_exts import gemm, get_gpu_ptrs, dot_batch_nocheck
+from settings import ROT_REG
+try:
+    import pycuda.gpuarray as gpuarray
+    import pycuda.driver as drv
+    from lfd.tpsopt.culinalg_exts import gemm, get_gpu_ptrs, dot_batch_nocheck
+    _has_cuda = True
+except (ImportError, OSError):
+    _has_cuda = False
 
 
 class NoGPUTPSSolver(object):
     """
-    class to fit a thin plate spline to data using precomputed
-    matrix products
+    class to fit a thin plate spline to data on the CPU using the
+    reduced matrix products N'O_bN precomputed for each bending
+    coefficient
+
+    the weights change at every solve, so the reduced system
+    N'(Q'WQ + O_b)N is assembled and Cholesky factored each time
     """
     def __init__(self, bend_coefs, N, QN, NON, NR, x_nd, K_nn, rot_coef):
         for b in bend_coefs:
@@ -32,15 +41,18 @@ class NoGPUTPSSolver(object):
         assert np.allclose(rot_coef, self.rot_coef)
         assert self.valid
         WQN = wt_n[:, None] * self.QN
-        lhs = self.NON[b] + self.QN.T.dot(WQN)
+        lhs = self.NON[bend_coef] + self.QN.T.dot(WQN)
         wy_nd = wt_n[:, None] * y_nd
         rhs = self.NR + self.QN.T.dot(wy_nd)
-        z = scipy.linalg.solve(lhs, rhs)
+        z = scipy.linalg.cho_solve(scipy.linalg.cho_factor(lhs), rhs)
         theta = self.N.dot(z)
         set_ThinPlateSpline(f_res, self.x_nd, theta)
 
     @staticmethod
-    def get_solvers(h5file):
+    def get_solvers(h5file, rot_coef=ROT_REG):
+        """
+        rot_coef should be the one the products in h5file were computed with
+        """
         solvers = {}
         for seg_name, seg_info in h5file.iteritems():
             solver_info = seg_info['solver']
@@ -53,7 +65,7 @@ class NoGPUTPSSolver(object):
             NON = {}
             for b in bend_coefs:
                 NON[b] = solver_info['NON'][str(b)][:]
-            solvers[seg_name] = NoGPUTPSSolver(bend_coefs, N, QN, NON, NR, x_nd, K_nn)
+            solvers[seg_name] = NoGPUTPSSolver(bend_coefs, N, QN, NON, NR, x_nd, K_nn, rot_coef)
         return solvers
 
 class NoGPUEmptySolver(object):
@@ -74,28 +86,41 @@ class NoGPUEmptySolver(object):
         if not self.cur_solver is None:
             self.cur_solver.valid = False
 
-        Q = np.c_[np.ones((n, 1)), x_na, K_nn]
-        A = np.r_[np.zeros((d+1, d+1)), np.c_[np.ones((n, 1)), x_na]].T
-        
-        R = np.zeros((n+d+1, d))
-        R[1:d+1, :d] = np.diag(rot_coef)
-    
-        n_cnts = A.shape[0]    
-        _u,_s,_vh = np.linalg.svd(A.T)
-        N = _u[:,n_cnts:]
-        QN = Q.dot(N)
-        NR = N.T.dot(R)
-        
-        NON = {}
-        for i, b in enumerate(bend_coefs):
-            O_b = np.zeros((n+d+1, n+d+1), np.float64)
-            O_b[d+1:, d+1:] += b * K_nn
-            O_b[1:d+1, 1:d+1] += np.diag(rot_coef)
-            NON[b] = N.T.dot(O_b.dot(N))
-       
+        N, QN, NON, NR = get_exact_solver_mats(x_na, K_nn, bend_coefs, rot_coef)
         self.cur_solver = NoGPUTPSSolver(bend_coefs, N, QN, NON, NR, x_na, K_nn, rot_coef)
         return self.cur_solver
 
+def get_exact_solver_mats(x_na, K_nn, bend_coefs, rot_coef):
+    """
+    precomputes the matrix products needed to fit a TPS exactly
+
+    a TPS is fit by solving the system
+    N'(Q'WQ + O_b)N z = N'R + N'Q'Wy
+    theta = Nz
+
+    returns N, QN, NON, NR where NON maps each bending coefficient to N'O_bN
+    """
+    n,d = x_na.shape
+    Q = np.c_[np.ones((n, 1)), x_na, K_nn]
+    A = np.r_[np.zeros((d+1, d+1)), np.c_[np.ones((n, 1)), x_na]].T
+
+    R = np.zeros((n+d+1, d))
+    R[1:d+1, :d] = np.diag(rot_coef)
+
+    n_cnts = A.shape[0]
+    _u,_s,_vh = np.linalg.svd(A.T)
+    N = _u[:,n_cnts:]
+    QN = Q.dot(N)
+    NR = N.T.dot(R)
+
+    # N'O_bN = b N_w'KN_w + N_l'diag(rot_coef)N_l, so only the kernel product depends on b
+    NKN = N[d+1:].T.dot(K_nn.dot(N[d+1:]))
+    NRN = (N[1:d+1].T * rot_coef).dot(N[1:d+1])
+    NON = {}
+    for b in bend_coefs:
+        NON[b] = b * NKN + NRN
+    return N, QN, NON, NR
+
 class TPSSolver(object):
     """
     class to fit a thin plate spline to data using precomputed
@@ -2,6 +2,7 @@ from __future__ import division
 
 import numpy as np
 import json
+import re
 import openravepy
 import trajoptpy
 from lfd.environment import sim_util
@@ -9,6 +10,192 @@ from lfd.util import util
 from lfd.rapprentice import math_utils as mu
 import settings
 
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+def to_json(obj):
+    """
+    serializes obj, converting numpy arrays (of any size) with a single tolist each
+    """
+    return json.dumps(obj, default=_json_default)
+
+def rows_to_json(a):
+    """
+    returns the serialization of each a[i]
+    """
+    return [json.dumps(row) for row in np.asarray(a).tolist()]
+
+class RequestTemplate(object):
+    """
+    the parts of a trajopt request that only depend on the robot, the manipulator 
+    and the optimization settings, serialized once
+    """
+    def __init__(self, manip_name, n_steps, start_fixed, gamma, use_collision_cost, joint_vel_limits=None, 
+                 m_ext=None, n_ext=None):
+        basic_info = {
+            "n_steps" : n_steps,
+            "manip" : manip_name,
+            "start_fixed" : start_fixed
+        }
+        if m_ext is not None:
+            basic_info["m_ext"] = m_ext
+            basic_info["n_ext"] = n_ext
+        self.basic_info = to_json(basic_info)
+        
+        self.costs = [to_json({
+            "type" : "joint_vel",
+            "params": {"coeffs" : [gamma/(n_steps-1)]}
+        })]
+        if use_collision_cost:
+            self.costs.append(to_json({
+                "type" : "collision",
+                "params" : {
+                  "continuous" : True,
+                  "coeffs" : [1000],  # penalty coefficients. list of length one is automatically expanded to a list of length n_timesteps
+                  "dist_pen" : [0.025]  # robot-obstacle distance that penalty kicks in. expands to length n_timesteps
+                }
+            }))
+        
+        self.constraints = []
+        if joint_vel_limits is not None:
+            self.constraints.append(to_json({
+                "type" : "joint_vel_limits",
+                "params": {"vals" : joint_vel_limits,
+                           "first_step" : 0,
+                           "last_step" : n_steps-1
+                           }
+            }))
+
+_request_templates = {}
+def get_request_template(manip_name, n_steps, start_fixed, gamma, use_collision_cost, joint_vel_limits=None, 
+                         m_ext=None, n_ext=None):
+    """
+    returns the RequestTemplate for these arguments, which is only built the first time
+    """
+    key = (manip_name, n_steps, start_fixed, gamma, use_collision_cost, 
+           None if joint_vel_limits is None else tuple(np.asarray(joint_vel_limits).flat), m_ext, n_ext)
+    if key not in _request_templates:
+        _request_templates[key] = RequestTemplate(manip_name, n_steps, start_fixed, gamma, use_collision_cost, 
+                                                  joint_vel_limits=joint_vel_limits, m_ext=m_ext, n_ext=n_ext)
+    return _request_templates[key]
+
+class RequestBuilder(object):
+    """
+    assembles the json string of a trajopt request out of serialized pieces
+    """
+    def __init__(self, template):
+        self.template = template
+        self.costs = list(template.costs)
+        self.constraints = list(template.constraints)
+        self.init_info = None
+    
+    def add_cost(self, cost):
+        self.costs.append(to_json(cost))
+    
+    def add_timestep_costs(self, cost_type, timesteps, params, timestep_params):
+        """
+        adds a cost of type cost_type for each of the timesteps
+        
+        Args:
+            params: dict of the params shared by all the timesteps
+            timestep_params: dict that maps to arrays whose first dimension is indexed by the position in timesteps
+        """
+        prefix = '{"type":%s,"params":{' % json.dumps(cost_type)
+        shared = to_json(params)[1:-1]
+        names = timestep_params.keys()
+        name_jsons = [json.dumps(name) + ":" for name in names]
+        rows = [rows_to_json(timestep_params[name]) for name in names]
+        for i, t in enumerate(timesteps):
+            fields = [name_json + name_rows[i] for (name_json, name_rows) in zip(name_jsons, rows)]
+            fields.append('"timestep":%d' % t)
+            if shared:
+                fields.append(shared)
+            self.costs.append(prefix + ",".join(fields) + "}}")
+    
+    def set_init_traj(self, init_traj, init_ext=None):
+        init_info = {
+            "type":"given_traj",
+            "data":init_traj
+        }
+        if init_ext is not None:
+            init_info["data_ext"] = init_ext
+        self.init_info = to_json(init_info)
+    
+    def get_json(self):
+        return '{"basic_info":%s,"costs":[%s],"constraints":[%s],"init_info":%s}' % \
+            (self.template.basic_info, ",".join(self.costs), ",".join(self.constraints), self.init_info)
+
+def get_link_trajs(robot, dof_inds, traj, link_names):
+    """
+    computes the transforms of the links along traj, setting the dof values once per timestep for all the links
+    
+    Returns:
+        dict that maps each link name to an array of shape (n_steps, 4, 4)
+    """
+    link_inds = [robot.GetLink(link_name).GetIndex() for link_name in link_names]
+    link_trajs = np.empty((len(link_inds), len(traj), 4, 4))
+    with openravepy.RobotStateSaver(robot):
+        for (i_step, dof_vals) in enumerate(traj):
+            robot.SetDOFValues(dof_vals, dof_inds)
+            link_trajs[:,i_step] = np.asarray(robot.GetLinkTransformations())[link_inds]
+    return dict(zip(link_names, link_trajs))
+
+def get_pose_err(hmats, link_traj):
+    """
+    returns the poses of link_traj relative to hmats, for every timestep
+    """
+    rot_inv = hmats[:,:3,:3].transpose(0,2,1)
+    rel_hmats = np.tile(np.eye(4), (len(hmats),1,1))
+    rel_hmats[:,:3,:3] = np.einsum('tij,tjk->tik', rot_inv, link_traj[:,:3,:3])
+    rel_hmats[:,:3,3] = np.einsum('tij,tj->ti', rot_inv, link_traj[:,:3,3] - hmats[:,:3,3])
+    return openravepy.poseFromMatrices(rel_hmats)
+
+def get_rel_pts_err(pts_traj, rel_pts, link_traj):
+    """
+    returns the difference between pts_traj and the points rel_pts of the link, for every timestep
+    """
+    return pts_traj - (link_traj[:,None,:3,3] + np.einsum('tij,kj->tki', link_traj[:,:3,:3], rel_pts))
+
+def get_cost_sums(result):
+    """
+    returns a dict that maps each cost type of the trajopt result to the sum of its values
+    """
+    cost_sums = {}
+    for (cost_type, cost_val) in result.GetCosts():
+        cost_sums[cost_type] = cost_sums.get(cost_type, 0) + cost_val
+    return cost_sums
+
+def get_n_sqp_iters(trajopt_output):
+    """
+    returns the number of SQP iterations in the output of a trajopt optimization, i.e. the number of 
+    "iteration <i>" lines it logged (0 if trajopt's log level hides them)
+    """
+    return len(re.findall(r"iteration \d+", trajopt_output))
+
+def print_costs_and_errors(cost_rows, err_rows):
+    """
+    prints the costs table, with rows (name, trajopt cost, computed cost or None), 
+    and the errors table, with rows (name, errors)
+    """
+    print "{:>15} | {:>10} | {:>10}".format("", "trajopt", "computed")
+    print "{:>15} | {:>10}".format("COSTS", "-"*23)
+    for (name, cost, cost2) in cost_rows:
+        if cost2 is None:
+            print "{:>15} | {:>10,.4} | {:>10}".format(name, cost, "-")
+        else:
+            print "{:>15} | {:>10,.4} | {:>10,.4}".format(name, cost, cost2)
+    print ""
+
+    print "{:>15} | {:>10} | {:>10}".format("", "abs min", "abs max")
+    print "{:>15} | {:>10}".format("ERRORS", "-"*23)
+    for (name, err) in err_rows:
+        print "{:>15} | {:>10,.4} | {:>10,.4}".format(name, np.abs(err).min(), np.abs(err).max())
+    print ""
+
 def plan_follow_traj(robot, manip_name, ee_link, new_hmats, old_traj, 
                      no_collision_cost_first=False, use_collision_cost=True, start_fixed=False, joint_vel_limits=None,
                      beta_pos=settings.BETA_POS, beta_rot=settings.BETA_ROT, gamma=settings.GAMMA):
@@ -18,7 +205,11 @@ def plan_follow_traj(robot, manip_name, ee_link, new_hmats, old_traj,
 
 def plan_follow_trajs(robot, manip_name, ee_link_names, ee_trajs, old_traj, 
                      no_collision_cost_first=False, use_collision_cost=True, start_fixed=False, joint_vel_limits=None,
-                     beta_pos=settings.BETA_POS, beta_rot=settings.BETA_ROT, gamma=settings.GAMMA):
+                     beta_pos=settings.BETA_POS, beta_rot=settings.BETA_ROT, gamma=settings.GAMMA, 
+                     verbose=settings.PLANNING_VERBOSE, return_n_iters=False):
+    """
+    if return_n_iters is True, the number of SQP iterations of the optimization is also returned
+    """
     orig_dof_inds = robot.GetActiveDOFIndices()
     orig_dof_vals = robot.GetDOFValues()
     
@@ -31,7 +222,7 @@ def plan_follow_trajs(robot, manip_name, ee_link_names, ee_trajs, old_traj,
     if no_collision_cost_first:
         init_traj, _, _ = plan_follow_trajs(robot, manip_name, ee_link_names, ee_trajs, old_traj, 
                                         no_collision_cost_first=False, use_collision_cost=False, start_fixed=start_fixed, joint_vel_limits=joint_vel_limits,
-                                        beta_pos = beta_pos, beta_rot = beta_rot, gamma = gamma)
+                                        beta_pos = beta_pos, beta_rot = beta_rot, gamma = gamma, verbose = verbose)
     else:
         init_traj = old_traj.copy()
 
@@ -40,121 +231,54 @@ def plan_follow_trajs(robot, manip_name, ee_link_names, ee_trajs, old_traj,
         sim_util.unwrap_in_place(init_traj, dof_inds)
         init_traj += robot.GetDOFValues(dof_inds) - init_traj[0,:]
 
-    request = {
-        "basic_info" : {
-            "n_steps" : n_steps,
-            "manip" : manip_name,
-            "start_fixed" : start_fixed
-        },
-        "costs" : [
-        {
-            "type" : "joint_vel",
-            "params": {"coeffs" : [gamma/(n_steps-1)]}
-        },            
-        ],
-        "constraints" : [
-        ],
-        "init_info" : {
-            "type":"given_traj",
-            "data":[x.tolist() for x in init_traj]
-        }
-    }
+    request = RequestBuilder(get_request_template(manip_name, n_steps, start_fixed, gamma, use_collision_cost, joint_vel_limits))
+    request.set_init_traj(init_traj)
     
-    if use_collision_cost:
-        request["costs"].append(
-            {
-                "type" : "collision",
-                "params" : {
-                  "continuous" : True,
-                  "coeffs" : [1000],  # penalty coefficients. list of length one is automatically expanded to a list of length n_timesteps
-                  "dist_pen" : [0.025]  # robot-obstacle distance that penalty kicks in. expands to length n_timesteps
-                }
-            })
-    
-    if joint_vel_limits is not None:
-        request["constraints"].append(
-             {
-                "type" : "joint_vel_limits",
-                "params": {"vals" : joint_vel_limits,
-                           "first_step" : 0,
-                           "last_step" : n_steps-1
-                           }
-              })
-
+    timesteps = np.arange(1 if start_fixed else 0, n_steps)
     for (ee_link_name, ee_traj) in zip(ee_link_names, ee_trajs):
-        poses = [openravepy.poseFromMatrix(hmat) for hmat in ee_traj]
-        for (i_step,pose) in enumerate(poses):
-            if start_fixed and i_step == 0:
-                continue
-            request["costs"].append(
-                {"type":"pose",
-                 "params":{
-                    "xyz":pose[4:7].tolist(),
-                    "wxyz":pose[0:4].tolist(),
-                    "link":ee_link_name,
-                    "timestep":i_step,
-                    "pos_coeffs":[np.sqrt(beta_pos/n_steps)]*3,
-                    "rot_coeffs":[np.sqrt(beta_rot/n_steps)]*3
-                 }
-                })
-
-    s = json.dumps(request)
+        poses = openravepy.poseFromMatrices(np.asarray(ee_traj)[timesteps])
+        request.add_timestep_costs("pose", timesteps, 
+                                   {"link":ee_link_name,
+                                    "pos_coeffs":[np.sqrt(beta_pos/n_steps)]*3,
+                                    "rot_coeffs":[np.sqrt(beta_rot/n_steps)]*3}, 
+                                   {"xyz":poses[:,4:7], "wxyz":poses[:,0:4]})
+
+    s = request.get_json()
     with openravepy.RobotStateSaver(robot):
         orig_dof_vals
-        with util.suppress_stdout():
+        with util.capture_stdout() as trajopt_stdout:
             prob = trajoptpy.ConstructProblem(s, robot.GetEnv()) # create object that stores optimization problem
             result = trajoptpy.OptimizeProblem(prob) # do optimization
     traj = result.GetTraj()
+    cost_sums = get_cost_sums(result)
+    pose_costs = cost_sums.get("pose", 0)
+    obj_value = np.sum(cost_sums.values())
     
-    pose_costs = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts() if cost_type == "pose"])
-    pose_err = []
-    with openravepy.RobotStateSaver(robot):
-        for (ee_link_name, ee_traj) in zip(ee_link_names, ee_trajs):
-            ee_link = robot.GetLink(ee_link_name)
-            for (i_step, hmat) in enumerate(ee_traj):
-                if start_fixed and i_step == 0:
-                    continue
-                robot.SetDOFValues(traj[i_step], dof_inds)
-                new_hmat = ee_link.GetTransform()
-                pose_err.append(openravepy.poseFromMatrix(mu.invertHmat(hmat).dot(new_hmat)))
-    pose_err = np.asarray(pose_err)
-    pose_costs2 = (beta_rot/n_steps) * np.square(pose_err[:,1:4]).sum() + (beta_pos/n_steps) * np.square(pose_err[:,4:7]).sum()
-
-    joint_vel_cost = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts() if cost_type == "joint_vel"])
-    joint_vel_err = np.diff(traj, axis=0)
-    joint_vel_cost2 = (gamma/(n_steps-1)) * np.square(joint_vel_err).sum()
+    if verbose:
+        link_trajs = get_link_trajs(robot, dof_inds, traj, ee_link_names)
+        pose_err = np.concatenate([get_pose_err(np.asarray(ee_traj)[timesteps], link_trajs[ee_link_name][timesteps]) 
+                                   for (ee_link_name, ee_traj) in zip(ee_link_names, ee_trajs)])
+        pose_costs2 = (beta_rot/n_steps) * np.square(pose_err[:,1:4]).sum() + (beta_pos/n_steps) * np.square(pose_err[:,4:7]).sum()
+        joint_vel_cost2 = (gamma/(n_steps-1)) * np.square(np.diff(traj, axis=0)).sum()
     sim_util.unwrap_in_place(traj, dof_inds)
-    joint_vel_err = np.diff(traj, axis=0)
     
-    collision_costs = [cost_val for (cost_type, cost_val) in result.GetCosts() if "collision" in cost_type]
-    if len(collision_costs) > 0:
-        collision_err = np.asarray(collision_costs)
-        collision_costs = np.sum(collision_costs)
-
-    obj_value = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts()])
-    
-    print "{:>15} | {:>10} | {:>10}".format("", "trajopt", "computed")
-    print "{:>15} | {:>10}".format("COSTS", "-"*23)
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("joint_vel", joint_vel_cost, joint_vel_cost2)
-    if np.isscalar(collision_costs):
-        print "{:>15} | {:>10,.4} | {:>10}".format("collision(s)", collision_costs, "-")
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("pose(s)", pose_costs, pose_costs2)
-    print "{:>15} | {:>10,.4} | {:>10}".format("total_obj", obj_value, "-")
-    print ""
-
-    print "{:>15} | {:>10} | {:>10}".format("", "abs min", "abs max")
-    print "{:>15} | {:>10}".format("ERRORS", "-"*23)
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("joint_vel (deg)", np.rad2deg(np.abs(joint_vel_err).min()), np.rad2deg(np.abs(joint_vel_err).max()))
-    if np.isscalar(collision_costs):
-        print "{:>15} | {:>10,.4} | {:>10,.4}".format("collision(s)", np.abs(-collision_err).min(), np.abs(-collision_err).max())
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("rot pose(s)", np.abs(pose_err[:,1:4]).min(), np.abs(pose_err[:,1:4]).max())
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("trans pose(s)", np.abs(pose_err[:,4:7]).min(), np.abs(pose_err[:,4:7]).max())
-    print ""
+    if verbose:
+        collision_costs = [cost_val for (cost_type, cost_val) in result.GetCosts() if "collision" in cost_type]
+        cost_rows = [("joint_vel", cost_sums.get("joint_vel", 0), joint_vel_cost2)]
+        err_rows = [("joint_vel (deg)", np.rad2deg(np.diff(traj, axis=0)))]
+        if len(collision_costs) > 0:
+            cost_rows.append(("collision(s)", np.sum(collision_costs), None))
+            err_rows.append(("collision(s)", np.asarray(collision_costs)))
+        cost_rows.extend([("pose(s)", pose_costs, pose_costs2), ("total_obj", obj_value, None)])
+        err_rows.extend([("rot pose(s)", pose_err[:,1:4]), ("trans pose(s)", pose_err[:,4:7])])
+        print_costs_and_errors(cost_rows, err_rows)
 
     # make sure this function doesn't change state of the robot
     assert not np.any(orig_dof_inds - robot.GetActiveDOFIndices())
     assert not np.any(orig_dof_vals - robot.GetDOFValues())
     
+    if return_n_iters:
+        return traj, obj_value, pose_costs, get_n_sqp_iters(trajopt_stdout.output)
     return traj, obj_value, pose_costs
 
 def plan_follow_finger_pts_traj(robot, manip_name, flr2finger_link, flr2finger_rel_pts, flr2finger_pts_traj, old_traj, 
@@ -166,7 +290,11 @@ def plan_follow_finger_pts_traj(robot, manip_name, flr2finger_link, flr2finger_r
 
 def plan_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_names, flr2finger_rel_pts, flr2finger_pts_trajs, old_traj, 
                                 no_collision_cost_first=False, use_collision_cost=True, start_fixed=False, joint_vel_limits=None,
-                                beta_pos=settings.BETA_POS, gamma=settings.GAMMA):
+                                beta_pos=settings.BETA_POS, gamma=settings.GAMMA, 
+                                verbose=settings.PLANNING_VERBOSE, return_n_iters=False):
+    """
+    if return_n_iters is True, the number of SQP iterations of the optimization is also returned
+    """
     orig_dof_inds = robot.GetActiveDOFIndices()
     orig_dof_vals = robot.GetDOFValues()
     
@@ -181,7 +309,7 @@ def plan_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_names, flr2f
     if no_collision_cost_first:
         init_traj, _ = plan_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_names, flr2finger_rel_pts, flr2finger_pts_trajs, old_traj, 
                                                    no_collision_cost_first=False, use_collision_cost=False, start_fixed=start_fixed, joint_vel_limits=joint_vel_limits,
-                                                   beta_pos = beta_pos, gamma = gamma)
+                                                   beta_pos = beta_pos, gamma = gamma, verbose = verbose)
     else:
         init_traj = old_traj.copy()
 
@@ -190,126 +318,61 @@ def plan_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_names, flr2f
         sim_util.unwrap_in_place(init_traj, dof_inds)
         init_traj += robot.GetDOFValues(dof_inds) - init_traj[0,:]
 
-    request = {
-        "basic_info" : {
-            "n_steps" : n_steps,
-            "manip" : manip_name,
-            "start_fixed" : start_fixed
-        },
-        "costs" : [
-        {
-            "type" : "joint_vel",
-            "params": {"coeffs" : [gamma/(n_steps-1)]}
-        },            
-        ],
-        "constraints" : [
-        ],
-        "init_info" : {
-            "type":"given_traj",
-            "data":[x.tolist() for x in init_traj]
-        }
-    }
-    
-    if use_collision_cost:
-        request["costs"].append(
-            {
-                "type" : "collision",
-                "params" : {
-                  "continuous" : True,
-                  "coeffs" : [1000],  # penalty coefficients. list of length one is automatically expanded to a list of length n_timesteps
-                  "dist_pen" : [0.025]  # robot-obstacle distance that penalty kicks in. expands to length n_timesteps
-                }
-            })
+    request = RequestBuilder(get_request_template(manip_name, n_steps, start_fixed, gamma, use_collision_cost, joint_vel_limits))
+    request.set_init_traj(init_traj)
     
-    if joint_vel_limits is not None:
-        request["constraints"].append(
-             {
-                "type" : "joint_vel_limits",
-                "params": {"vals" : joint_vel_limits,
-                           "first_step" : 0,
-                           "last_step" : n_steps-1
-                           }
-              })
-
+    timesteps = np.arange(1 if start_fixed else 0, n_steps)
     for (flr2finger_link_name, flr2finger_pts_traj) in zip(flr2finger_link_names, flr2finger_pts_trajs):
         for finger_lr, finger_link_name in flr2finger_link_name.items():
             finger_rel_pts = flr2finger_rel_pts[finger_lr]
-            finger_pts_traj = flr2finger_pts_traj[finger_lr]
-            for (i_step, finger_pts) in enumerate(finger_pts_traj):
-                if start_fixed and i_step == 0:
-                    continue
-                request["costs"].append(
-                    {"type":"rel_pts",
-                     "params":{
-                        "xyzs":finger_pts.tolist(),
-                        "rel_xyzs":finger_rel_pts.tolist(),
-                        "link":finger_link_name,
-                        "timestep":i_step,
-                        "pos_coeffs":[np.sqrt(beta_pos/n_steps)]*4, # there is a coefficient for each of the 4 points
-                     }
-                    })
-
-    s = json.dumps(request)
+            finger_pts_traj = np.asarray(flr2finger_pts_traj[finger_lr])
+            request.add_timestep_costs("rel_pts", timesteps, 
+                                       {"rel_xyzs":finger_rel_pts,
+                                        "link":finger_link_name,
+                                        "pos_coeffs":[np.sqrt(beta_pos/n_steps)]*4}, # there is a coefficient for each of the 4 points
+                                       {"xyzs":finger_pts_traj[timesteps]})
+
+    s = request.get_json()
     with openravepy.RobotStateSaver(robot):
-        with util.suppress_stdout():
+        with util.capture_stdout() as trajopt_stdout:
             prob = trajoptpy.ConstructProblem(s, robot.GetEnv()) # create object that stores optimization problem
             result = trajoptpy.OptimizeProblem(prob) # do optimization
 
     traj = result.GetTraj() 
-
-
-    rel_pts_costs = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts() if cost_type == "rel_pts"])
-    rel_pts_err = []
-    with openravepy.RobotStateSaver(robot):
+    cost_sums = get_cost_sums(result)
+    rel_pts_costs = cost_sums.get("rel_pts", 0)
+    obj_value = np.sum(cost_sums.values())
+
+    if verbose:
+        link_trajs = get_link_trajs(robot, dof_inds, traj, [link_name for flr2finger_link_name in flr2finger_link_names 
+                                                            for link_name in flr2finger_link_name.values()])
+        rel_pts_err = []
         for (flr2finger_link_name, flr2finger_pts_traj) in zip(flr2finger_link_names, flr2finger_pts_trajs):
             for finger_lr, finger_link_name in flr2finger_link_name.items():
-                finger_link = robot.GetLink(finger_link_name)
-                finger_rel_pts = flr2finger_rel_pts[finger_lr]
-                finger_pts_traj = flr2finger_pts_traj[finger_lr]
-                for (i_step, finger_pts) in enumerate(finger_pts_traj):
-                    if start_fixed and i_step == 0:
-                        continue
-                    robot.SetDOFValues(traj[i_step], dof_inds)
-                    new_hmat = finger_link.GetTransform()
-                    rel_pts_err.append(finger_pts - (new_hmat[:3,3][None,:] + finger_rel_pts.dot(new_hmat[:3,:3].T)))
-    rel_pts_err = np.concatenate(rel_pts_err, axis=0)
-    rel_pts_costs2 = (beta_pos/n_steps) * np.square(rel_pts_err).sum() # TODO don't square n_steps
-
-    joint_vel_cost = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts() if cost_type == "joint_vel"])
-    joint_vel_err = np.diff(traj, axis=0)
-    joint_vel_cost2 = (gamma/(n_steps-1)) * np.square(joint_vel_err).sum()
+                rel_pts_err.append(get_rel_pts_err(np.asarray(flr2finger_pts_traj[finger_lr])[timesteps], flr2finger_rel_pts[finger_lr], 
+                                                   link_trajs[finger_link_name][timesteps]).reshape((-1,3)))
+        rel_pts_err = np.concatenate(rel_pts_err, axis=0)
+        rel_pts_costs2 = (beta_pos/n_steps) * np.square(rel_pts_err).sum() # TODO don't square n_steps
+        joint_vel_cost2 = (gamma/(n_steps-1)) * np.square(np.diff(traj, axis=0)).sum()
     sim_util.unwrap_in_place(traj, dof_inds)
-    joint_vel_err = np.diff(traj, axis=0)
-
-    collision_costs = [cost_val for (cost_type, cost_val) in result.GetCosts() if "collision" in cost_type]
-    if len(collision_costs) > 0:
-        collision_err = np.asarray(collision_costs)
-        collision_costs = np.sum(collision_costs)
 
-    obj_value = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts()])
-    
-    print "{:>15} | {:>10} | {:>10}".format("", "trajopt", "computed")
-    print "{:>15} | {:>10}".format("COSTS", "-"*23)
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("joint_vel", joint_vel_cost, joint_vel_cost2)
-    if np.isscalar(collision_costs):
-        print "{:>15} | {:>10,.4} | {:>10}".format("collision(s)", collision_costs, "-")
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("rel_pts(s)", rel_pts_costs, rel_pts_costs2)
-    print "{:>15} | {:>10,.4} | {:>10}".format("total_obj", obj_value, "-")
-    print ""
-
-    print "{:>15} | {:>10} | {:>10}".format("", "abs min", "abs max")
-    print "{:>15} | {:>10}".format("ERRORS", "-"*23)
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("joint_vel (deg)", np.rad2deg(np.abs(joint_vel_err).min()), np.rad2deg(np.abs(joint_vel_err).max()))
-    if np.isscalar(collision_costs):
-        print "{:>15} | {:>10,.4} | {:>10,.4}".format("collision(s)", np.abs(-collision_err).min(), np.abs(-collision_err).max())
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("rel_pts(s)", np.abs(rel_pts_err).min(), np.abs(rel_pts_err).max())
-    print ""
+    if verbose:
+        collision_costs = [cost_val for (cost_type, cost_val) in result.GetCosts() if "collision" in cost_type]
+        cost_rows = [("joint_vel", cost_sums.get("joint_vel", 0), joint_vel_cost2)]
+        err_rows = [("joint_vel (deg)", np.rad2deg(np.diff(traj, axis=0)))]
+        if len(collision_costs) > 0:
+            cost_rows.append(("collision(s)", np.sum(collision_costs), None))
+            err_rows.append(("collision(s)", np.asarray(collision_costs)))
+        cost_rows.extend([("rel_pts(s)", rel_pts_costs, rel_pts_costs2), ("total_obj", obj_value, None)])
+        err_rows.append(("rel_pts(s)", rel_pts_err))
+        print_costs_and_errors(cost_rows, err_rows)
 
     # make sure this function doesn't change state of the robot
     assert not np.any(orig_dof_inds - robot.GetActiveDOFIndices())
     assert not np.any(orig_dof_vals - robot.GetDOFValues())
     
-    obj_value = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts()])
+    if return_n_iters:
+        return traj, obj_value, rel_pts_costs, get_n_sqp_iters(trajopt_stdout.output)
     return traj, obj_value, rel_pts_costs
 
 def joint_fit_tps_follow_finger_pts_traj(robot, manip_name, flr2finger_link, flr2finger_rel_pts, flr2finger_pts_traj, old_traj, 
@@ -324,7 +387,8 @@ def joint_fit_tps_follow_finger_pts_traj(robot, manip_name, flr2finger_link, flr
 def joint_fit_tps_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_names, flr2finger_rel_pts, flr2old_finger_pts_trajs, old_traj, 
                                          f, closing_pts=None,
                                          no_collision_cost_first=False, use_collision_cost=True, start_fixed=False, joint_vel_limits=None,
-                                          alpha=settings.ALPHA, beta_pos=settings.BETA_POS, gamma=settings.GAMMA):
+                                          alpha=settings.ALPHA, beta_pos=settings.BETA_POS, gamma=settings.GAMMA, 
+                                          verbose=settings.PLANNING_VERBOSE):
     orig_dof_inds = robot.GetActiveDOFIndices()
     orig_dof_vals = robot.GetDOFValues()
     
@@ -353,7 +417,7 @@ def joint_fit_tps_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_nam
         init_traj, _, (N, init_z) , _, _ = joint_fit_tps_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_names, flr2finger_rel_pts, flr2old_finger_pts_trajs, old_traj, 
                                                                                  f, closing_pts=closing_pts, 
                                                                                  no_collision_cost_first=False, use_collision_cost=False, start_fixed=start_fixed, joint_vel_limits=joint_vel_limits, 
-                                                                                 alpha=alpha, beta_pos=beta_pos, gamma=gamma)
+                                                                                 alpha=alpha, beta_pos=beta_pos, gamma=gamma, verbose=verbose)
     else:
         init_traj = old_traj.copy()
         N = f.N
@@ -364,93 +428,46 @@ def joint_fit_tps_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_nam
         sim_util.unwrap_in_place(init_traj, dof_inds)
         init_traj += robot.GetDOFValues(dof_inds) - init_traj[0,:]
 
-    request = {
-        "basic_info" : {
-            "n_steps" : n_steps,
-            "m_ext" : n, 
-            "n_ext" : d,
-            "manip" : manip_name,
-            "start_fixed" : start_fixed
-        },
-        "costs" : [
-        {
-            "type" : "joint_vel",
-            "params": {"coeffs" : [gamma/(n_steps-1)]}
-        },
-        {
+    request = RequestBuilder(get_request_template(manip_name, n_steps, start_fixed, gamma, use_collision_cost, joint_vel_limits, 
+                                                  m_ext=n, n_ext=d))
+    request.set_init_traj(init_traj, init_ext=init_z)
+    request.add_cost({
             "type" : "tps",
             "name" : "tps",
-            "params" : {"x_na" : [row.tolist() for row in f.x_na],
-                        "y_ng" : [row.tolist() for row in f.y_ng],
-                        "bend_coefs" : bend_coefs.tolist(),
-                        "rot_coefs" : rot_coefs.tolist(),
-                        "wt_n" : [row.tolist() for row in wt_n],
-                        "N" : [row.tolist() for row in N],
+            "params" : {"x_na" : f.x_na,
+                        "y_ng" : f.y_ng,
+                        "bend_coefs" : bend_coefs,
+                        "rot_coefs" : rot_coefs,
+                        "wt_n" : wt_n,
+                        "N" : N,
                         "alpha" : alpha,
             }
-        }
-        ],
-        "constraints" : [
-        ],
-        "init_info" : {
-            "type":"given_traj",
-            "data":[x.tolist() for x in init_traj],
-            "data_ext":[row.tolist() for row in init_z]
-        }
-    }
-    
-    if use_collision_cost:
-        request["costs"].append(
-            {
-                "type" : "collision",
-                "params" : {
-                  "continuous" : True,
-                  "coeffs" : [1000],  # penalty coefficients. list of length one is automatically expanded to a list of length n_timesteps
-                  "dist_pen" : [0.025]  # robot-obstacle distance that penalty kicks in. expands to length n_timesteps
-                }
-            })
-    
-    if joint_vel_limits is not None:
-        request["constraints"].append(
-             {
-                "type" : "joint_vel_limits",
-                "params": {"vals" : joint_vel_limits,
-                           "first_step" : 0,
-                           "last_step" : n_steps-1
-                           }
-              })
+        })
 
     if closing_pts is not None:
-        request["costs"].append(
+        request.add_cost(
             {
                 "type":"tps_jac_orth",
                 "params":  {
                             "tps_cost_name":"tps",
-                            "pts":closing_pts.tolist(),
+                            "pts":closing_pts,
                             "coeffs":[10.0]*len(closing_pts),
                             }
             })
     
+    timesteps = np.arange(1 if start_fixed else 0, n_steps)
     for (flr2finger_link_name, flr2old_finger_pts_traj) in zip(flr2finger_link_names, flr2old_finger_pts_trajs):
         for finger_lr, finger_link_name in flr2finger_link_name.items():
             finger_rel_pts = flr2finger_rel_pts[finger_lr]
-            old_finger_pts_traj = flr2old_finger_pts_traj[finger_lr]
-            for (i_step, old_finger_pts) in enumerate(old_finger_pts_traj):
-                if start_fixed and i_step == 0:
-                    continue
-                request["costs"].append(
-                    {"type":"tps_rel_pts",
-                     "params":{
-                        "tps_cost_name":"tps",
-                        "src_xyzs":old_finger_pts.tolist(),
-                        "rel_xyzs":finger_rel_pts.tolist(),
-                        "link":finger_link_name,
-                        "timestep":i_step,
-                        "pos_coeffs":[np.sqrt(beta_pos/n_steps)]*4,
-                     }
-                    })
-
-    s = json.dumps(request)
+            old_finger_pts_traj = np.asarray(flr2old_finger_pts_traj[finger_lr])
+            request.add_timestep_costs("tps_rel_pts", timesteps, 
+                                       {"tps_cost_name":"tps",
+                                        "rel_xyzs":finger_rel_pts,
+                                        "link":finger_link_name,
+                                        "pos_coeffs":[np.sqrt(beta_pos/n_steps)]*4}, 
+                                       {"src_xyzs":old_finger_pts_traj[timesteps]})
+
+    s = request.get_json()
     with openravepy.RobotStateSaver(robot):
         with util.suppress_stdout():
             prob = trajoptpy.ConstructProblem(s, robot.GetEnv()) # create object that stores optimization problem
@@ -463,72 +480,45 @@ def joint_fit_tps_follow_finger_pts_trajs(robot, manip_name, flr2finger_link_nam
     f.lin_ag = theta[1:d+1,:]
     f.w_ng = theta[d+1:]
     
-    tps_rel_pts_costs = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts() if cost_type == "tps_rel_pts"])
-    tps_rel_pts_err = []
-    with openravepy.RobotStateSaver(robot):
+    tps_cost_sums = get_cost_sums(result)
+    tps_rel_pts_costs = tps_cost_sums.get("tps_rel_pts", 0)
+    tps_cost = tps_cost_sums.get("tps", 0)
+    obj_value = np.sum(tps_cost_sums.values())
+
+    if verbose:
+        link_trajs = get_link_trajs(robot, dof_inds, traj, [link_name for flr2finger_link_name in flr2finger_link_names 
+                                                            for link_name in flr2finger_link_name.values()])
+        tps_rel_pts_err = []
         for (flr2finger_link_name, flr2old_finger_pts_traj) in zip(flr2finger_link_names, flr2old_finger_pts_trajs):
             for finger_lr, finger_link_name in flr2finger_link_name.items():
-                finger_link = robot.GetLink(finger_link_name)
-                finger_rel_pts = flr2finger_rel_pts[finger_lr]
-                old_finger_pts_traj = flr2old_finger_pts_traj[finger_lr]
-                for (i_step, old_finger_pts) in enumerate(old_finger_pts_traj):
-                    if start_fixed and i_step == 0:
-                        continue
-                    robot.SetDOFValues(traj[i_step], dof_inds)
-                    new_hmat = finger_link.GetTransform()
-                    tps_rel_pts_err.append(f.transform_points(old_finger_pts) - (new_hmat[:3,3][None,:] + finger_rel_pts.dot(new_hmat[:3,:3].T)))
-    tps_rel_pts_err = np.concatenate(tps_rel_pts_err, axis=0)
-    tps_rel_pts_costs2 = (beta_pos/n_steps) * np.square(tps_rel_pts_err).sum() # TODO don't square n_steps
-
-    tps_cost = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts() if cost_type == "tps"])
-    tps_cost2 = alpha * f.get_objective().sum()
-    matching_err = f.transform_points(f.x_na) - f.y_ng
-    
-    joint_vel_cost = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts() if cost_type == "joint_vel"])
-    joint_vel_err = np.diff(traj, axis=0)
-    joint_vel_cost2 = (gamma/(n_steps-1)) * np.square(joint_vel_err).sum()
+                old_finger_pts_traj = np.asarray(flr2old_finger_pts_traj[finger_lr])[timesteps]
+                finger_pts_traj = f.transform_points(old_finger_pts_traj.reshape((-1,3))).reshape(old_finger_pts_traj.shape)
+                tps_rel_pts_err.append(get_rel_pts_err(finger_pts_traj, flr2finger_rel_pts[finger_lr], 
+                                                       link_trajs[finger_link_name][timesteps]).reshape((-1,3)))
+        tps_rel_pts_err = np.concatenate(tps_rel_pts_err, axis=0)
+        tps_rel_pts_costs2 = (beta_pos/n_steps) * np.square(tps_rel_pts_err).sum() # TODO don't square n_steps
+        tps_cost2 = alpha * f.get_objective().sum()
+        matching_err = f.transform_points(f.x_na) - f.y_ng
+        joint_vel_cost2 = (gamma/(n_steps-1)) * np.square(np.diff(traj, axis=0)).sum()
     sim_util.unwrap_in_place(traj, dof_inds)
-    joint_vel_err = np.diff(traj, axis=0)
-
-    collision_costs = [cost_val for (cost_type, cost_val) in result.GetCosts() if "collision" in cost_type]
-    if len(collision_costs) > 0:
-        collision_err = np.asarray(collision_costs)
-        collision_costs = np.sum(collision_costs)
-
-    tps_jac_orth_cost = [cost_val for (cost_type, cost_val) in result.GetCosts() if "tps_jac_orth" in cost_type]
-    if len(tps_jac_orth_cost) > 0:
-        tps_jac_orth_cost = np.sum(tps_jac_orth_cost)
-        f_jacs = f.compute_jacobian(closing_pts)
-        tps_jac_orth_err = []
-        for jac in f_jacs:
-            tps_jac_orth_err.extend((jac.dot(jac.T) - np.eye(3)).flatten())
-        tps_jac_orth_err = np.asarray(tps_jac_orth_err)
-        tps_jac_orth_cost2 = np.square( 10.0 * tps_jac_orth_err ).sum()
-
-    obj_value = np.sum([cost_val for (cost_type, cost_val) in result.GetCosts()])
-    
-    print "{:>15} | {:>10} | {:>10}".format("", "trajopt", "computed")
-    print "{:>15} | {:>10}".format("COSTS", "-"*23)
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("joint_vel", joint_vel_cost, joint_vel_cost2)
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("tps", tps_cost, tps_cost2)
-    if np.isscalar(collision_costs):
-        print "{:>15} | {:>10,.4} | {:>10}".format("collision(s)", collision_costs, "-")
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("tps_rel_pts(s)", tps_rel_pts_costs, tps_rel_pts_costs2)
-    if np.isscalar(tps_jac_orth_cost):
-        print "{:>15} | {:>10,.4} | {:>10,.4}".format("tps_jac_orth", tps_jac_orth_cost, tps_jac_orth_cost2)
-    print "{:>15} | {:>10,.4} | {:>10}".format("total_obj", obj_value, "-")
-    print ""
 
-    print "{:>15} | {:>10} | {:>10}".format("", "abs min", "abs max")
-    print "{:>15} | {:>10}".format("ERRORS", "-"*23)
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("joint_vel (deg)", np.rad2deg(np.abs(joint_vel_err).min()), np.rad2deg(np.abs(joint_vel_err).max()))
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("tps (matching)", np.abs(matching_err).min(), np.abs(matching_err).max())
-    if np.isscalar(collision_costs):
-        print "{:>15} | {:>10,.4} | {:>10,.4}".format("collision(s)", np.abs(-collision_err).min(), np.abs(-collision_err).max())
-    print "{:>15} | {:>10,.4} | {:>10,.4}".format("tps_rel_pts(s)", np.abs(tps_rel_pts_err).min(), np.abs(tps_rel_pts_err).max())
-    if np.isscalar(tps_jac_orth_cost):
-        print "{:>15} | {:>10,.4} | {:>10,.4}".format("tps_jac_orth", np.abs(tps_jac_orth_err).min(), np.abs(tps_jac_orth_err).max())
-    print ""
+    if verbose:
+        collision_costs = [cost_val for (cost_type, cost_val) in result.GetCosts() if "collision" in cost_type]
+        cost_rows = [("joint_vel", tps_cost_sums.get("joint_vel", 0), joint_vel_cost2), ("tps", tps_cost, tps_cost2)]
+        err_rows = [("joint_vel (deg)", np.rad2deg(np.diff(traj, axis=0))), ("tps (matching)", matching_err)]
+        if len(collision_costs) > 0:
+            cost_rows.append(("collision(s)", np.sum(collision_costs), None))
+            err_rows.append(("collision(s)", np.asarray(collision_costs)))
+        cost_rows.append(("tps_rel_pts(s)", tps_rel_pts_costs, tps_rel_pts_costs2))
+        err_rows.append(("tps_rel_pts(s)", tps_rel_pts_err))
+        if "tps_jac_orth" in tps_cost_sums:
+            f_jacs = f.compute_jacobian(closing_pts)
+            tps_jac_orth_err = (np.einsum('nij,nkj->nik', f_jacs, f_jacs) - np.eye(3)).flatten()
+            tps_jac_orth_cost2 = np.square( 10.0 * tps_jac_orth_err ).sum()
+            cost_rows.append(("tps_jac_orth", tps_cost_sums["tps_jac_orth"], tps_jac_orth_cost2))
+            err_rows.append(("tps_jac_orth", tps_jac_orth_err))
+        cost_rows.append(("total_obj", obj_value, None))
+        print_costs_and_errors(cost_rows, err_rows)
 
     # make sure this function doesn't change state of the robot
     assert not np.any(orig_dof_inds - robot.GetActiveDOFIndices())
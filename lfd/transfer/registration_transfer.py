@@ -2,9 +2,12 @@ from __future__ import division
 
 import settings
 import numpy as np
+import multiprocessing
+import Queue
+import traceback
 from lfd.demonstration import demonstration
 from lfd.environment import sim_util
-from lfd.registration import registration
+from lfd.registration import registration, solver
 from lfd.transfer import transfer
 from lfd.transfer import planning
 
@@ -25,6 +28,82 @@ class RegistrationAndTrajectoryTransferer(object):
         """
         raise NotImplementedError
 
+    def supports_speculative_transfer(self):
+        """Returns whether speculative_transfer can be used, i.e. whether the registrations don't use the GPU
+        
+        A forked worker can't use the CUDA context of its parent process.
+        """
+        for solver_factory_name in ['f_solver_factory', 'g_solver_factory']:
+            if isinstance(getattr(self.registration_factory, solver_factory_name, None), solver.GpuTpsSolverFactory):
+                return False
+        batch_ctx = getattr(self.registration_factory, 'batch_ctx', None)
+        if batch_ctx is not None and batch_ctx.use_gpu:
+            return False
+        return True
+
+    def speculative_transfer(self, demos, test_scene_state, lfd_env, timeout=settings.SPECULATIVE_TIMEOUT):
+        """Transfers the demonstrations concurrently, each one in a forked worker process, and checks the 
+        feasibility of the transferred trajectories in the workers' copies of lfd_env
+        
+        The workers are started in the order of demos and, as soon as the results up to the first feasible 
+        one are in, the remaining workers are terminated. The simulation of lfd_env is not modified.
+        
+        Args:
+            demos: list of Demonstrations in agenda order
+            test_scene_state: SceneState of the test scene
+            lfd_env: LfdEnvironment whose simulation is in the test scene state
+            timeout: seconds to wait for a worker before its transfer is considered failed
+        
+        Returns:
+            A list with a (aug_traj, feasible, misgrasp) tuple for each demonstration up to the first feasible 
+            one (or all of them if none is). aug_traj is None if the worker failed, in which case the 
+            demonstration should be transferred again in this process.
+        """
+        if not self.supports_speculative_transfer():
+            raise RuntimeError("speculative transfer can't be used with GPU registrations")
+        q = multiprocessing.Queue()
+        procs = []
+        for i, demo in enumerate(demos):
+            proc = multiprocessing.Process(target=_speculative_transfer_worker, args=(q, i, self, demo, test_scene_state, lfd_env))
+            proc.start()
+            procs.append(proc)
+        
+        i2result = {}
+        results = []
+        try:
+            while len(results) < len(demos):
+                i = len(results)
+                if i in i2result:
+                    results.append(i2result[i])
+                    if results[-1][1]: # feasible
+                        break
+                    continue
+                try:
+                    i_done, result = q.get(True, timeout)
+                    i2result[i_done] = result
+                except Queue.Empty:
+                    print "speculative transfer of %s timed out" % demos[i].name
+                    i2result[i] = (None, False, False)
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+        return results
+
+def _speculative_transfer_worker(q, i, reg_and_traj_transferer, demo, test_scene_state, lfd_env):
+    try:
+        aug_traj = reg_and_traj_transferer.transfer(demo, test_scene_state, plotting=False)
+        # the feasibility doesn't change after the first infeasible mini-segment, so execution stops there
+        feasible, misgrasp = lfd_env.execute_augmented_trajectory(aug_traj, step_viewer=0, check_feasible=True)
+        result = (aug_traj, feasible, misgrasp)
+    except Exception:
+        traceback.print_exc()
+        result = (None, False, False)
+    q.put((i, result))
+    q.close()
+    q.join_thread()
+
 class TwoStepRegistrationAndTrajectoryTransferer(RegistrationAndTrajectoryTransferer):
     def transfer(self, demo, test_scene_state, callback=None, plotting=False):
         reg = self.registration_factory.register(demo, test_scene_state, callback=callback)
@@ -63,18 +142,18 @@ class UnifiedRegistrationAndTrajectoryTransferer(RegistrationAndTrajectoryTransf
             handles.append(self.sim.env.plot3(test_cloud[:,:3], 2, test_color if test_color is not None else (0,0,1)))
             self.sim.viewer.Step()
         
-        active_lr = ""
-        for lr in 'lr':
-            if lr in demo.aug_traj.lr2arm_traj and sim_util.arm_moved(demo.aug_traj.lr2arm_traj[lr]):
-                active_lr += lr
-        _, timesteps_rs = sim_util.unif_resample(np.c_[(1./settings.JOINT_LENGTH_PER_STEP) * np.concatenate([demo.aug_traj.lr2arm_traj[lr] for lr in active_lr], axis=1), 
-                                                       (1./settings.FINGER_CLOSE_RATE) * np.concatenate([demo.aug_traj.lr2finger_traj[lr] for lr in active_lr], axis=1)], 
-                                                 1.)
-        demo_aug_traj_rs = demo.aug_traj.get_resampled_traj(timesteps_rs)
+        active_lr = demo.get_active_lr()
+        timesteps_rs, demo_aug_traj_rs = demo.get_resampled_traj(settings.JOINT_LENGTH_PER_STEP, settings.FINGER_CLOSE_RATE)
 
         if self.init_trajectory_transferer:
             warm_init_traj = self.init_trajectory_transferer.transfer(reg, demo, plotting=plotting)
         
+        # warp the finger points trajectories of all the active grippers (and the end-effector trajectories to 
+        # plot them) at once
+        lr2flr2demo_finger_pts_traj_rs = dict((lr, demo.get_resampled_finger_pts_traj(self.sim.robot, lr, settings.JOINT_LENGTH_PER_STEP, settings.FINGER_CLOSE_RATE)) for lr in active_lr)
+        name2transformed = reg.f.warp(name2pts=dict(((lr, finger_lr), lr2flr2demo_finger_pts_traj_rs[lr][finger_lr]) for lr in active_lr for finger_lr in 'lr'), 
+                                      name2hmats=dict(((lr, 'ee'), demo_aug_traj_rs.lr2ee_traj[lr]) for lr in active_lr) if plotting else None)
+
         manip_name = ""
         flr2finger_link_names = []
         flr2demo_finger_pts_trajs_rs = []
@@ -95,18 +174,17 @@ class UnifiedRegistrationAndTrajectoryTransferer(RegistrationAndTrajectoryTransf
             if plotting:
                 handles.append(self.sim.env.drawlinestrip(demo.aug_traj.lr2ee_traj[lr][:,:3,3], 2, (1,0,0)))
                 handles.append(self.sim.env.drawlinestrip(demo_aug_traj_rs.lr2ee_traj[lr][:,:3,3], 2, (1,1,0)))
-                transformed_ee_traj_rs = reg.f.transform_hmats(demo_aug_traj_rs.lr2ee_traj[lr])
-                handles.append(self.sim.env.drawlinestrip(transformed_ee_traj_rs[:,:3,3], 2, (0,1,0)))
+                handles.append(self.sim.env.drawlinestrip(name2transformed[(lr, 'ee')][:,:3,3], 2, (0,1,0)))
                 self.sim.viewer.Step()
 
-            flr2demo_finger_pts_traj_rs = sim_util.get_finger_pts_traj(self.sim.robot, lr, (demo_aug_traj_rs.lr2ee_traj[lr], demo_aug_traj_rs.lr2finger_traj[lr]))
+            flr2demo_finger_pts_traj_rs = lr2flr2demo_finger_pts_traj_rs[lr]
             flr2demo_finger_pts_trajs_rs.append(flr2demo_finger_pts_traj_rs)
             
             flr2transformed_finger_pts_traj_rs = {}
             flr2finger_link_name = {}
             flr2finger_rel_pts = {}
             for finger_lr in 'lr':
-                flr2transformed_finger_pts_traj_rs[finger_lr] = reg.f.transform_points(np.concatenate(flr2demo_finger_pts_traj_rs[finger_lr], axis=0)).reshape((-1,4,3))
+                flr2transformed_finger_pts_traj_rs[finger_lr] = name2transformed[(lr, finger_lr)]
                 flr2finger_link_name[finger_lr] = "%s_gripper_%s_finger_tip_link"%(lr,finger_lr)
                 flr2finger_rel_pts[finger_lr] = sim_util.get_finger_rel_pts(finger_lr)
             flr2finger_link_names.append(flr2finger_link_name)
@@ -13,6 +13,15 @@ BETA_ROT = 100.0
 GAMMA = 1000.0
 #: whether to use collision cost in trajectory optimization
 USE_COLLISION_COST = True
+#: maximum rms distance (in meters) between the warped demonstration trajectory of a new transfer and one in the 
+#: trajectory library for the library's solution to be used to initialize the trajectory optimization
+TRAJ_LIBRARY_MAX_DIST = .05
+#: maximum number of trajectories kept per demonstration in the trajectory library
+TRAJ_LIBRARY_SIZE     = 20
+#: if True, the planning functions print tables comparing the trajopt costs with the recomputed ones, and the errors
+PLANNING_VERBOSE = False
+#: seconds to wait for a worker of a speculative transfer before its transfer is considered failed
+SPECULATIVE_TIMEOUT = 600
 
 try:
 	from lfd_settings.transfer.settings import *
@@ -1,17 +1,58 @@
 from __future__ import division
 
+import time
 import settings
 import numpy as np
 from lfd.demonstration import demonstration
 from lfd.environment import sim_util
 from lfd.transfer import planning
 
+class TrajectoryLibrary(object):
+    def __init__(self, max_dist=settings.TRAJ_LIBRARY_MAX_DIST, max_size=settings.TRAJ_LIBRARY_SIZE):
+        """Inits TrajectoryLibrary
+        
+        The library stores the trajectories solved by previous transfers of each demonstration, together with a 
+        descriptor of the registration warp: the warped positions that the trajectory optimization follows.
+        
+        Args:
+            max_dist: a stored trajectory is only returned if the rms distance between its descriptor and the queried one is below max_dist
+            max_size: maximum number of trajectories stored per demonstration. The oldest ones are dropped first
+        """
+        self.max_dist = max_dist
+        self.max_size = max_size
+        self.demo2entries = {}
+        self.n_queries = 0
+        self.n_hits = 0
+    
+    def add(self, demo_name, descriptor, traj):
+        entries = self.demo2entries.setdefault(demo_name, [])
+        entries.append((np.asarray(descriptor).copy(), traj.copy()))
+        if len(entries) > self.max_size:
+            entries.pop(0)
+    
+    def query(self, demo_name, descriptor):
+        """Returns the stored trajectory whose descriptor is nearest to descriptor, or None if there is none within max_dist"""
+        self.n_queries += 1
+        descriptor = np.asarray(descriptor)
+        best_dist, best_traj = self.max_dist, None
+        for (entry_descriptor, traj) in self.demo2entries.get(demo_name, []):
+            if entry_descriptor.shape != descriptor.shape:
+                continue
+            dist = np.sqrt(np.square(entry_descriptor - descriptor).sum(axis=-1).mean())
+            if dist < best_dist:
+                best_dist, best_traj = dist, traj
+        if best_traj is not None:
+            self.n_hits += 1
+            return best_traj.copy()
+        return None
+
 class TrajectoryTransferer(object):
     def __init__(self, sim, 
                  beta_pos=settings.BETA_POS, 
                  gamma=settings.GAMMA, 
                  use_collision_cost=settings.USE_COLLISION_COST, 
-                 init_trajectory_transferer=None):
+                 init_trajectory_transferer=None, 
+                 traj_library=None):
         """Inits TrajectoryTransferer
         
         Args:
@@ -20,12 +61,14 @@ class TrajectoryTransferer(object):
             gamma: penalty coefficient for joint velocities
             use_collision_cost: if False, collisions are ignored
             init_trajectory_transferer: TrajectoryTransferer used to get a trajectory for initializing the optimization
+            traj_library: TrajectoryLibrary of previously solved trajectories. If there is one for a similar warp of the same demonstration, it is used for initializing the optimization instead
         """
         self.sim = sim
         self.beta_pos = beta_pos
         self.gamma = gamma
         self.use_collision_cost = use_collision_cost
         self.init_trajectory_transferer = init_trajectory_transferer
+        self.traj_library = traj_library
     
     def transfer(self, reg, demo, plotting=False):
         """Transfers demonstration trajectory using the given registration
@@ -50,8 +93,9 @@ class PoseTrajectoryTransferer(TrajectoryTransferer):
                  beta_rot=settings.BETA_ROT, 
                  gamma=settings.GAMMA, 
                  use_collision_cost=settings.USE_COLLISION_COST, 
-                 init_trajectory_transferer=None):
-        super(PoseTrajectoryTransferer, self).__init__(sim, beta_pos, gamma, use_collision_cost, init_trajectory_transferer=init_trajectory_transferer)
+                 init_trajectory_transferer=None, 
+                 traj_library=None):
+        super(PoseTrajectoryTransferer, self).__init__(sim, beta_pos, gamma, use_collision_cost, init_trajectory_transferer=init_trajectory_transferer, traj_library=traj_library)
         self.beta_rot = beta_rot
         
     def transfer(self, reg, demo, plotting=False):
@@ -65,17 +109,11 @@ class PoseTrajectoryTransferer(TrajectoryTransferer):
             handles.append(self.sim.env.plot3(test_cloud[:,:3], 2, test_color if test_color is not None else (0,0,1)))
             self.sim.viewer.Step()
         
-        active_lr = ""
-        for lr in 'lr':
-            if lr in demo.aug_traj.lr2arm_traj and sim_util.arm_moved(demo.aug_traj.lr2arm_traj[lr]):
-                active_lr += lr
-        _, timesteps_rs = sim_util.unif_resample(np.c_[(1./settings.JOINT_LENGTH_PER_STEP) * np.concatenate([demo.aug_traj.lr2arm_traj[lr] for lr in active_lr], axis=1), 
-                                                       (1./settings.FINGER_CLOSE_RATE) * np.concatenate([demo.aug_traj.lr2finger_traj[lr] for lr in active_lr], axis=1)], 
-                                                 1.)
-        demo_aug_traj_rs = demo.aug_traj.get_resampled_traj(timesteps_rs)
+        active_lr = demo.get_active_lr()
+        timesteps_rs, demo_aug_traj_rs = demo.get_resampled_traj(settings.JOINT_LENGTH_PER_STEP, settings.FINGER_CLOSE_RATE)
 
-        if self.init_trajectory_transferer:
-            warm_init_traj = self.init_trajectory_transferer.transfer(reg, demo, plotting=plotting)
+        # warp the end-effector trajectories of all the active arms at once
+        lr2transformed_ee_traj_rs = reg.f.warp(name2hmats=dict((lr, demo_aug_traj_rs.lr2ee_traj[lr]) for lr in active_lr))
 
         manip_name = ""
         ee_link_names = []
@@ -90,12 +128,9 @@ class PoseTrajectoryTransferer(TrajectoryTransferer):
             manip_name += arm_name
             ee_link_names.append(ee_link_name)
             
-            if self.init_trajectory_transferer:
-                init_traj = np.c_[init_traj, warm_init_traj.lr2arm_traj[lr]]
-            else:
-                init_traj = np.c_[init_traj, demo_aug_traj_rs.lr2arm_traj[lr]]
+            init_traj = np.c_[init_traj, demo_aug_traj_rs.lr2arm_traj[lr]]
             
-            transformed_ee_traj_rs = reg.f.transform_hmats(demo_aug_traj_rs.lr2ee_traj[lr])
+            transformed_ee_traj_rs = lr2transformed_ee_traj_rs[lr]
             transformed_ee_trajs_rs.append(transformed_ee_traj_rs)
             
             if plotting:
@@ -104,17 +139,33 @@ class PoseTrajectoryTransferer(TrajectoryTransferer):
                 handles.append(self.sim.env.drawlinestrip(transformed_ee_traj_rs[:,:3,3], 2, (0,1,0)))
                 self.sim.viewer.Step()
         
-        if not self.init_trajectory_transferer:
+        library_traj = None
+        if self.traj_library is not None:
+            warp_descriptor = np.concatenate([transformed_ee_traj_rs[:,None,:3,3] for transformed_ee_traj_rs in transformed_ee_trajs_rs], axis=1)
+            library_traj = self.traj_library.query(demo.name, warp_descriptor)
+        # the initialization trajectory is only transferred if the library doesn't have one
+        if library_traj is not None:
+            init_traj = library_traj
+        elif self.init_trajectory_transferer:
+            warm_init_traj = self.init_trajectory_transferer.transfer(reg, demo, plotting=plotting)
+            init_traj = np.concatenate([warm_init_traj.lr2arm_traj[lr] for lr in active_lr], axis=1)
+        else:
             # modify the shoulder joint angle of init_traj to be the limit (highest arm) because this usually gives a better local optima (but this might not be the right thing to do)
             dof_inds = sim_util.dof_inds_from_name(self.sim.robot, manip_name)
             joint_ind = self.sim.robot.GetJointIndex("%s_shoulder_lift_joint"%lr)
             init_traj[:,dof_inds.index(joint_ind)] = self.sim.robot.GetDOFLimits([joint_ind])[0][0]
 
         print "planning pose trajectory following"
-        test_traj, obj_value, pose_errs = planning.plan_follow_trajs(self.sim.robot, manip_name, ee_link_names, transformed_ee_trajs_rs, init_traj, 
+        start_time = time.time()
+        test_traj, obj_value, pose_errs, n_iters = planning.plan_follow_trajs(self.sim.robot, manip_name, ee_link_names, transformed_ee_trajs_rs, init_traj, 
                                                                        start_fixed=False,
                                                                        use_collision_cost=self.use_collision_cost,
-                                                                       beta_pos=self.beta_pos, beta_rot=self.beta_rot)
+                                                                       beta_pos=self.beta_pos, beta_rot=self.beta_rot, 
+                                                                       return_n_iters=True)
+        print "trajectory optimization time: %.3f s, SQP iterations: %i, objective: %.4g" % (time.time() - start_time, n_iters, obj_value)
+        if self.traj_library is not None:
+            print "init from library: %s (%i/%i hits)" % (library_traj is not None, self.traj_library.n_hits, self.traj_library.n_queries)
+            self.traj_library.add(demo.name, warp_descriptor, test_traj)
 
         # the finger trajectory is the same for the demo and the test trajectory
         for lr in active_lr:
@@ -137,8 +188,9 @@ class FingerTrajectoryTransferer(TrajectoryTransferer):
                  beta_pos=settings.BETA_POS, 
                  gamma=settings.GAMMA, 
                  use_collision_cost=settings.USE_COLLISION_COST, 
-                 init_trajectory_transferer=None):
-        super(FingerTrajectoryTransferer, self).__init__(sim, beta_pos, gamma, use_collision_cost, init_trajectory_transferer=init_trajectory_transferer)
+                 init_trajectory_transferer=None, 
+                 traj_library=None):
+        super(FingerTrajectoryTransferer, self).__init__(sim, beta_pos, gamma, use_collision_cost, init_trajectory_transferer=init_trajectory_transferer, traj_library=traj_library)
 
     def transfer(self, reg, demo, plotting=False):
         handles = []
@@ -151,18 +203,15 @@ class FingerTrajectoryTransferer(TrajectoryTransferer):
             handles.append(self.sim.env.plot3(test_cloud[:,:3], 2, test_color if test_color is not None else (0,0,1)))
             self.sim.viewer.Step()
         
-        active_lr = ""
-        for lr in 'lr':
-            if lr in demo.aug_traj.lr2arm_traj and sim_util.arm_moved(demo.aug_traj.lr2arm_traj[lr]):
-                active_lr += lr
-        _, timesteps_rs = sim_util.unif_resample(np.c_[(1./settings.JOINT_LENGTH_PER_STEP) * np.concatenate([demo.aug_traj.lr2arm_traj[lr] for lr in active_lr], axis=1), 
-                                                       (1./settings.FINGER_CLOSE_RATE) * np.concatenate([demo.aug_traj.lr2finger_traj[lr] for lr in active_lr], axis=1)], 
-                                                 1.)
-        demo_aug_traj_rs = demo.aug_traj.get_resampled_traj(timesteps_rs)
+        active_lr = demo.get_active_lr()
+        timesteps_rs, demo_aug_traj_rs = demo.get_resampled_traj(settings.JOINT_LENGTH_PER_STEP, settings.FINGER_CLOSE_RATE)
+
+        # warp the finger points trajectories of all the active grippers (and the end-effector trajectories to 
+        # plot them) at once
+        lr2flr2demo_finger_pts_traj_rs = dict((lr, demo.get_resampled_finger_pts_traj(self.sim.robot, lr, settings.JOINT_LENGTH_PER_STEP, settings.FINGER_CLOSE_RATE)) for lr in active_lr)
+        name2transformed = reg.f.warp(name2pts=dict(((lr, finger_lr), lr2flr2demo_finger_pts_traj_rs[lr][finger_lr]) for lr in active_lr for finger_lr in 'lr'), 
+                                      name2hmats=dict(((lr, 'ee'), demo_aug_traj_rs.lr2ee_traj[lr]) for lr in active_lr) if plotting else None)
 
-        if self.init_trajectory_transferer:
-            warm_init_traj = self.init_trajectory_transferer.transfer(reg, demo, plotting=plotting)
-        
         manip_name = ""
         flr2finger_link_names = []
         flr2transformed_finger_pts_trajs_rs = []
@@ -175,25 +224,21 @@ class FingerTrajectoryTransferer(TrajectoryTransferer):
                 manip_name += "+"
             manip_name += arm_name + "+" + finger_name
             
-            if self.init_trajectory_transferer:
-                init_traj = np.c_[init_traj, warm_init_traj.lr2arm_traj[lr], warm_init_traj.lr2finger_traj[lr]]
-            else:
-                init_traj = np.c_[init_traj, demo_aug_traj_rs.lr2arm_traj[lr], demo_aug_traj_rs.lr2finger_traj[lr]]
+            init_traj = np.c_[init_traj, demo_aug_traj_rs.lr2arm_traj[lr], demo_aug_traj_rs.lr2finger_traj[lr]]
             
             if plotting:
                 handles.append(self.sim.env.drawlinestrip(demo.aug_traj.lr2ee_traj[lr][:,:3,3], 2, (1,0,0)))
                 handles.append(self.sim.env.drawlinestrip(demo_aug_traj_rs.lr2ee_traj[lr][:,:3,3], 2, (1,1,0)))
-                transformed_ee_traj_rs = reg.f.transform_hmats(demo_aug_traj_rs.lr2ee_traj[lr])
-                handles.append(self.sim.env.drawlinestrip(transformed_ee_traj_rs[:,:3,3], 2, (0,1,0)))
+                handles.append(self.sim.env.drawlinestrip(name2transformed[(lr, 'ee')][:,:3,3], 2, (0,1,0)))
                 self.sim.viewer.Step()
 
-            flr2demo_finger_pts_traj_rs = sim_util.get_finger_pts_traj(self.sim.robot, lr, (demo_aug_traj_rs.lr2ee_traj[lr], demo_aug_traj_rs.lr2finger_traj[lr]))
+            flr2demo_finger_pts_traj_rs = lr2flr2demo_finger_pts_traj_rs[lr]
             
             flr2transformed_finger_pts_traj_rs = {}
             flr2finger_link_name = {}
             flr2finger_rel_pts = {}
             for finger_lr in 'lr':
-                flr2transformed_finger_pts_traj_rs[finger_lr] = reg.f.transform_points(np.concatenate(flr2demo_finger_pts_traj_rs[finger_lr], axis=0)).reshape((-1,4,3))
+                flr2transformed_finger_pts_traj_rs[finger_lr] = name2transformed[(lr, finger_lr)]
                 flr2finger_link_name[finger_lr] = "%s_gripper_%s_finger_tip_link"%(lr,finger_lr)
                 flr2finger_rel_pts[finger_lr] = sim_util.get_finger_rel_pts(finger_lr)
             flr2finger_link_names.append(flr2finger_link_name)
@@ -204,19 +249,37 @@ class FingerTrajectoryTransferer(TrajectoryTransferer):
                 handles.extend(sim_util.draw_finger_pts_traj(self.sim, flr2transformed_finger_pts_traj_rs, (0,1,0)))
                 self.sim.viewer.Step()
         
-        if not self.init_trajectory_transferer:
+        library_traj = None
+        if self.traj_library is not None:
+            warp_descriptor = np.concatenate([flr2transformed_finger_pts_traj_rs[finger_lr] 
+                                              for flr2transformed_finger_pts_traj_rs in flr2transformed_finger_pts_trajs_rs 
+                                              for finger_lr in 'lr'], axis=1)
+            library_traj = self.traj_library.query(demo.name, warp_descriptor)
+        # the initialization trajectory is only transferred if the library doesn't have one
+        if library_traj is not None:
+            init_traj = library_traj
+        elif self.init_trajectory_transferer:
+            warm_init_traj = self.init_trajectory_transferer.transfer(reg, demo, plotting=plotting)
+            init_traj = np.concatenate([np.c_[warm_init_traj.lr2arm_traj[lr], warm_init_traj.lr2finger_traj[lr]] for lr in active_lr], axis=1)
+        else:
             # modify the shoulder joint angle of init_traj to be the limit (highest arm) because this usually gives a better local optima (but this might not be the right thing to do)
             dof_inds = sim_util.dof_inds_from_name(self.sim.robot, manip_name)
             joint_ind = self.sim.robot.GetJointIndex("%s_shoulder_lift_joint"%lr)
             init_traj[:,dof_inds.index(joint_ind)] = self.sim.robot.GetDOFLimits([joint_ind])[0][0]
         
         print "planning finger trajectory following"
-        test_traj, obj_value, rel_pts_costs = planning.plan_follow_finger_pts_trajs(self.sim.robot, manip_name, 
+        start_time = time.time()
+        test_traj, obj_value, rel_pts_costs, n_iters = planning.plan_follow_finger_pts_trajs(self.sim.robot, manip_name, 
                                                                               flr2finger_link_names, flr2finger_rel_pts, 
                                                                               flr2transformed_finger_pts_trajs_rs, init_traj, 
                                                                               use_collision_cost=self.use_collision_cost,
                                                                               start_fixed=False,
-                                                                              beta_pos=self.beta_pos, gamma=self.gamma)
+                                                                              beta_pos=self.beta_pos, gamma=self.gamma, 
+                                                                              return_n_iters=True)
+        print "trajectory optimization time: %.3f s, SQP iterations: %i, objective: %.4g" % (time.time() - start_time, n_iters, obj_value)
+        if self.traj_library is not None:
+            print "init from library: %s (%i/%i hits)" % (library_traj is not None, self.traj_library.n_hits, self.traj_library.n_queries)
+            self.traj_library.add(demo.name, warp_descriptor, test_traj)
 
         full_traj = (test_traj, sim_util.dof_inds_from_name(self.sim.robot, manip_name))
         test_aug_traj = demonstration.AugmentedTrajectory.create_from_full_traj(self.sim.robot, full_traj, lr2open_finger_traj=demo_aug_traj_rs.lr2open_finger_traj, lr2close_finger_traj=demo_aug_traj_rs.lr2close_finger_traj)
@@ -1,8 +1,11 @@
 from __future__ import division
 
 import os 
+import sys
 import time
 import argparse
+import tempfile
+import ctypes
 from lfd.util import colorize
 
 def redprint(msg):
@@ -62,3 +65,29 @@ class suppress_stdout(object):
         os.dup2(self.save_fds,1)
         # Close the null file
         os.close(self.save_fds)
+
+class capture_stdout(object):
+    '''
+    A context manager like suppress_stdout, but the suppressed output 
+    (including the one of compiled sub-functions) is kept in the output 
+    attribute after the block
+    '''
+    def __init__(self):
+        self.output = ""
+        self.tmp_file = tempfile.TemporaryFile()
+        self.save_fds = os.dup(1)
+
+    def __enter__(self):
+        sys.stdout.flush()
+        os.dup2(self.tmp_file.fileno(), 1)
+        return self
+
+    def __exit__(self, *_):
+        # flush the C and python buffers before stdout is re-assigned
+        sys.stdout.flush()
+        ctypes.CDLL(None).fflush(None)
+        os.dup2(self.save_fds, 1)
+        os.close(self.save_fds)
+        self.tmp_file.seek(0)
+        self.output = self.tmp_file.read()
+        self.tmp_file.close()
@@ -13,12 +13,13 @@ import numpy as np
 from lfd.environment import sim_util
 from lfd.environment import settings
 from constants import MAX_ACTIONS_TO_TRY
-from lfd.demonstration.demonstration import SceneState, GroundTruthRopeSceneState, AugmentedTrajectory, Demonstration
+from lfd.demonstration.demonstration import SceneState, GroundTruthRopeSceneState, AugmentedTrajectory, Demonstration, \
+    load_demo_artifacts, save_demo_artifacts
 from lfd.environment.simulation import DynamicRopeSimulationRobotWorld
 from lfd.environment.simulation_object import XmlSimulationObject, BoxSimulationObject, CylinderSimulationObject, RopeSimulationObject
 from lfd.environment.environment import LfdEnvironment, GroundTruthRopeLfdEnvironment
 from lfd.registration.registration import TpsRpmBijRegistrationFactory, TpsRpmRegistrationFactory, TpsSegmentRegistrationFactory, BatchGpuTpsRpmBijRegistrationFactory, BatchGpuTpsRpmRegistrationFactory
-from lfd.transfer.transfer import PoseTrajectoryTransferer, FingerTrajectoryTransferer
+from lfd.transfer.transfer import PoseTrajectoryTransferer, FingerTrajectoryTransferer, TrajectoryLibrary
 from lfd.transfer.registration_transfer import TwoStepRegistrationAndTrajectoryTransferer, UnifiedRegistrationAndTrajectoryTransferer
 from lfd.action_selection import GreedyActionSelection
 from lfd.action_selection import FeatureActionSelection
@@ -97,6 +98,7 @@ def eval_on_holdout(args, action_selection, reg_and_traj_transferer, lfd_env, si
             
             eval_stats.generalized = True
             num_actions_to_try = MAX_ACTIONS_TO_TRY if args.eval.search_until_feasible else 1
+            action2speculative_result = {}
             for i_choice in range(num_actions_to_try):
                 if q_values_root[i_choice] == -np.inf: # none of the demonstrations generalize
                     eval_stats.generalized = False
@@ -106,12 +108,37 @@ def eval_on_holdout(args, action_selection, reg_and_traj_transferer, lfd_env, si
                 best_root_action = str(agenda[i_choice])
 
                 start_time = time.time()
-                try:
-                    test_aug_traj = reg_and_traj_transferer.transfer(GlobalVars.demos[best_root_action], scene_state, plotting=args.plotting)
-                except ValueError: # If something is cloud/traj is empty or something
-                    redprint("**Raised value error during traj transfer")
-                    break
-                eval_stats.feasible, eval_stats.misgrasp = lfd_env.execute_augmented_trajectory(test_aug_traj, step_viewer=args.animation, interactive=args.interactive, check_feasible=args.eval.check_feasible)
+                # reuse the transfer and execution done by the search if it was executed the same way, unless this one has to be shown
+                transfer_result = None
+                if not (args.plotting or args.animation or args.interactive):
+                    transfer_result = action_selection.get_transfer_result(scene_state, best_root_action, check_feasible=bool(args.eval.check_feasible))
+                    if transfer_result is None and args.eval.speculative_k > 1 and args.eval.check_feasible and num_actions_to_try > 1 and best_root_action not in action2speculative_result \
+                            and reg_and_traj_transferer.supports_speculative_transfer():
+                        # transfer this and the next candidates concurrently, up to the first feasible one
+                        i_end = min(i_choice + args.eval.speculative_k, num_actions_to_try)
+                        actions = [str(action) for action, q_value in zip(agenda[i_choice:i_end], q_values_root[i_choice:i_end]) if q_value != -np.inf]
+                        speculative_results = reg_and_traj_transferer.speculative_transfer([GlobalVars.demos[action] for action in actions], scene_state, lfd_env)
+                        action2speculative_result.update(zip(actions, speculative_results))
+                speculative_result = action2speculative_result.get(best_root_action)
+                if speculative_result is not None and speculative_result[0] is None:
+                    redprint("**Speculative traj transfer failed, transferring %s in this process" % best_root_action)
+                    speculative_result = None
+                if transfer_result is not None:
+                    test_aug_traj = transfer_result.aug_traj
+                    eval_stats.feasible, eval_stats.misgrasp = transfer_result.feasible, transfer_result.misgrasp
+                    sim.set_state(transfer_result.sim_state)
+                elif speculative_result is not None:
+                    test_aug_traj, eval_stats.feasible, eval_stats.misgrasp = speculative_result
+                    if eval_stats.feasible or not args.eval.check_feasible:
+                        # the worker's simulation is gone, so the trajectory is executed again in this one
+                        eval_stats.feasible, eval_stats.misgrasp = lfd_env.execute_augmented_trajectory(test_aug_traj, step_viewer=args.animation, interactive=args.interactive, check_feasible=args.eval.check_feasible)
+                else:
+                    try:
+                        test_aug_traj = reg_and_traj_transferer.transfer(GlobalVars.demos[best_root_action], scene_state, plotting=args.plotting)
+                    except ValueError: # If something is cloud/traj is empty or something
+                        redprint("**Raised value error during traj transfer")
+                        break
+                    eval_stats.feasible, eval_stats.misgrasp = lfd_env.execute_augmented_trajectory(test_aug_traj, step_viewer=args.animation, interactive=args.interactive, check_feasible=args.eval.check_feasible)
                 eval_stats.exec_elapsed_time += time.time() - start_time
                 
                 if not args.eval.check_feasible or eval_stats.feasible:  # try next action if TrajOpt cannot find feasible action and we care about feasibility
@@ -323,6 +350,8 @@ def parse_input_args():
     parser_eval.add_argument('actionfile', type=str, nargs='?', default='../bigdata/misc/overhand_actions.h5')
     parser_eval.add_argument('holdoutfile', type=str, nargs='?', default='../bigdata/misc/holdout_set_Jun20_0.10.h5')
     parser.add_argument("--landmarkfile", type=str, default='../data/misc/landmarks.h5')
+    parser.add_argument("--landmark_nearest", type=int, default=None,
+                        help="only register the landmarks nearest to the cloud under a cheap shape descriptor")
 
     parser_eval.add_argument('action_selection', type=str, nargs='?', choices=['greedy', 'feature'])
     parser_eval.add_argument('--weightfile', type=str, default='')
@@ -354,6 +383,7 @@ def parse_input_args():
     parser_eval.add_argument("--beta_rot", type=float, default=100.0)
     parser_eval.add_argument("--gamma", type=float, default=1000.0)
     parser_eval.add_argument("--use_collision_cost", type=int, default=1)
+    parser_eval.add_argument("--traj_library", type=int, default=0, help="if nonzero, initialize the trajectory optimization with the nearest previously transferred trajectory")
 
     parser_eval.add_argument("--num_steps", type=int, default=5, help="maximum number of steps to simulate each task")
     parser_eval.add_argument("--dof_limits_factor", type=float, default=1.0)
@@ -364,7 +394,10 @@ def parse_input_args():
 
 
     parser_eval.add_argument("--parallel", action="store_true")
+    parser_eval.add_argument("--speculative_k", type=int, default=1, help="if greater than 1 and searching until a feasible action is found, transfer this many agenda candidates concurrently in worker processes")
+    parser_eval.add_argument("--search_sim_profile", type=str, default=None, choices=sorted(settings.SIM_PROFILES.keys()), help="fidelity profile of the simulation during the search. By default, the search uses the profile of the execution")
     parser_eval.add_argument("--batch", action="store_true", default=False)
+    parser_eval.add_argument("--demo_artifacts_file", type=str, default='', help="h5 file where the demonstration-side transfer results are cached between runs")
 
     parser_replay = subparsers.add_parser('replay')
     parser_replay.add_argument("loadresultfile", type=str)
@@ -420,6 +453,8 @@ def set_global_vars(args):
         aug_traj = AugmentedTrajectory(lr2arm_traj=lr2arm_traj, lr2finger_traj=lr2finger_traj, lr2ee_traj=lr2ee_traj, lr2open_finger_traj=lr2open_finger_traj, lr2close_finger_traj=lr2close_finger_traj)
         demo = Demonstration(action, scene_state, aug_traj)
         GlobalVars.demos[action] = demo
+    if args.eval.demo_artifacts_file:
+        load_demo_artifacts(GlobalVars.demos, args.eval.demo_artifacts_file)
 
 def setup_lfd_environment_sim(args):
     actions = h5py.File(args.eval.actionfile, 'r')
@@ -515,9 +550,11 @@ def setup_registration_and_trajectory_transferer(args, sim):
             raise RuntimeError("Invalid reg_type option %s"%args.eval.reg_type)
 
     if args.eval.transferopt == 'pose' or args.eval.transferopt == 'finger':
-        traj_transferer = PoseTrajectoryTransferer(sim, args.eval.beta_pos, args.eval.beta_rot, args.eval.gamma, args.eval.use_collision_cost)
+        traj_transferer = PoseTrajectoryTransferer(sim, args.eval.beta_pos, args.eval.beta_rot, args.eval.gamma, args.eval.use_collision_cost, 
+                                                   traj_library=TrajectoryLibrary() if args.eval.traj_library else None)
         if args.eval.transferopt == 'finger':
-            traj_transferer = FingerTrajectoryTransferer(sim, args.eval.beta_pos, args.eval.gamma, args.eval.use_collision_cost, init_trajectory_transferer=traj_transferer)
+            traj_transferer = FingerTrajectoryTransferer(sim, args.eval.beta_pos, args.eval.gamma, args.eval.use_collision_cost, init_trajectory_transferer=traj_transferer, 
+                                                         traj_library=TrajectoryLibrary() if args.eval.traj_library else None)
     else:
         raise RuntimeError("Invalid transferopt option %s"%args.eval.transferopt)
     
@@ -556,7 +593,7 @@ def get_features(args):
 
     feats = feat(args.eval.actionfile)
     try:
-        feats.set_landmark_file(args.landmarkfile)
+        feats.set_landmark_file(args.landmarkfile, args.landmark_nearest)
     except AttributeError:
         pass
     if args.eval.weightfile:
@@ -588,7 +625,7 @@ def main():
     if args.eval.action_selection == 'greedy':
         action_selection = GreedyActionSelection(reg_and_traj_transferer.registration_factory)
     else:
-        action_selection = FeatureActionSelection(reg_and_traj_transferer.registration_factory, GlobalVars.features, GlobalVars.actions, GlobalVars.demos, simulator=reg_and_traj_transferer, lfd_env=lfd_env, width=args.eval.width, depth=args.eval.depth)
+        action_selection = FeatureActionSelection(reg_and_traj_transferer.registration_factory, GlobalVars.features, GlobalVars.actions, GlobalVars.demos, simulator=reg_and_traj_transferer, lfd_env=lfd_env, width=args.eval.width, depth=args.eval.depth, sim_profile=args.eval.search_sim_profile)
 
     if args.subparser_name == "eval":
         start = time.time()
@@ -597,6 +634,8 @@ def main():
         else:
             eval_on_holdout(args, action_selection, reg_and_traj_transferer, lfd_env, sim)
         print "eval time is:\t{}".format(time.time() - start)
+        if args.eval.demo_artifacts_file:
+            save_demo_artifacts(GlobalVars.demos, args.eval.demo_artifacts_file)
     elif args.subparser_name == "replay":
         replay_on_holdout(args, action_selection, reg_and_traj_transferer, lfd_env, sim)
     else:
@@ -7,10 +7,54 @@ from lfd.demonstration.demonstration import Demonstration, SceneState
 from lfd.registration.registration import TpsRpmRegistration, TpsRpmRegistrationFactory
 from lfd.registration import tps, solver
 from lfd.registration import _has_cuda
+from lfd.tpsopt import transformations as tpsopt_transformations
+from lfd.tpsopt import tps as tpsopt_tps
+from lfd.tpsopt import batchtps_cpu
+from lfd.tpsopt.registration import unit_boxify, loglinspace, get_cpu_solver
+from lfd.tpsopt.settings import ROT_REG, DEFAULT_NORM_ITERS
+import scipy.spatial.distance as ssd
 from tempfile import mkdtemp
 import sys, time
 import unittest
 
+def batch_tps_rpm_bij_reference(x_nd, y_md, bend_coefs, T_init=1e-1, T_final=5e-3, 
+                                outlierfrac=1e-2, outlierprior=1e-1, outliercutoff=1e-2):
+    """
+    cost of batchtps.batch_tps_rpm_bij for a single pair of clouds, computed with fit_ThinPlateSpline
+    """
+    n, d = x_nd.shape
+    m, _ = y_md.shape
+    T_vals = loglinspace(T_init, T_final, len(bend_coefs))
+    f = tpsopt_transformations.ThinPlateSpline(d)
+    g = tpsopt_transformations.ThinPlateSpline(d)
+    for (b, T) in zip(bend_coefs, T_vals):
+        xwarped_nd = f.transform_points(x_nd)
+        ywarped_md = g.transform_points(y_md)
+        prob_nm = outlierprior * np.ones((n+1, m+1))
+        prob_nm[:n, :m] = np.exp(-(ssd.cdist(xwarped_nd, y_md) + ssd.cdist(x_nd, ywarped_md)) / (2*T)) + 1e-9
+        prob_nm[n, m] = outlierfrac * np.sqrt(n * m)
+        a_N = np.r_[np.ones(n), m * outlierfrac]
+        b_M = np.r_[np.ones(m), n * outlierfrac]
+        r_N = np.ones(n+1)
+        c_M = np.ones(m+1)
+        for _ in range(DEFAULT_NORM_ITERS):
+            r_N = a_N / prob_nm.dot(c_M)
+            rn_c_M = c_M
+            c_M = b_M / r_N.dot(prob_nm)
+        prob_nm = prob_nm[:n, :m] * r_N[:n, None]
+        rn_prob_nm = prob_nm * rn_c_M[None, :m]
+        cn_prob_nm = prob_nm * c_M[None, :m]
+        wt_n = rn_prob_nm.sum(axis=1)
+        xtarg_nd = np.where((wt_n > outliercutoff)[:, None], rn_prob_nm.dot(y_md), xwarped_nd)
+        wt_m = cn_prob_nm.sum(axis=0)
+        ytarg_md = np.where((wt_m > outliercutoff)[:, None], cn_prob_nm.T.dot(x_nd), ywarped_md)
+        f = tpsopt_transformations.fit_ThinPlateSpline(x_nd, xtarg_nd, bend_coef=b, rot_coef=ROT_REG)
+        g = tpsopt_transformations.fit_ThinPlateSpline(y_md, ytarg_md, bend_coef=b, rot_coef=ROT_REG)
+    cost = ((f.transform_points(x_nd) - xtarg_nd)**2).sum() + ((g.transform_points(y_md) - ytarg_md)**2).sum()
+    cost += (tpsopt_tps.tps_kernel_matrix(x_nd).dot(f.w_ng) * f.w_ng).sum()
+    cost += (tpsopt_tps.tps_kernel_matrix(y_md).dot(g.w_ng) * g.w_ng).sum()
+    return cost
+
 class TestRegistration(unittest.TestCase):
     def setUp(self):
         np.random.seed(0)
@@ -114,6 +158,46 @@ class TestRegistration(unittest.TestCase):
         + np.trace(y_ng.T.dot(wt_n[:,None]*y_ng)) + rot_coefs.sum() # constant
         self.assertTrue(np.allclose(obj, reg.f.get_objective().sum()))
 
+    def test_tpsopt_cpu_solvers(self):
+        x_nd = self.demos.values()[0].scene_state.cloud
+        y_nd = x_nd + (np.random.random(x_nd.shape) - 0.5) * 0.04
+        wt_n = np.random.random(len(x_nd)) + 0.1
+        n = len(x_nd)
+        bend_coefs = [.1, .01, .001]
+        rot_coef = np.r_[1e-4, 1e-4, 1e-1]
+        K_nn = tpsopt_tps.tps_kernel_matrix(x_nd)
+        
+        nogpu_solver = tpsopt_transformations.NoGPUEmptySolver(n, bend_coefs).get_solver(x_nd, K_nn, bend_coefs, rot_coef)
+        cached_solver = get_cpu_solver(x_nd, bend_coefs, rot_coef)
+        for bend_coef in bend_coefs:
+            f_test = tpsopt_transformations.fit_ThinPlateSpline(x_nd, y_nd, bend_coef=bend_coef, rot_coef=rot_coef, wt_n=wt_n)
+            for solver in [nogpu_solver, cached_solver]:
+                f = tpsopt_transformations.ThinPlateSpline()
+                solver.solve(wt_n, y_nd, bend_coef, rot_coef, f)
+                self.assertTrue(np.allclose(f.trans_g, f_test.trans_g))
+                self.assertTrue(np.allclose(f.lin_ag, f_test.lin_ag))
+                self.assertTrue(np.allclose(f.w_ng, f_test.w_ng))
+
+    def test_batchtps_cpu(self):
+        src_ctx = batchtps_cpu.CPUContext()
+        x_clds = []
+        for (i, demo_name) in enumerate(sorted(self.demos.keys())):
+            # clouds of different sizes, so that the batch arrays are padded
+            cloud = self.demos[demo_name].scene_state.cloud
+            x_nd, scale_params = unit_boxify(cloud[:len(cloud) - 5*i])
+            proj_mats, offset_mats, K_nn = src_ctx.get_sol_params(x_nd)
+            src_ctx.add_cld(demo_name, proj_mats, offset_mats, x_nd, K_nn, scale_params)
+            x_clds.append(x_nd)
+        src_ctx.update_arrays()
+        tgt_ctx = batchtps_cpu.CPUTgtContext(src_ctx)
+        tgt_ctx.set_cld(self.test_scene_state.cloud)
+        costs = batchtps_cpu.batch_tps_rpm_bij(src_ctx, tgt_ctx)
+        
+        y_md, _ = unit_boxify(self.test_scene_state.cloud)
+        for (x_nd, cost) in zip(x_clds, costs):
+            cost_ref = batch_tps_rpm_bij_reference(x_nd, y_md, src_ctx.bend_coefs)
+            self.assertTrue(np.allclose(cost, cost_ref, rtol=1e-3))
+
     def test_tpsrpm_objective_monotonicity(self):
         n_iter = 10
         em_iter = 10
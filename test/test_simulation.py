@@ -11,6 +11,7 @@ import trajoptpy
 from lfd.environment.simulation import DynamicSimulation
 from lfd.environment.simulation_object import XmlSimulationObject, BoxSimulationObject, CylinderSimulationObject, RopeSimulationObject
 from lfd.environment import sim_util
+from lfd.environment import settings
 
 
 class TestSimulation(unittest.TestCase):
@@ -118,6 +119,37 @@ class TestSimulation(unittest.TestCase):
         self.assertArrayDictEqual(sim_state1[1], sim_state3[1])
         self.assertArrayDictEqual(sim_state1[1], sim_state4[1])
     
+    def test_set_state_in_place(self):
+        """
+        Check if setting the state in the existing bullet objects gives the same states as recreating them
+        """
+        sim_state0 = self.sim.get_state()
+        self.sim.settle(max_steps=100)
+        
+        set_state_in_place = settings.SET_STATE_IN_PLACE
+        in_place2states = {}
+        try:
+            for in_place in [True, False]:
+                settings.SET_STATE_IN_PLACE = in_place
+                self.sim.step() # the objects are moving when the state is set
+                self.sim.set_state(sim_state0)
+                sim_state1 = self.sim.get_state()
+                self.sim.step()
+                sim_state2 = self.sim.get_state()
+                in_place2states[in_place] = (sim_state1, sim_state2)
+        finally:
+            settings.SET_STATE_IN_PLACE = set_state_in_place
+        
+        self.assertArrayDictAlmostEqual(sim_state0[1], in_place2states[True][0][1])
+        self.assertArrayDictAlmostEqual(in_place2states[False][0][1], in_place2states[True][0][1])
+        self.assertArrayDictAlmostEqual(in_place2states[False][1][1], in_place2states[True][1][1])
+    
+    def assertArrayDictAlmostEqual(self, d0, d1, atol=1e-5):
+        self.assertSetEqual(set(d0.keys()), set(d1.keys()))
+        for (k, v0) in d0.iteritems():
+            v1 = d1[k]
+            self.assertTrue(np.allclose(v0, v1, atol=atol))
+    
     def assertArrayDictEqual(self, d0, d1):
         self.assertSetEqual(set(d0.keys()), set(d1.keys()))
         for (k, v0) in d0.iteritems():